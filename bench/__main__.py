@@ -0,0 +1,66 @@
+import argparse
+import json
+import logging
+import sys
+
+import urllib3
+
+from downloader.limiter import parse_size
+from downloader.rangespec import UNIT
+from downloader.static import CHUNK_SIZE
+
+from .suite import run, compare, save
+
+
+# Sequential, then concurrent: WORKERS is 1, the default of download() alone measures no concurrency.
+BENCH_WORKERS = [1, 4]
+
+
+def _sizes(text: str):
+    # Duplicates would only run the same case twice.
+    return list(dict.fromkeys(parse_size(v) for v in text.split(",")))
+
+
+def _ints(text: str):
+    return list(dict.fromkeys(int(v) for v in text.split(",")))
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(
+        prog="python -m bench",
+        description="End-to-end benchmark of download, concat and migrate against a local Range server."
+    )
+    parser.add_argument("-s", "--sizes", type=_sizes, default=_sizes("4M,32M"), help="File sizes, comma separated.")
+    parser.add_argument("-u", "--units", type=_sizes, default=[UNIT], help="Slice sizes (UNIT), comma separated.")
+    parser.add_argument(
+        "-c", "--chunks", type=_sizes, default=[CHUNK_SIZE], help="Read sizes (CHUNK_SIZE), comma separated."
+    )
+    parser.add_argument(
+        "-w", "--workers", type=_ints, default=BENCH_WORKERS,
+        help="Concurrency levels, comma separated."
+    )
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Runs of every case.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds every request is delayed by.")
+    parser.add_argument("--bandwidth", type=parse_size, help="Bytes/s of every connection, e.g. 10M.")
+    parser.add_argument("--no_migrate", action="store_true", help="Skip the migrate cases.")
+    parser.add_argument("--work", help="Folder for the served files and the downloads, default is a temporary one.")
+    parser.add_argument("-o", "--out", help="JSON report file, default is stdout.")
+    parser.add_argument("-b", "--baseline", help="Earlier JSON report to compare the medians with, on stderr.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log at the INFO level.")
+    return parser
+
+
+if __name__ == '__main__':
+    args = get_argparser().parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    urllib3.disable_warnings()
+
+    report = run(
+        args.sizes, args.units, args.chunks, args.workers, repeat=args.repeat,
+        latency=args.latency, bandwidth=args.bandwidth, migrate=not args.no_migrate, work=args.work
+    )
+    save(report, args.out)
+    if args.baseline:
+        with open(args.baseline, "r") as fp:
+            compare(report, json.load(fp), sys.stderr)
+    exit(0 if all(r["ok"] for r in report["results"]) else 1)
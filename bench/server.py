@@ -0,0 +1,169 @@
+import email.utils
+import html
+import logging
+import os
+import re
+import threading
+import time
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Optional, Tuple
+
+# Bytes written between two pacing sleeps of a shaped connection.
+SHAPING_CHUNK = 1 << 14
+_RANGE = re.compile(r"bytes=(\d*)-(\d*)$")
+
+
+def _parse_range(value: str, size: int) -> Optional[Tuple[int, int]]:
+    # A single range, inclusive on both ends, None when it can't be satisfied.
+    m = _RANGE.match(value.strip())
+    if not m or not any(m.groups()):
+        return None
+    low, high = m.groups()
+    if not low:
+        # Suffix range, the last `high` bytes.
+        low, high = max(size - int(high), 0), size - 1
+    else:
+        low, high = int(low), min(int(high), size - 1) if high else size - 1
+    return (low, high) if low <= high else None
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "_Server"
+
+    def log_message(self, fmt, *args):
+        logging.debug(f"[Bench] [Server] {fmt % args}")
+
+    def _local(self) -> str:
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        return os.path.join(self.server.root, os.path.normpath(path).lstrip(os.sep).lstrip("."))
+
+    def _listing(self, local: str) -> bytes:
+        # The nginx autoindex layout the migrator parses, a link per entry.
+        entries = "".join(
+            f'<a href="{urllib.parse.quote(n)}">{html.escape(n)}</a>\n' for n in sorted(os.listdir(local))
+        )
+        return f"<html><body><pre>\n<a href=\"../\">../</a>\n{entries}</pre></body></html>".encode("utf8")
+
+    def _send_body(self, fp, amt: int):
+        bandwidth = self.server.bandwidth
+        st, sent = time.monotonic(), 0
+        while sent < amt:
+            chunk = fp.read(min(SHAPING_CHUNK, amt - sent))
+            if not chunk:
+                break
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            if bandwidth:
+                # Per connection, ahead of the schedule means waiting for it.
+                ahead = sent / bandwidth - (time.monotonic() - st)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+    def _respond(self, body: bool):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        local = self._local()
+        if os.path.isdir(local):
+            content = self._listing(local)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            if body:
+                self.wfile.write(content)
+            return
+        if not os.path.isfile(local):
+            self.send_error(404)
+            return
+
+        st = os.stat(local)
+        size = st.st_size
+        etag = f'"{st.st_mtime_ns:x}-{size:x}"'
+        last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+        low, high, status = 0, size - 1, 200
+        requested = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        if requested and (if_range is None or if_range in (etag, last_modified)):
+            bounds = _parse_range(requested, size)
+            if bounds is None:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            (low, high), status = bounds, 206
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {low}-{high}/{size}")
+        self.send_header("Content-Length", str(high - low + 1))
+        self.end_headers()
+        if body:
+            with open(local, "rb") as fp:
+                fp.seek(low)
+                self._send_body(fp, high - low + 1)
+
+    def do_HEAD(self):
+        self._respond(body=False)
+
+    def do_GET(self):
+        try:
+            self._respond(body=True)
+        except (BrokenPipeError, ConnectionResetError):
+            # Clients may drop a range half way, a retry is their business.
+            self.close_connection = True
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, root: str, latency: float, bandwidth: Optional[int]):
+        super().__init__(address, _Handler)
+        self.root = root
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+
+class BenchServer:
+    """
+    Local HTTP/1.1 server over the files of `root`, with keep-alive, HEAD, single
+    Range requests answered by 206, If-Range, and directory listings for the migrator.
+    Every request is delayed by `latency` seconds, every connection is shaped to
+    `bandwidth` bytes/s when given. Binds an ephemeral port of 127.0.0.1.
+    """
+
+    def __init__(self, root: str, latency: float = 0.0, bandwidth: Optional[int] = None, port: int = 0):
+        self._server = _Server(("127.0.0.1", port), root, latency, bandwidth)
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def url(self, name: str) -> str:
+        return urllib.parse.urljoin(self.base_url, urllib.parse.quote(name))
+
+    def start(self) -> "BenchServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="BenchServer", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *_):
+        self.stop()
@@ -0,0 +1,99 @@
+import argparse
+import json
+import pathlib
+import statistics
+import subprocess
+import sys
+import tempfile
+from typing import Dict, List, Optional, Tuple
+
+from downloader.static import Meta
+from .suite import REPO, environment
+
+# Milliseconds a light subcommand may spend importing and running, interpreter start excluded.
+STARTUP_BUDGET_MS = 100
+# Dependencies of the engines, none of them is needed to parse arguments or to check fragments.
+HEAVY_MODULES = ("requests", "urllib3", "lxml", "tqdm", "aiohttp", "asyncio")
+# Placing fragments shows a progress bar, concat imports tqdm once it gets there, and only then.
+PLACING_MODULES = ("tqdm",)
+# Bytes of the fragment concat is probed with.
+FIXTURE_SIZE = 1 << 16
+
+# Runs run.py as `python run.py ...` would, after the interpreter has started.
+_PROBE = """
+import json, runpy, sys, time
+before = set(sys.modules)
+sys.argv = ["run.py"] + json.loads(sys.argv[1])
+st = time.perf_counter()
+try:
+    runpy.run_path("run.py", run_name="__main__")
+except SystemExit:
+    pass
+seconds = time.perf_counter() - st
+print(json.dumps({"seconds": seconds, "modules": sorted(set(sys.modules) - before)}), file=sys.stderr)
+"""
+
+
+def probe(argv: List[str]) -> dict:
+    proc = subprocess.run(
+        [sys.executable, "-c", _PROBE, json.dumps(argv)], cwd=REPO, capture_output=True, text=True, check=True
+    )
+    return json.loads(proc.stderr.strip().splitlines()[-1])
+
+
+def fixture(folder) -> str:
+    # A complete download of one fragment and its meta, concat goes all the way to placing it.
+    folder = pathlib.Path(folder)
+    (folder / f"f.bin@bytes=0-{FIXTURE_SIZE}").write_bytes(b"\0" * FIXTURE_SIZE)
+    Meta(instant_save=True, path=str(folder), url="http://127.0.0.1/f.bin", content_length=FIXTURE_SIZE)
+    return str(folder)
+
+
+def check(commands: List[List[str]], budget_ms: float = STARTUP_BUDGET_MS, repeat: int = 5,
+          allowed: Optional[Dict[str, Tuple[str, ...]]] = None) -> dict:
+    """
+    Run every command `repeat` times in a fresh interpreter.
+    A command fails when its median exceeds budget_ms or when it imports one of HEAVY_MODULES.
+    :param allowed: heavy modules a command, as joined in the report, needs anyway, only timed.
+    """
+    results = []
+    for argv in commands:
+        runs = [probe(argv) for _ in range(repeat)]
+        median = statistics.median(r["seconds"] for r in runs) * 1000
+        heavy = set(HEAVY_MODULES) - set((allowed or {}).get(" ".join(argv), ()))
+        heavy = sorted({m.split(".")[0] for m in runs[0]["modules"]} & heavy)
+        results.append({
+            "command": " ".join(argv), "median_ms": round(median, 2), "budget_ms": budget_ms,
+            "heavy_modules": heavy, "modules": len(runs[0]["modules"]), "ok": median <= budget_ms and not heavy
+        })
+    return {"environment": environment(), "results": results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog="python -m bench.startup",
+        description="Check that the light subcommands of run.py start within an import-time budget."
+    )
+    parser.add_argument("-b", "--budget", type=float, default=STARTUP_BUDGET_MS, help="Milliseconds per command.")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="Runs of every command.")
+    parser.add_argument("-o", "--out", help="JSON report file, default is stdout.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        fixture(folder)
+        placing = [["concat", folder], ["concat", "-F", folder]]
+        report = check(
+            [["--help"], ["concat", "-E", folder], *placing], budget_ms=args.budget, repeat=args.repeat,
+            allowed={" ".join(argv): PLACING_MODULES for argv in placing}
+        )
+    if args.out:
+        with open(args.out, "w") as fp:
+            json.dump(report, fp, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    for result in report["results"]:
+        if not result["ok"]:
+            print(f"[Startup] {result['command']!r} took {result['median_ms']}ms, "
+                  f"heavy modules = {result['heavy_modules']}.", file=sys.stderr)
+    exit(0 if all(r["ok"] for r in report["results"]) else 1)
@@ -0,0 +1,244 @@
+import hashlib
+import itertools
+import json
+import logging
+import os
+import pathlib
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+from downloader import download, concat
+from utils.migrate import WebServerMigrator
+
+from .server import BenchServer
+
+REPO = pathlib.Path(__file__).resolve().parent.parent
+# Fixed so that runs on different commits fetch the very same bytes.
+SEED = b"selenium-driven-bench"
+
+
+def _fill(fn: pathlib.Path, size: int) -> str:
+    # Pseudo random, incompressible content, sha256 of the whole file is returned.
+    digest = hashlib.sha256()
+    block = hashlib.sha512(SEED).digest() * 1024
+    with open(fn, "wb") as fp:
+        written, counter = 0, 0
+        while written < size:
+            chunk = hashlib.sha512(SEED + counter.to_bytes(8, "little")).digest() + block
+            chunk = chunk[:size - written]
+            fp.write(chunk)
+            digest.update(chunk)
+            written += len(chunk)
+            counter += 1
+    return digest.hexdigest()
+
+
+def _sha256(fn: pathlib.Path) -> Optional[str]:
+    if not fn.is_file():
+        return None
+    digest = hashlib.sha256()
+    with open(fn, "rb") as fp:
+        while chunk := fp.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _git(*args) -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", *args], cwd=REPO, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment() -> dict:
+    return {
+        "commit": _git("rev-parse", "HEAD"),
+        "dirty": bool(_git("status", "--porcelain", "--untracked-files=no")),
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def _summary(case: dict, runs: List[float], ok: bool) -> dict:
+    median = statistics.median(runs) if runs else None
+    return {
+        **case,
+        "ok": ok,
+        "runs": runs,
+        "median": median,
+        "min": min(runs) if runs else None,
+        "mb_per_sec": case["size"] / median / (1 << 20) if median else None,
+    }
+
+
+def _timed(fn, *args, **kwargs):
+    st = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - st, result
+
+
+def bench_download(server: BenchServer, name: str, size: int, sha256: str, work: pathlib.Path,
+                   unit: int, chunk_size: int, workers: int, repeat: int) -> List[dict]:
+    # download() then concat() of its fragments, into a fresh folder every time.
+    case = {"size": size, "unit": unit, "chunk_size": chunk_size, "workers": workers}
+    downloads, concats, ok = [], [], True
+    for _ in range(repeat):
+        folder = pathlib.Path(tempfile.mkdtemp(dir=work))
+        try:
+            secs, (_, totally_failed) = _timed(
+                download, server.url(f"files/{name}"), path=str(folder), name=name,
+                workers=workers, unit=unit, chunk_size=chunk_size
+            )
+            downloads.append(secs)
+            try:
+                secs, _ = _timed(concat, str(folder))
+            except SystemExit as se:
+                # concat() exits on missing or corrupted fragments.
+                logging.warning(f"[Bench] concat exited with {se.code}, case = {case}.")
+                ok = False
+                continue
+            concats.append(secs)
+            if totally_failed or _sha256(folder / name) != sha256:
+                logging.warning(f"[Bench] Downloaded content doesn't match, case = {case}.")
+                ok = False
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+    return [_summary({"op": "download", **case}, downloads, ok), _summary({"op": "concat", **case}, concats, ok)]
+
+
+def bench_default_path(server: BenchServer, name: str, size: int, sha256: str, work: pathlib.Path) -> dict:
+    # download() without path nor name keeps everything in the working directory, concat() of "." as well.
+    case = {"size": size}
+    folder = pathlib.Path(tempfile.mkdtemp(dir=work))
+    cwd = os.getcwd()
+    ok = True
+    try:
+        os.chdir(folder)
+        secs, (_, totally_failed) = _timed(download, server.url(f"files/{name}"))
+        _timed(concat, ".")
+        if totally_failed or _sha256(folder / name) != sha256:
+            logging.warning(f"[Bench] Downloaded content doesn't match, case = {case}.")
+            ok = False
+    except (Exception, SystemExit) as e:  # noqa
+        logging.warning(f"[Bench] Download without a path failed, case = {case}.", exc_info=e)
+        ok = False
+        secs = None
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(folder, ignore_errors=True)
+    return _summary({"op": "download_cwd", **case}, [secs] if secs is not None else [], ok)
+
+
+class _TimedMigrator(WebServerMigrator):
+    # The receiver polls once a second, the transfer ends when the worker thread is done with the targets.
+    finished: Optional[float] = None
+
+    def _single_threaded(self, targets, path):
+        super()._single_threaded(targets, path)
+        self.finished = time.perf_counter()
+
+
+def bench_migrate(server: BenchServer, name: str, size: int, sha256: str, work: pathlib.Path, repeat: int) -> dict:
+    # From migrate() to the end of its transfer, the once a second reporting of the migrator left out.
+    case = {"size": size}
+    runs, ok = [], True
+    for _ in range(repeat):
+        folder = pathlib.Path(tempfile.mkdtemp(dir=work))
+        try:
+            migrator = _TimedMigrator(server.url(f"mig/{name}/"))
+            st = time.perf_counter()
+            migrator.migrate(to=str(folder))
+            runs.append(migrator.finished - st)
+            if _sha256(folder / name / name) != sha256:
+                logging.warning(f"[Bench] Migrated content doesn't match, case = {case}.")
+                ok = False
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+    return _summary({"op": "migrate", **case}, runs, ok)
+
+
+def run(sizes: List[int], units: List[int], chunks: List[int], workers: List[int], repeat: int = 3,
+        latency: float = 0.0, bandwidth: Optional[int] = None, migrate: bool = True,
+        work: Optional[str] = None) -> dict:
+    """
+    Run the whole matrix against a local BenchServer.
+    :param sizes: file sizes, in bytes.
+    :param units, chunks, workers: slice sizes, read sizes and worker counts download() is run with.
+    :param repeat: runs of every case, results carry all of them and their median.
+    :param latency: seconds every request is delayed by on the server.
+    :param bandwidth: bytes/s each connection is shaped to, unlimited when None.
+    :param work: folder for the served files and the downloads, a temporary one by default.
+    :return: the JSON-able report.
+    """
+    params = {
+        "sizes": sizes, "units": units, "chunks": chunks, "workers": workers,
+        "repeat": repeat, "latency": latency, "bandwidth": bandwidth, "migrate": migrate,
+    }
+    report = {"environment": environment(), "params": params, "results": []}
+    root = pathlib.Path(tempfile.mkdtemp(prefix="bench-", dir=work))
+    try:
+        files: Dict[int, tuple] = {}
+        for size in sizes:
+            name = f"{size}.bin"
+            (root / "files").mkdir(exist_ok=True)
+            (root / "mig" / name).mkdir(parents=True)
+            sha256 = _fill(root / "files" / name, size)
+            os.link(root / "files" / name, root / "mig" / name / name)
+            files[size] = name, sha256
+
+        with BenchServer(str(root), latency=latency, bandwidth=bandwidth) as server:
+            out = root / "out"
+            out.mkdir()
+            for size, unit, chunk_size, n in itertools.product(sizes, units, chunks, workers):
+                name, sha256 = files[size]
+                logging.warning(f"[Bench] download size = {size}, unit = {unit}, chunk = {chunk_size}, workers = {n}")
+                report["results"].extend(bench_download(server, name, size, sha256, out, unit, chunk_size, n, repeat))
+            for size in sizes:
+                name, sha256 = files[size]
+                report["results"].append(bench_default_path(server, name, size, sha256, out))
+            if migrate:
+                for size in sizes:
+                    logging.warning(f"[Bench] migrate size = {size}")
+                    name, sha256 = files[size]
+                    report["results"].append(bench_migrate(server, name, size, sha256, out, repeat))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return report
+
+
+def _key(result: dict) -> tuple:
+    return tuple(result.get(k) for k in ("op", "size", "unit", "chunk_size", "workers"))
+
+
+def compare(report: dict, baseline: dict, fp=sys.stdout):
+    # Median of every case against the one of the baseline, > 1 is faster than it.
+    before = {_key(r): r for r in baseline["results"]}
+    fp.write(f"{'op':<9}{'size':>12}{'unit':>10}{'chunk':>8}{'workers':>8}{'before':>10}{'after':>10}{'speedup':>9}\n")
+    for result in report["results"]:
+        old = before.get(_key(result))
+        if not old or not old["median"] or not result["median"]:
+            continue
+        op, size, unit, chunk_size, workers = _key(result)
+        fp.write(
+            f"{op:<9}{size:>12}{unit or '':>10}{chunk_size or '':>8}{workers or '':>8}"
+            f"{old['median']:>10.3f}{result['median']:>10.3f}{old['median'] / result['median']:>9.2f}\n"
+        )
+
+
+def save(report: dict, fn: Optional[str]):
+    if fn:
+        with open(fn, "w") as fp:
+            json.dump(report, fp, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
@@ -1,2 +1,9 @@
-from .downloader import download
 from .concat import concat
+
+
+# The engine is imported on first use, `concat` and `downloader.static` don't pull requests and urllib3 in.
+def __getattr__(name):
+    if name == "download":
+        from .downloader import download
+        return download
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,143 @@
+import collections
+import logging
+import threading
+import time
+from typing import Iterable, Optional, Tuple
+
+from .rangespec import UNIT, RangeSlicer
+from .static import ADAPTIVE_MIN_UNIT, ADAPTIVE_MAX_UNIT, ADAPTIVE_SLICE_SECS, ADAPTIVE_RTT_FACTOR, EWMA_ALPHA
+
+
+class Span:
+    """
+    An in-flight byte range, both ends inclusive. The worker reading it claims
+    bytes before receiving them, while another worker may lower `high` to steal
+    the unfetched remainder, so the reader stops exactly at the new end.
+    """
+
+    def __init__(self, low: int, high: int):
+        self.low = low
+        self.high = high
+        self.position = low
+        self._reserved = low
+        self._lock = threading.Lock()
+        self.sent: Optional[float] = None
+        self.first_byte: Optional[float] = None
+
+    def start(self):
+        self.sent = time.monotonic()
+
+    def claim(self, amt: int) -> int:
+        with self._lock:
+            amt = max(0, min(amt, self.high - self.position + 1))
+            self._reserved = self.position + amt
+            return amt
+
+    def advance(self, n: int):
+        with self._lock:
+            if self.first_byte is None:
+                self.first_byte = time.monotonic()
+            self.position += n
+            self._reserved = self.position
+
+    def split(self, min_size: int) -> Optional[Tuple[int, int]]:
+        # Give away the second half of what hasn't been claimed yet.
+        with self._lock:
+            remaining = self.high - self._reserved + 1
+            if remaining < 2 * min_size:
+                return None
+            mid = self._reserved + remaining // 2
+            stolen = mid, self.high
+            self.high = mid - 1
+            return stolen
+
+    @property
+    def rate(self) -> float:
+        # Transfer rate in bytes/s, not counting the time to first byte.
+        if self.first_byte is None:
+            return 0.0
+        return (self.position - self.low) / max(time.monotonic() - self.first_byte, 1e-6)
+
+    @property
+    def eta(self) -> float:
+        rate = self.rate
+        remaining = self.high - self.position + 1
+        return remaining / rate if rate else float("inf")
+
+    @property
+    def ttfb(self) -> Optional[float]:
+        if self.sent is None or self.first_byte is None:
+            return None
+        return self.first_byte - self.sent
+
+
+class AdaptiveSlicer:
+    """
+    Hands out slices sized from the measured per-connection throughput and RTT:
+    a slice should last ADAPTIVE_SLICE_SECS, and never less than ADAPTIVE_RTT_FACTOR
+    round trips, so the request overhead stays small on fast links while slow links
+    don't end up with long tails. Until the first slice completes, UNIT is used.
+
+    Once nothing is left to cut, next() splits the in-flight span that would take
+    the longest to finish and returns its second half.
+    """
+
+    def __init__(
+            self,
+            regions: Iterable[Tuple[int, int]],
+            unit: int = UNIT,
+            min_unit: int = ADAPTIVE_MIN_UNIT,
+            max_unit: int = ADAPTIVE_MAX_UNIT
+    ):
+        self._regions = collections.deque(regions)
+        self._unit = unit
+        self._min_unit = min_unit
+        self._max_unit = max_unit
+        self._inflight = set()
+        self._lock = threading.Lock()
+        self._rate: Optional[float] = None  # bytes/s per connection
+        self._rtt: Optional[float] = None  # s
+
+    @property
+    def unit(self) -> int:
+        if self._rate is None:
+            return self._unit
+        secs = max(ADAPTIVE_SLICE_SECS, ADAPTIVE_RTT_FACTOR * (self._rtt or 0))
+        return min(max(int(self._rate * secs), self._min_unit), self._max_unit)
+
+    def next(self) -> Optional[Span]:
+        with self._lock:
+            if self._regions:
+                low, high = self._regions.popleft()
+                unit = self.unit
+                # Don't leave a tail much smaller than a slice behind.
+                if high - low + 1 > unit + unit // 2:
+                    self._regions.appendleft((low + unit, high))
+                    high = low + unit - 1
+                span = Span(low, high)
+            else:
+                span = self._steal()
+            if span is not None:
+                self._inflight.add(span)
+            return span
+
+    def _steal(self) -> Optional[Span]:
+        for victim in sorted(self._inflight, key=lambda x: x.eta, reverse=True):
+            stolen = victim.split(self._min_unit)
+            if stolen:
+                logging.info(f"[Adaptive] Stealing {RangeSlicer.gen_range_headers(*stolen)['Range']} "
+                             f"from the slowest range, {victim.rate / 1024:.2f}KB/s.")
+                return Span(*stolen)
+        return None
+
+    def done(self, span: Span, ok: bool = True):
+        with self._lock:
+            self._inflight.discard(span)
+            if not ok or span.first_byte is None:
+                return
+            rate, ttfb = span.rate, span.ttfb
+            self._rate = rate if self._rate is None else EWMA_ALPHA * rate + (1 - EWMA_ALPHA) * self._rate
+            if ttfb is not None:
+                self._rtt = ttfb if self._rtt is None else EWMA_ALPHA * ttfb + (1 - EWMA_ALPHA) * self._rtt
+        logging.debug(f"[Adaptive] {self._rate / 1024:.2f}KB/s per connection, "
+                      f"RTT = {self._rtt}s, next unit = {self.unit}.")
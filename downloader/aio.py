@@ -0,0 +1,262 @@
+import asyncio
+import itertools
+import logging
+import os
+import time
+from typing import List, Optional
+
+import aiohttp
+import requests
+
+from .downloader import name_handler, _prepare, _open_checklist, _check, _slice_tasks, _save_failed, \
+    _open_output, _slice_writer, _start_metrics, _open_mirrors, _save_digests, _discard_progress, if_range, \
+    _unchanged, _whole_body, _status_code, _host_health, CHANGED, REJECTED, ResourceChanged
+from .buffers import BufferPool
+from .digest import BlockDigests, digest_file
+from .limiter import TokenBucket
+from .metrics import Metrics
+from .output import FragmentWriter
+from .retry import CircuitBreaker, backoff_delay
+from .rangespec import DParts, BlockInterpreter, RangeSlicer
+from .static import MEMORY_BUDGET, AIO_CONNECTIONS, AIO_CONNECTIONS_PER_HOST, AIO_KEEPALIVE
+
+
+async def _adownload(
+        url: str,
+        name: str,
+        s: aiohttp.ClientSession,
+        headers: dict = None,
+        data=None,
+        writer=None,
+        pool: BufferPool = None,
+        metrics: Metrics = None,
+        limiter: TokenBucket = None
+):
+    # Timeout = UNIT bytes // 5 kbps * 1024 bytes + 1
+    loop = asyncio.get_running_loop()
+    writer = writer or FragmentWriter(name)
+    # The caller holds a slot, there are no more slots than pooled buffers, acquire() never blocks the loop.
+    buffer = pool.acquire()
+    code, ttfb = 0, None
+    sent = time.monotonic()
+    try:
+        async with s.get(url, headers=headers, data=data, ssl=False,
+                         timeout=aiohttp.ClientTimeout(total=1229)) as resp:
+            if resp.status not in (200, 206):
+                # An error page must not end up as a fragment.
+                logging.info(f"Unexpected status {resp.status} when downloading file, url = {url}, name = {name}.")
+                code = _status_code(resp.status)
+            elif resp.status == 200 and headers and "Range" in headers and \
+                    not _whole_body(headers["Range"], resp.headers.get("Content-Length")):
+                # The whole file can't be written where the range should be. The only slice of the file may take it.
+                if "If-Range" in headers:
+                    # The validator didn't match.
+                    logging.warning(f"Resource changed since {headers['If-Range']}, url = {url}, name = {name}.")
+                    code = CHANGED
+                else:
+                    logging.info(f"Range ignored by the server, url = {url}, name = {name}.")
+                    code = 4
+            else:
+                view = memoryview(buffer)
+                filled = 0
+                async for chunk in resp.content.iter_any():
+                    if ttfb is None:
+                        ttfb = time.monotonic() - sent
+                    # Audit - bytes
+                    metrics.add(len(chunk))
+                    if limiter:
+                        await limiter.aconsume(len(chunk))
+
+                    # aiohttp cannot readinto, chunks are copied into the pooled buffer instead of piling up.
+                    chunk = memoryview(chunk)
+                    while chunk:
+                        n = min(len(chunk), len(view) - filled)
+                        view[filled:filled + n] = chunk[:n]
+                        filled += n
+                        chunk = chunk[n:]
+                        if filled == len(view):
+                            # Keep the event loop free while the buffer hits the disk.
+                            await loop.run_in_executor(None, writer.write, view)
+                            filled = 0
+
+                if filled:
+                    await loop.run_in_executor(None, writer.write, view[:filled])
+                await loop.run_in_executor(None, writer.commit)
+
+    except asyncio.TimeoutError:
+        logging.info(f"Timeout when downloading file, url = {url}, name = {name}.")
+        code = 1
+    except IOError as ie:
+        logging.info(f"IOError when saving buffered content, url = {url}, name = {name}.", exc_info=ie)
+        code = 2
+    except Exception as be:
+        logging.info(f"Unhandled exception occurred, exception = {be}, url = {url}, name = {name}.", exc_info=be)
+        code = 3
+    finally:
+        writer.close()
+        pool.release(buffer)
+
+    metrics.finish(code, time.monotonic() - sent, ttfb)
+    return code
+
+
+async def _download_async(
+        url: str, path=None, name=None,
+        headers=None, data=None, retry_timeout=3600,
+        dparts: Optional[DParts] = None, block_index: Optional[BlockInterpreter] = None,
+        connections: int = AIO_CONNECTIONS, connections_per_host: int = AIO_CONNECTIONS_PER_HOST,
+        direct: bool = False, memory_budget: int = MEMORY_BUDGET,
+        metrics_file: Optional[str] = None, metrics_port: Optional[int] = None,
+        mirrors: Optional[List[str]] = None, limiter: Optional[TokenBucket] = None, mmap: bool = False,
+        breaker: Optional[CircuitBreaker] = None
+):
+    pool = BufferPool(budget=memory_budget)
+    breaker = breaker or CircuitBreaker(connections_per_host)
+
+    # HEAD and meta are one-off, the blocking session is good enough for them.
+    with requests.session() as _s:
+        slices, path, raw_name, content_length, validators, cached, ranged = _prepare(
+            url, path, name, _s, dparts, direct, mirrors
+        )
+        mirror_set = _open_mirrors(url, _s, mirrors, content_length, validators, ranged)
+    # Like windowed_map does for the threads, a slice becomes a task only once a slot is free. There are no
+    # more slots than connections to be had, a slice holding one picks its mirror when it can be sent at once.
+    slots = asyncio.Semaphore(min(pool.capacity, connections, connections_per_host * len(mirror_set)))
+    headers = {**(headers or {})}
+    changed = validated = False
+    checklist, journal = _open_checklist(path, raw_name)
+    digests = BlockDigests(digest_file(path))
+    output = _open_output(path, name, url, content_length, direct, mmap)
+    metrics = _start_metrics(raw_name, content_length, journal, metrics_file, metrics_port)
+    total = len(slices)
+    retries = []
+    failed = []
+
+    connector = aiohttp.TCPConnector(
+        limit=connections, limit_per_host=connections_per_host,
+        keepalive_timeout=AIO_KEEPALIVE, ssl=False
+    )
+    async with aiohttp.ClientSession(connector=connector) as s:
+        async def _adownload_mirrored(_name, _headers, _data):
+            # Called with a slot held. limit_per_host applies to every mirror on its own,
+            # so mirrors add up their connections, the breaker gates each host like the threaded engine.
+            mirror = mirror_set.pick()
+            # Conditional on the validators of the mirror, a changed resource answers with its whole new body.
+            _headers = {**_headers, **if_range(mirror.validators)}
+            code = 3
+            st = time.monotonic()
+            await breaker.aacquire(mirror.host)
+            try:
+                code = await _adownload(mirror.url, _name, s, _headers, _data,
+                                        writer=_slice_writer(output, _headers["Range"], _name, digests),
+                                        pool=pool, metrics=metrics, limiter=limiter)
+            finally:
+                breaker.release(mirror.host, _host_health(code))
+                low, high = RangeSlicer.parse_range(_headers["Range"])
+                mirror_set.done(mirror, code == 0, high - low + 1, time.monotonic() - st)
+            if code == REJECTED and len(mirror_set) > 1:
+                # Another mirror may still serve what this one refuses.
+                code = 4
+            return code
+
+        async def _fetch(epoch, low, high, range_info):
+            nonlocal changed, validated
+            if changed:
+                return
+            _headers = {**headers, **range_info}
+            _name = name_handler(path=path, name=name, range_info=range_info, url=url)
+            logging.info(f"[AioDownload][{epoch}/{total}] "
+                         f"Starting with url = {url}, name = {_name},"
+                         f" overwrite = {os.path.exists(_name)}, headers = {_headers}, "
+                         f"save to {raw_name}")
+            st = time.time()
+            code = await _adownload_mirrored(_name, _headers, data)
+            duration = time.time() - st
+            logging.info(
+                f"[AioDownload][{epoch}/{total}] "
+                f"Ended with code = {code}, used {duration} secs @ {(high - low) / 1024 / duration:.2f}KB/s."
+            )
+
+            # The event loop is single threaded, the checklist is never written concurrently.
+            if code == 0:
+                _check(journal, range_info["Range"])
+                validated = True
+            elif code == CHANGED:
+                changed = True
+            elif code == REJECTED:
+                logging.warning(f"[AioDownload][{epoch}/{total}] {range_info['Range']} refused by the server, "
+                                f"given up.")
+                failed.append((url, _name, _headers, data))
+            else:
+                retries.append(asyncio.create_task(_retry((url, _name, _headers, data))))
+
+        async def _retry(item):
+            # Retried with backoff alongside the remaining slices, until retry_timeout after the first failure.
+            nonlocal changed, validated
+            _url, _name, _headers, _data = item
+            deadline = time.monotonic() + retry_timeout
+            for attempt in itertools.count():
+                await asyncio.sleep(backoff_delay(attempt))
+                if changed:
+                    return
+                async with slots:
+                    code = await _adownload_mirrored(_name, _headers, _data)
+                if code == 0:
+                    _check(journal, _headers["Range"])
+                    validated = True
+                    return
+                if code == CHANGED:
+                    changed = True
+                    return
+                if code == REJECTED or time.monotonic() >= deadline:
+                    logging.warning(f"[AioDownload] [Retry] Giving up {_headers['Range']} after {attempt + 1} retries.")
+                    failed.append(item)
+                    return
+
+        # The connector caps the opened connections, slices wait there for a free keep-alive one.
+        logging.info(f"[AioDownload] Scheduling slices over {connections} connections, "
+                     f"{connections_per_host} per host.")
+        running = set()
+
+        def _finished(fetching: asyncio.Task):
+            # The slot is given back however the slice ended.
+            running.discard(fetching)
+            slots.release()
+
+        for task in _slice_tasks(slices, checklist, block_index):
+            await slots.acquire()
+            if changed:
+                slots.release()
+                break
+            running.add(fetching := asyncio.create_task(_fetch(*task)))
+            fetching.add_done_callback(_finished)
+        await asyncio.gather(*running)
+
+        await asyncio.gather(*retries)
+
+    if cached and not (validated or changed):
+        # Complete from an earlier run on a cached HEAD, not a single request was sent.
+        with requests.session() as _s:
+            changed = not _unchanged(url, _s, content_length, validators)
+
+    if output:
+        output.close()
+    if changed:
+        _discard_progress(path, raw_name, journal, digests)
+    journal.close()
+    metrics.stop()
+    _save_digests(path, content_length, digests, failed)
+    _save_failed(path, raw_name, failed)
+    if changed:
+        raise ResourceChanged(f"{url} changed while being downloaded, progress discarded, start again.")
+    return checklist, failed
+
+
+def download_async(url: str, **kwargs):
+    """
+    Asyncio alternative of downloader.download, taking the same keywords plus
+    connections and connections_per_host, which bound the shared keep-alive pool.
+    With mirrors, connections_per_host holds for each mirror. A CircuitBreaker may
+    be shared with the threaded engine, one allowing connections_per_host is made otherwise.
+    """
+    return asyncio.run(_download_async(url, **kwargs))
@@ -0,0 +1,140 @@
+import collections
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, Optional, Tuple
+
+from .buffers import BufferPool
+from .downloader import Transfer, ResourceChanged, CHANGED, REJECTED
+from .limiter import TokenBucket
+from .metrics import Metrics
+from .retry import CircuitBreaker, RetryScheduler
+from .static import WORKERS, MEMORY_BUDGET, BATCH_OPEN_FILES, BATCH_PER_HOST, BATCH_OPENERS
+from .threaded import windowed_map
+from .trace import Tracer
+
+
+def read_manifest(fn: str) -> Iterator[Tuple[str, Optional[str]]]:
+    # One url per line, optionally followed by the file name. Blank lines and # comments are skipped.
+    with open(fn, "r") as fp:
+        for line in fp:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            url, *rest = line.split(maxsplit=1)
+            yield url, rest[0] if rest else None
+
+
+def _folders(base: str, entries: Iterator[Tuple[str, Optional[str]]]):
+    # Every file gets its own folder, as the meta file is per folder.
+    used = collections.Counter()
+    for url, name in entries:
+        stem = (name or url.rsplit("/", maxsplit=1)[-1]).split(".")[0] or "index"
+        used[stem] += 1
+        folder = os.path.join(base, stem if used[stem] == 1 else f"{stem}-{used[stem]}")
+        yield url, name, folder
+
+
+def download_manifest(
+        manifest: str, path=None, headers=None, data=None, retry_timeout=3600,
+        workers: int = WORKERS, per_host: int = BATCH_PER_HOST, open_files: int = BATCH_OPEN_FILES,
+        direct: bool = False, mmap: bool = False, memory_budget: int = MEMORY_BUDGET,
+        metrics_file: Optional[str] = None, metrics_port: Optional[int] = None,
+        limiter: Optional[TokenBucket] = None, tracer: Optional[Tracer] = None
+) -> Dict[str, Optional[list]]:
+    """
+    Download every url of a manifest in this process.
+    `workers` threads fetch the slices of up to `open_files` files at once, taken
+    round robin, so small files go in between the slices of big ones. Each worker
+    keeps its keep-alive connections across files, no host gets more than `per_host`
+    of them. Failed slices of every file are retried by one scheduler of `workers`
+    threads. HEAD requests of the next files are sent ahead by BATCH_OPENERS threads.
+    :return: the urls which didn't complete, with their failed slices, or None when
+    the file couldn't be prepared at all or changed on the server meanwhile.
+    """
+    base = path or os.getcwd()
+    pool = BufferPool(budget=memory_budget)
+    breaker = CircuitBreaker(per_host)
+    retries = RetryScheduler(workers=workers, retry_timeout=retry_timeout, fatal=(CHANGED, REJECTED))
+    metrics = Metrics(job="batch").start(textfile=metrics_file, port=metrics_port)
+    failed: Dict[str, Optional[list]] = {}
+    inflight = collections.Counter()
+    exhausted = set()
+    opened = files = 0
+
+    def _open(url, name, folder):
+        os.makedirs(folder, exist_ok=True)
+        try:
+            return Transfer(
+                url, path=folder, name=name, headers=headers, data=data, retry_timeout=retry_timeout,
+                workers=workers, direct=direct, mmap=mmap, pool=pool, breaker=breaker, limiter=limiter, metrics=metrics,
+                tracer=tracer, retry=retries
+            )
+        except Exception as be:  # noqa
+            logging.warning(f"[Batch] Can't prepare {url}, skipped.", exc_info=be)
+            return None
+
+    def _fetch(transfer: Transfer, task):
+        return transfer.fetch(*task)
+
+    def _finish(transfer: Transfer):
+        # Retries may still be pending, they are waited for off the main stream.
+        exhausted.discard(transfer)
+        del inflight[transfer]
+        finisher.submit(_close, transfer)
+
+    def _close(transfer: Transfer):
+        try:
+            _, totally_failed = transfer.close()
+        except ResourceChanged as rc:
+            logging.warning(f"[Batch] {rc}")
+            failed[transfer.url] = None
+            return
+        if totally_failed:
+            failed[transfer.url] = totally_failed
+        logging.info(f"[Batch] {transfer.raw_name} finished, {len(totally_failed)} slices failed.")
+
+    def _tasks(transfers):
+        nonlocal opened, files
+        active = collections.deque()
+        while True:
+            # Keep open_files transfers open, the HEADs of the next ones are already on their way.
+            while len(active) < open_files:
+                item = next(transfers, None)
+                if item is None:
+                    break
+                (url, _, _), transfer = item
+                files += 1
+                if transfer is None:
+                    failed[url] = None
+                    continue
+                opened += 1
+                metrics.total_bytes += transfer.content_length - transfer.journal.completed.size
+                active.append((transfer, transfer.tasks()))
+            if not active:
+                return
+
+            transfer, tasks = active.popleft()
+            task = next(tasks, None)
+            if task is None:
+                exhausted.add(transfer)
+                if not inflight[transfer]:
+                    _finish(transfer)
+                continue
+            inflight[transfer] += 1
+            yield transfer, task
+            active.append((transfer, tasks))
+
+    logging.info(f"[Batch] Downloading {manifest} with {workers} workers, {per_host} per host.")
+    with ThreadPoolExecutor(max_workers=open_files, thread_name_prefix="finisher") as finisher:
+        transfers = windowed_map(_open, _folders(base, read_manifest(manifest)), BATCH_OPENERS)
+        for (transfer, task), result in windowed_map(_fetch, _tasks(transfers), workers):
+            transfer.done(task[0], *result)
+            inflight[transfer] -= 1
+            if transfer in exhausted and not inflight[transfer]:
+                _finish(transfer)
+
+    retries.join()
+    metrics.stop()
+    logging.info(f"[Batch] {files} files, {opened} downloaded, {len(failed)} incomplete.")
+    return failed
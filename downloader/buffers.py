@@ -0,0 +1,35 @@
+import threading
+
+from .rangespec import UNIT
+from .static import MEMORY_BUDGET
+
+
+class BufferPool:
+    """
+    Preallocated bytearrays recycled across slices. The number of buffers is
+    bounded by budget // buffer_size, acquire() blocks when all of them are in
+    use, which throttles new slices instead of growing the memory.
+    """
+
+    # Ranges are inclusive on both ends, the first slice carries UNIT + 1 bytes.
+    def __init__(self, buffer_size: int = UNIT + 1, budget: int = MEMORY_BUDGET):
+        self.buffer_size = buffer_size
+        self.capacity = max(1, budget // buffer_size)
+        self._free = []
+        self._created = 0
+        self._cond = threading.Condition()
+
+    def acquire(self) -> bytearray:
+        with self._cond:
+            while not self._free and self._created >= self.capacity:
+                self._cond.wait()
+            if self._free:
+                return self._free.pop()
+            # Allocated lazily, a short download never pays for the whole budget.
+            self._created += 1
+        return bytearray(self.buffer_size)
+
+    def release(self, buffer: bytearray):
+        with self._cond:
+            self._free.append(buffer)
+            self._cond.notify()
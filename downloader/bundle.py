@@ -0,0 +1,211 @@
+import collections
+import logging
+import os
+import pathlib
+import struct
+import tarfile
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Deque, Iterable, Iterator, Optional, Tuple
+
+from .static import BUNDLE_BLOCK, BUNDLE_GZIP, BUNDLE_ZSTD, BUNDLE_GZIP_LEVEL, BUNDLE_ZSTD_LEVEL
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+# Every gzip member tells its own size in a "DP" extra subfield, as BGZF does, so that a reader
+# can hop from member to member and inflate them in parallel. Any gzip reader skips the field.
+# Magic, method, flags (FEXTRA), mtime, extra flags, OS, extra length, subfield id and length, member size.
+MEMBER_HEADER = struct.Struct("<2sBBIBBH2sHI")
+# CRC-32 and size of the uncompressed block.
+MEMBER_TRAILER = struct.Struct("<II")
+_SUBFIELD = b"DP"
+
+
+def _gzip_member(block: bytes, level: int = BUNDLE_GZIP_LEVEL) -> bytes:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = compressor.compress(block) + compressor.flush()
+    size = MEMBER_HEADER.size + len(body) + MEMBER_TRAILER.size
+    header = MEMBER_HEADER.pack(GZIP_MAGIC, zlib.DEFLATED, 4, 0, 0, 255, 8, _SUBFIELD, 4, size)
+    return header + body + MEMBER_TRAILER.pack(zlib.crc32(block), len(block) & 0xFFFFFFFF)
+
+
+def _gunzip_member(member: bytes) -> bytes:
+    # wbits = 31 reads the gzip header and checks the CRC.
+    return zlib.decompress(member, 31)
+
+
+def _compressor(compression: str) -> Callable[[bytes], bytes]:
+    if compression == BUNDLE_GZIP:
+        return _gzip_member
+    if compression == BUNDLE_ZSTD:
+        # Optional, only the zstd bundles need it.
+        import zstandard
+
+        # Compressors aren't thread safe, every block gets its own, each block is a frame of its own.
+        return lambda block: zstandard.ZstdCompressor(level=BUNDLE_ZSTD_LEVEL).compress(block)
+    raise ValueError(f"Unknown bundle compression {compression!r}.")
+
+
+class _BlockWriter:
+    """File object tarfile streams into, full blocks are compressed by the pool and written in order."""
+
+    def __init__(self, fp, compress: Callable[[bytes], bytes], executor: ThreadPoolExecutor, window: int):
+        self._fp = fp
+        self._compress = compress
+        self._executor = executor
+        self._window = window
+        self._buffer = bytearray()
+        self._pending: Deque[Future] = collections.deque()
+        self.raw = 0
+        self.written = 0
+
+    def write(self, data) -> int:
+        self._buffer += data
+        self.raw += len(data)
+        while len(self._buffer) >= BUNDLE_BLOCK:
+            self._submit(bytes(self._buffer[:BUNDLE_BLOCK]))
+            del self._buffer[:BUNDLE_BLOCK]
+        return len(data)
+
+    def _submit(self, block: bytes):
+        self._pending.append(self._executor.submit(self._compress, block))
+        # At most `window` blocks are held, compressed or not.
+        while len(self._pending) > self._window:
+            self._drain()
+
+    def _drain(self):
+        out = self._pending.popleft().result()
+        self._fp.write(out)
+        self.written += len(out)
+
+    def close(self):
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer.clear()
+        while self._pending:
+            self._drain()
+
+
+class _BlockReader:
+    """File object tarfile reads from, blocks are decompressed by the pool ahead of it, in order."""
+
+    def __init__(self, blocks: Iterator[bytes], decompress: Callable[[bytes], bytes],
+                 executor: ThreadPoolExecutor, window: int):
+        self._blocks = blocks
+        self._decompress = decompress
+        self._executor = executor
+        self._window = window
+        self._pending: Deque[Future] = collections.deque()
+        self._current = memoryview(b"")
+
+    def _next(self) -> bool:
+        for block in self._blocks:
+            self._pending.append(self._executor.submit(self._decompress, block))
+            if len(self._pending) >= self._window:
+                break
+        if not self._pending:
+            return False
+        self._current = memoryview(self._pending.popleft().result())
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        chunks = []
+        while size != 0:
+            if not self._current and not self._next():
+                break
+            take = self._current[:size] if size > 0 else self._current
+            chunks.append(take)
+            self._current = self._current[len(take):]
+            if size > 0:
+                size -= len(take)
+        return b"".join(chunks)
+
+
+def _members(fp) -> Iterator[bytes]:
+    # Gzip members of a bundle, raw, as told by their "DP" subfields.
+    while header := fp.read(MEMBER_HEADER.size):
+        *_, size = MEMBER_HEADER.unpack(header)
+        yield header + fp.read(size - MEMBER_HEADER.size)
+
+
+def _indexed(fn) -> bool:
+    # Written by bundle(), with the sizes of the members, rather than by another gzip.
+    with open(fn, "rb") as fp:
+        header = fp.read(MEMBER_HEADER.size)
+    if len(header) < MEMBER_HEADER.size:
+        return False
+    magic, method, flags, _, _, _, xlen, subfield, slen, _ = MEMBER_HEADER.unpack(header)
+    return magic == GZIP_MAGIC and bool(flags & 4) and xlen == 8 and subfield == _SUBFIELD and slen == 4
+
+
+def bundle(fn, members: Iterable[Tuple[str, str]], compression: str = BUNDLE_GZIP, jobs: Optional[int] = None) -> int:
+    """
+    Stream files into a tar archive compressed on the fly, BUNDLE_BLOCK bytes of
+    tar at a time. Blocks are compressed in parallel and written in order, as
+    gzip members (pigz-like, readable by tar -xzf) or zstd frames.
+    :param members: (path, name in the archive) of every file, read where they are.
+    :param compression: BUNDLE_GZIP, or BUNDLE_ZSTD which requires zstandard.
+    :param jobs: blocks compressed at once, one per CPU by default.
+    :return: size of the bundle.
+    """
+    compress = _compressor(compression)
+    jobs = jobs or os.cpu_count() or 1
+    tmp = f"{fn}.tmp"
+    try:
+        with open(tmp, "wb") as fp, ThreadPoolExecutor(jobs, thread_name_prefix="bundle") as executor:
+            writer = _BlockWriter(fp, compress, executor, 2 * jobs)
+            with tarfile.open(fileobj=writer, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+                for path, name in members:
+                    tar.add(path, arcname=name, recursive=False)
+                    logging.info(f"[Bundle] Added {name}, {os.path.getsize(path)} bytes.")
+            writer.close()
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    os.replace(tmp, fn)
+    logging.info(f"[Bundle] {fn} written with {compression} by {jobs} jobs, "
+                 f"{writer.raw} bytes of tar compressed to {writer.written}.")
+    return writer.written
+
+
+def _extract_member(tar: tarfile.TarFile, member: tarfile.TarInfo, to: str):
+    if hasattr(tarfile, "data_filter"):
+        tar.extract(member, to, filter="data")
+        return
+    # The data filter isn't there before Python 3.11.4, the bundle comes from another machine anyway.
+    name = pathlib.PurePosixPath(member.name)
+    if name.is_absolute() or ".." in name.parts or not (member.isfile() or member.isdir()):
+        raise tarfile.ExtractError(f"Refusing to extract {member.name!r}.")
+    tar.extract(member, to)
+
+
+def extract(fn, to, jobs: Optional[int] = None) -> int:
+    """
+    Extract a bundle into the folder `to`, members that would land outside of it are refused.
+    Bundles written by bundle() with gzip are inflated in parallel, member by member,
+    zstd ones and those of other gzip writers are read as one stream.
+    :return: number of files extracted.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    with open(fn, "rb") as fp:
+        magic = fp.read(len(ZSTD_MAGIC))
+
+    with open(fn, "rb") as fp, ThreadPoolExecutor(jobs, thread_name_prefix="unbundle") as executor:
+        if magic == ZSTD_MAGIC:
+            import zstandard
+            stream = zstandard.ZstdDecompressor().stream_reader(fp, read_across_frames=True)
+        elif _indexed(fn):
+            stream = _BlockReader(_members(fp), _gunzip_member, executor, 2 * jobs)
+        else:
+            stream = None
+
+        count = 0
+        with tarfile.open(fn, mode="r|gz") if stream is None else tarfile.open(fileobj=stream, mode="r|") as tar:
+            for member in tar:
+                _extract_member(tar, member, str(to))
+                count += member.isfile()
+                logging.info(f"[Bundle] Extracted {member.name}, {member.size} bytes.")
+    logging.info(f"[Bundle] {count} files extracted from {fn} into {to}.")
+    return count
+
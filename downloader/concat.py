@@ -1,39 +1,42 @@
 import logging
 import os
 import pathlib
-import pickle
 import shutil
 import sys
 import threading
 from typing import List, Tuple
 
-import tqdm
-
-from .static import DEFAULT_PARTS_LIST_FILE_NAME, DEFAULT_DISTRIBUTED_DOWNLOADED_TARFILE, Meta
-from .rangespec import UNIT, DParts
+from .static import DEFAULT_PARTS_LIST_FILE_NAME, DEFAULT_DISTRIBUTED_DOWNLOADED_TARFILE, Meta, \
+    DEFAULT_DISTRIBUTED_DOWNLOADED_ZSTFILE, CONCAT_JOBS, FSYNC_NONE, FSYNC_END, FSYNC_FRAGMENT, BUNDLE_GZIP, BUNDLE_ZSTD
+from .digest import BlockDigests, digest_file, file_digest, merkle_root
+from .fastcopy import FileCopier
+from .fragments import Fragment, refresh_index, scan_fragments
+from .intervals import IntervalSet, parse_interval
+from .partsfile import PartsFile, UnsupportedPartsFile, save_parts
 
 _LOCAL = threading.local()
 
 
 def precheck_missing_block(
         path: pathlib.Path,
-        files: List[pathlib.Path]
+        files: List[Fragment]
 ) -> Tuple[int, List[pathlib.Path], List[str]]:
     # Currently consider the last block as healthy.
 
     missing_size = 0
     missing_blocks = []
-    cursor_seq = []
-    for file in files[0: -1]:
+    fragments = IntervalSet()
+    for file in files:
         # Missing handler for non-existent fragments
         # Despite the size, we always keep the filename.
-        slash_format_string = file.name.split("@bytes=")[-1]
-        cursor_seq.extend(map(int, slash_format_string.split('-')))
+        fragments.add(file.low, file.high)
+        if file is files[-1]:
+            continue
 
-        size = os.path.getsize(file)
-        if size != UNIT:
-            missing_blocks.append(file)
-            missing_size += UNIT
+        # Slices aren't all UNIT long anymore, the name tells the expected size (both ends inclusive).
+        if file.size != file.high - file.low + 1:
+            missing_blocks.append(pathlib.Path(file.path))
+            missing_size += file.high - file.low + 1
 
     # Meta
     # Un-download parts
@@ -48,21 +51,8 @@ def precheck_missing_block(
                               f"maybe you could try with --without_meta. Excption = {str(fnfe)}")
             exit(-1)
     else:
-        cursor_seq.sort()
-        un_download = []
-        if cursor_seq[-1] != meta.content_length:
-            un_download.append(f"{cursor_seq[-1]}-{meta.content_length}")
-        if cursor_seq[0] != 0:
-            missing_blocks.append(f"{0}-{cursor_seq[0]}")
-
-        last_value = None
-        for idx in range(0, len(cursor_seq) - 1, 2):
-            if last_value is None:
-                last_value = cursor_seq[idx + 1]
-                continue
-            if last_value + 1 != cursor_seq[idx]:
-                un_download.append(f"{last_value + 1}-{cursor_seq[idx] - 1}")
-            last_value = cursor_seq[idx + 1]
+        # Bytes no fragment holds, the last slice ends at content_length.
+        un_download = [f"{low}-{high}" for low, high in fragments.gaps(0, meta.content_length)]
 
     return missing_size, missing_blocks, un_download
 
@@ -101,14 +91,30 @@ def missing_handler_existed(total: List[pathlib.Path], missing: List[pathlib.Pat
     if ud:
         missing_bytes_range.extend(ud)
 
-    # Save the targets as a pickle file.
-    with open(temp_dir_path / (_f_name + DEFAULT_PARTS_LIST_FILE_NAME), "wb") as mpf:
-        pickle.dump(missing_bytes_range, mpf)
+    # Save the targets as a parts file, stamped with the resource they belong to when the meta is there.
+    try:
+        meta = Meta.load(_f)
+    except FileNotFoundError:
+        meta = Meta()
+    save_parts(
+        temp_dir_path / (_f_name + DEFAULT_PARTS_LIST_FILE_NAME), map(parse_interval, missing_bytes_range),
+        meta.content_length, meta.etag, meta.unit
+    )
 
-    fn = _f_name + DEFAULT_DISTRIBUTED_DOWNLOADED_TARFILE
-    tarball_cmd = f"tar -zcvf {fn} {str(temp_dir_path.absolute())}"
-    logging.info(f"[MissingHandler] Archiving fragments using cmd: {tarball_cmd!r}")
-    os.system(tarball_cmd)
+    # Bundled beside the fragments, under the name of the temp dir, for another node to download the rest.
+    compression = getattr(_LOCAL, "bundle", None) or BUNDLE_GZIP
+    if compression == BUNDLE_ZSTD:
+        fn = _f / (_f_name + DEFAULT_DISTRIBUTED_DOWNLOADED_ZSTFILE)
+    else:
+        fn = _f / (_f_name + DEFAULT_DISTRIBUTED_DOWNLOADED_TARFILE)
+    members = [(str(f), f"{temp_dir_path.name}/{f.name}") for f in sorted(temp_dir_path.iterdir())]
+    logging.info(f"[MissingHandler] Archiving {len(members)} files into {str(fn)!r}.")
+    from .bundle import bundle
+    try:
+        bundle(fn, members, compression)
+    except Exception as be:  # noqa
+        logging.exception(f"[MissingHandler] Can't archive the fragments into {str(fn)!r}.", exc_info=be)
+        exit(1)
 
 
 def concat(path, **kwargs):
@@ -119,8 +125,15 @@ def concat(path, **kwargs):
     if not os.path.isdir(path):
         raise FileNotFoundError(path)
     p = pathlib.Path(path)
-    files = [file for file in p.glob("*.*") if "@bytes" in file.name]
-    if files.__len__() <= 0:
+    if kwargs.get("unbundle"):
+        from .bundle import extract
+        extract(kwargs["unbundle"], p)
+        exit(0)
+    if kwargs.get("convert"):
+        convert_parts(p)
+        exit(0)
+    scanned = scan_fragments(p, use_index=not kwargs.get("no_index"))
+    if scanned.__len__() <= 0:
         logging.info(f"Noting to do with path : {path!r}")
         return
 
@@ -128,8 +141,6 @@ def concat(path, **kwargs):
         # d = DParts(path)
         # parts = d.as_list()
         # ms, mbs, ud = precheck_missing_block(path, files)
-        files.sort(key=lambda x: int(str(x.name).rsplit("-", maxsplit=1)[-1]))
-        #
         try:
             meta = Meta.load(path)
             length = meta.content_length
@@ -137,58 +148,183 @@ def concat(path, **kwargs):
             logging.exception(f"Broken, you cannot use this function without meta.")
             exit(-1)
 
-        slices = []
-        for file in files:
-            a, b = file.name.rsplit("@bytes=", maxsplit=1)[-1].split("-")
-            slices.append(int(a))
-            slices.append(int(b))
+        fragments = IntervalSet()
+        for low, high in ((f.low, f.high) for f in scanned):
+            if fragments.intersects(low, high):
+                logging.warning(f"\033[33m[F] Two pieces have the same byte.\033[0m {low}-{high}")
+            fragments.add(low, high)
+            logging.info(f"\033[34m[Y]\033[0m  PART {low}-{high}")
 
         un_download = []
-        if slices[0] != 0:
-            un_download.append(f"{0}-{slices[0]}")
-            logging.info(f"\033[31m[N]\033[0m  PART {0}-{slices[0]}")
-        last_value = -2
-        for idx in range(0, len(slices) - 1, 2):
-            # if last_value is None:
-            #     last_value = slices[idx + 1]
-            #     continue
-            if last_value + 1 != slices[idx] and last_value != -2:
-                if last_value == slices[idx]:
-                    logging.warning(f"\033[33m[F] Two pieces have the same byte.\033[0m {last_value}-{slices[idx]}")
-                    continue
-                un_download.append(f"{last_value + 1}-{slices[idx] - 1}")
-                logging.info(f"\033[31m[N]\033[0m  PART {last_value + 1}-{slices[idx] - 1}")
-            last_value = slices[idx + 1]
-            logging.info(f"\033[34m[Y]\033[0m  PART {slices[idx]}-{slices[idx + 1]}")
-
-        if slices[-1] != length:
-            un_download.append(f"{slices[-1]}-{meta.content_length}")
-
-        _f_name = files[0].name.rsplit('@', maxsplit=1)[0]
-        with open(p / (_f_name + DEFAULT_PARTS_LIST_FILE_NAME), "wb") as mpf:
-            pickle.dump(un_download, mpf)
+        for low, high in fragments.gaps(0, length):
+            un_download.append(f"{low}-{high}")
+            logging.info(f"\033[31m[N]\033[0m  PART {low}-{high}")
+
+        _f_name = scanned[0].name.rsplit('@', maxsplit=1)[0]
+        save_parts(
+            p / (_f_name + DEFAULT_PARTS_LIST_FILE_NAME), fragments.gaps(0, length), length, meta.etag, meta.unit
+        )
+        refresh_index(p, scanned)
         logging.info("DPart file saved.")
         exit(0)
 
+    # @bytes=119537665-125829120, sorted by the high end.
     if not kwargs.get("force"):
-        ms, mbs, ud = precheck_missing_block(path, files)
+        ms, mbs, ud = precheck_missing_block(path, scanned)
         if ms > 0 or len(ud) > 0:
             if ms > 0:
                 logging.warning(f"Currently we found {ms} bytes of missing, collecting peaceful ones.")
             if len(ud) > 0:
                 logging.warning(f"Plus we found {len(ud)} parts of un-downloaded file. UD = {ud}")
-            missing_handler_existed(files, mbs, ud)
+            missing_handler_existed([pathlib.Path(f.path) for f in scanned], mbs, ud)
             logging.info(f"Successfully created dparts info, exiting.")
             exit(1)
 
-    # @bytes=119537665-125829120
-    files.sort(key=lambda x: int(str(x.name).rsplit("-", maxsplit=1)[-1]))
-    real_name = files[0].name.rsplit("@", maxsplit=1)[0]
+    digests = None if kwargs.get("force") else open_digests(p)
+    real_name = scanned[0].name.rsplit("@", maxsplit=1)[0]
     final_path = p / real_name
-    with open(final_path, "wb") as fp:
-        for file in tqdm.tqdm(files):
-            with open(file, "rb") as _tf:
-                fp.write(_tf.read())
+    corrupted, leaves = place_fragments(
+        p, scanned, final_path, digests, jobs=kwargs.get("jobs") or CONCAT_JOBS,
+        fsync=kwargs.get("fsync") or FSYNC_NONE, verify=bool(kwargs.get("verify"))
+    )
+
+    if digests is not None:
+        verify_digests(path, final_path, scanned, corrupted, leaves, verify=bool(kwargs.get("verify")))
+
+
+def _place(copier: FileCopier, fragment: Fragment, fd: int, digests, fsync: str, verify: bool):
+    # One fragment copied at its offset: (low, size, copied, digest or None, corrupted).
+    file, low = fragment.path, fragment.low
+    digest, corrupted = None, False
+    if digests is not None and verify:
+        # Hashing has to read the fragment, which leaves it in the page cache for the copy.
+        size, digest = file_digest(file)
+        corrupted = digests.check(low, size, digest) is False
+        if corrupted:
+            logging.warning(f"[Concat] [Digest] Fragment {fragment.name} doesn't match its digest.")
+    with open(file, "rb") as _tf:
+        size = os.fstat(_tf.fileno()).st_size
+        if digests is not None and not verify and low in digests.blocks:
+            # Hashed when it was downloaded, a fragment of the recorded size is taken as is.
+            recorded, _ = digests.blocks[low]
+            corrupted = recorded != size
+            if corrupted:
+                logging.warning(f"[Concat] [Digest] Fragment {fragment.name} is {size} bytes, {recorded} recorded.")
+        copied = copier.copy(_tf.fileno(), fd, size, dst_offset=low)
+    if fsync == FSYNC_FRAGMENT:
+        os.fsync(fd)
+    return low, size, copied, digest, corrupted
+
+
+def place_fragments(path: pathlib.Path, files: List[Fragment], final_path: pathlib.Path, digests,
+                    jobs: int = CONCAT_JOBS, fsync: str = FSYNC_NONE, verify: bool = False):
+    """
+    Copy every fragment at the offset its name tells, into a preallocated file.
+    :param jobs: fragments copied at once, positioned writes let them land in any order.
+    :param fsync: FSYNC_NONE, FSYNC_END to sync the file once complete, or FSYNC_FRAGMENT after every fragment.
+    :param verify: hash every fragment again, otherwise only their sizes are checked against the digest records.
+    :return: the corrupted fragments and the digests of all, in the order of files, None unless verify.
+    """
+    # Only the copy shows a progress bar and needs a pool, -E and the checks above don't import them.
+    import tqdm
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    try:
+        expected = Meta.load(path).content_length
+    except FileNotFoundError:
+        expected = None
+    if expected is None:
+        expected = max(f.low + f.size for f in files)
+
+    # Fragments are copied by the kernel, they never go through Python's memory.
+    copier = FileCopier()
+    fd = os.open(final_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        try:
+            os.posix_fallocate(fd, 0, expected)
+        except (AttributeError, OSError):
+            # Not every platform nor filesystem can reserve the blocks, the size is set anyway.
+            os.ftruncate(fd, expected)
+        with ThreadPoolExecutor(max_workers=max(jobs, 1), thread_name_prefix="concat") as executor:
+            futures = [executor.submit(_place, copier, file, fd, digests, fsync, verify) for file in files]
+            for future in tqdm.tqdm(as_completed(futures), total=len(futures)):
+                future.result()
+        results = [future.result() for future in futures]
+
+        short = [file.name for file, (_, size, copied, _, _) in zip(files, results) if copied != size]
+        if short:
+            logging.error(f"[Concat] Fragments cut short while being copied: {short}.")
+            exit(1)
+        # The file is preallocated, its size alone tells nothing: every byte must have been written.
+        written = IntervalSet((low, low + copied - 1) for low, _, copied, _, _ in results)
+        actual = os.fstat(fd).st_size
+        if actual != expected or (expected and not written.covers(0, expected - 1)):
+            logging.error(f"[Concat] {final_path.name} is {actual} bytes, {written.size} written, {expected} expected.")
+            exit(1)
+        if fsync in (FSYNC_END, FSYNC_FRAGMENT):
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+    logging.info(f"[Concat] {len(files)} fragments placed into {final_path.name} by {jobs} jobs, {expected} bytes.")
+
+    leaves = [digest for _, _, _, digest, _ in results]
+    corrupted = [pathlib.Path(file.path) for file, (_, _, _, _, bad) in zip(files, results) if bad]
+    return corrupted, leaves
+
+
+def convert_parts(path: pathlib.Path):
+    # Pickled parts lists under path rewritten in the binary format, stamped from the meta beside them.
+    for fn in path.rglob(f"*{DEFAULT_PARTS_LIST_FILE_NAME}"):
+        try:
+            PartsFile(fn).close()
+            continue
+        except UnsupportedPartsFile as e:
+            logging.error(f"[Concat] Can't convert {str(fn)!r}, {e}")
+            continue
+        except ValueError:
+            pass
+        try:
+            meta = Meta.load(fn.parent)
+        except FileNotFoundError:
+            meta = Meta()
+        try:
+            PartsFile.convert(fn, meta.content_length or 0, meta.etag, meta.unit or 0).close()
+        except Exception as e:  # noqa
+            logging.error(f"[Concat] Can't convert {str(fn)!r}, {e}.")
+
+
+def open_digests(path: pathlib.Path):
+    fn = digest_file(path)
+    if not fn.exists():
+        logging.info("[Concat] [Digest] No block digests, fragments are not verified.")
+        return None
+    return BlockDigests(fn, readonly=True)
+
+
+def verify_digests(path, final_path: pathlib.Path, files: List[Fragment], corrupted: List[pathlib.Path], leaves,
+                   verify: bool = False):
+    if corrupted:
+        # Corrupted fragments go the way of the missing ones, to be downloaded again.
+        os.remove(final_path)
+        missing_handler_existed([pathlib.Path(f.path) for f in files], corrupted)
+        logging.info(f"[Concat] [Digest] {len(corrupted)} corrupted fragments, dparts info created, exiting.")
+        exit(1)
+    if not verify:
+        # The recorded digests would always make up the recorded root, only hashing the fragments tells.
+        logging.info("[Concat] [Digest] Only fragment sizes checked against their digests, Merkle root not checked, "
+                     "use --verify to hash the fragments.")
+        return
+    try:
+        expected = Meta.load(path).merkle_root
+    except FileNotFoundError:
+        expected = None
+    if expected is None:
+        logging.info("[Concat] [Digest] Fragments verified, no Merkle root saved to compare the whole file with.")
+    elif merkle_root(leaves).hex() != expected:
+        logging.error(f"[Concat] [Digest] Merkle root mismatch, expected {expected}, "
+                      f"fragments don't make up the downloaded file.")
+        exit(1)
+    else:
+        logging.info(f"[Concat] [Digest] Verified, Merkle root = {expected}.")
 
 
 if __name__ == '__main__':
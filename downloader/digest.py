@@ -0,0 +1,155 @@
+import hashlib
+import logging
+import os
+import pathlib
+import struct
+import threading
+from typing import Dict, Iterable, Optional, Tuple
+
+from .static import DEFAULT_DIGEST_FILE_NAME, COPY_CHUNK
+
+MAGIC = b"DDGS"
+VERSION = 1
+HEADER = struct.Struct("<4sH")
+# One committed block: offset, size and SHA-256 of its bytes.
+RECORD = struct.Struct("<qq32s")
+
+
+def digest_file(path) -> pathlib.Path:
+    # Beside the meta file.
+    if path and os.path.isdir(path):
+        return pathlib.Path(path) / DEFAULT_DIGEST_FILE_NAME
+    return pathlib.Path(".") / DEFAULT_DIGEST_FILE_NAME
+
+
+def merkle_root(leaves: Iterable[bytes]) -> bytes:
+    # Leaves in offset order, pairs hashed level by level, an odd node is carried up as is.
+    level = list(leaves)
+    if not level:
+        return hashlib.sha256(b"").digest()
+    while len(level) > 1:
+        carried = [level.pop()] if len(level) % 2 else []
+        level = [hashlib.sha256(level[i] + level[i + 1]).digest() for i in range(0, len(level), 2)] + carried
+    return level[0]
+
+
+def file_digest(fn, chunk_size: int = COPY_CHUNK) -> Tuple[int, bytes]:
+    # Size and SHA-256 of a file, read through one reused buffer.
+    digest, size = hashlib.sha256(), 0
+    buffer = memoryview(bytearray(chunk_size))
+    with open(fn, "rb", buffering=0) as fp:
+        while n := fp.readinto(buffer):
+            digest.update(buffer[:n])
+            size += n
+    return size, digest.digest()
+
+
+class HashingWriter:
+    """Wraps the writer of a slice, hashing every buffer on its way to the disk."""
+
+    def __init__(self, writer, low: int, digests: "BlockDigests"):
+        self._writer = writer
+        self._low = low
+        self._digests = digests
+        self._hash = hashlib.sha256()
+        self._size = 0
+
+    def write(self, chunk):
+        # hashlib releases the GIL on large buffers, workers hash in parallel.
+        self._hash.update(chunk)
+        self._size += len(chunk)
+        self._writer.write(chunk)
+
+    def commit(self):
+        self._writer.commit()
+        # Only a fully received slice gets its digest recorded.
+        self._digests.append(self._low, self._size, self._hash.digest())
+
+    def close(self):
+        self._writer.close()
+
+
+class BlockDigests:
+    """
+    Per-block SHA-256 digests of a download, computed while slices are written
+    and appended as they commit. The latest record of an offset wins, a torn
+    record left by a crash is dropped on load. close() rewrites the file sorted
+    and without duplicates.
+
+    The Merkle root over the blocks, in offset order, is saved in the meta file
+    once the download completes, concat() checks fragments against both.
+    """
+
+    def __init__(self, fn, readonly: bool = False):
+        self.fn = str(fn)
+        self.blocks: Dict[int, Tuple[int, bytes]] = {}
+        self._lock = threading.Lock()
+        self._load()
+        self._fp = None if readonly else open(self.fn, "ab")
+        if self._fp is not None and self._fp.tell() == 0:
+            self._fp.write(HEADER.pack(MAGIC, VERSION))
+
+    def _load(self):
+        if not os.path.exists(self.fn):
+            return
+        with open(self.fn, "rb") as fp:
+            content = fp.read()
+        if not content:
+            return
+        magic, version = HEADER.unpack_from(content)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"Unsupported digest file {self.fn!r}.")
+        body = memoryview(content)[HEADER.size:]
+        tail = len(body) % RECORD.size
+        if tail:
+            logging.warning(f"[Digest] Dropping a torn record of {tail} bytes from {self.fn!r}.")
+            body = body[:len(body) - tail]
+        for low, size, digest in RECORD.iter_unpack(body):
+            self.blocks[low] = size, digest
+
+    def writer(self, writer, low: int) -> HashingWriter:
+        return HashingWriter(writer, low, self)
+
+    def append(self, low: int, size: int, digest: bytes):
+        with self._lock:
+            self.blocks[low] = size, digest
+            self._fp.write(RECORD.pack(low, size, digest))
+            self._fp.flush()
+
+    def covers(self, content_length: int) -> bool:
+        cursor = 0
+        for low, (size, _) in sorted(self.blocks.items()):
+            if low > cursor:
+                return False
+            cursor = max(cursor, low + size)
+        return cursor >= content_length
+
+    def root(self) -> bytes:
+        return merkle_root(digest for _, (_, digest) in sorted(self.blocks.items()))
+
+    def verify(self, low: int, content) -> Optional[bool]:
+        # None when the block has no digest to check against.
+        if low not in self.blocks:
+            return None
+        return self.check(low, len(content), hashlib.sha256(content).digest())
+
+    def check(self, low: int, size: int, digest: bytes) -> Optional[bool]:
+        # Like verify(), with the size and digest of a block hashed elsewhere.
+        if low not in self.blocks:
+            return None
+        return self.blocks[low] == (size, digest)
+
+    def close(self):
+        with self._lock:
+            if self._fp is None:
+                return
+            self._fp.close()
+            self._fp = None
+            tmp = self.fn + ".tmp"
+            with open(tmp, "wb") as fp:
+                fp.write(HEADER.pack(MAGIC, VERSION))
+                for low, (size, digest) in sorted(self.blocks.items()):
+                    fp.write(RECORD.pack(low, size, digest))
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(tmp, self.fn)
@@ -1,47 +1,130 @@
-import io
+import glob
+import pathlib
 import pickle
 import time
 import logging
-from typing import Optional
+from typing import List, Optional
 
 import requests
 import os
-import queue
 
-from .rangespec import RangeSlicer, DParts, BlockInterpreter
-from .static import REPORT_FREQUENCY, NS, CHUNK_SIZE, SLICING, Meta
+from .rangespec import RangeSlicer, DParts, BlockInterpreter, SlicePlan, UNIT
+from .static import CHUNK_SIZE, SLICING, WORKERS, MEMORY_BUDGET, Meta
+from .adaptive import AdaptiveSlicer, Span
+from .buffers import BufferPool
+from .digest import BlockDigests, digest_file
+from .intervals import IntervalSet
+from .journal import Journal
+from .limiter import TokenBucket
+from .metrics import Metrics
+from .mirrors import MirrorSet
+from .output import FragmentWriter, DirectOutput, MmapOutput
+from .retry import CircuitBreaker, RetryScheduler
+from .threaded import thread_session, windowed_map
+from .trace import Tracer, SliceTrace
 
 rs = RangeSlicer()
-LAST_REPORT_TIME = None
-Bytes = 0
-Time = 0  # s
-
-
-def report(bytes_amt, time_ns):
-    global LAST_REPORT_TIME, Bytes, Time
-
-    if LAST_REPORT_TIME is None:
-        LAST_REPORT_TIME = time.time_ns()
-    # logging.debug(f"[REPORT] Before add, Bytes = {Bytes},
-    # Time = {Time}, bytes_amt = {bytes_amt}, timens = {time_ns}")
-    ct = time.time_ns()
-    if (time.time_ns() - LAST_REPORT_TIME) < REPORT_FREQUENCY:
-        Bytes += bytes_amt
-        Time += time_ns
-        return
+# Return code of a slice whose resource no longer matches the saved validators.
+CHANGED = 5
+# Return code of a slice the server refuses for good, a 4xx other than 408 and 429.
+REJECTED = 6
+POOL = BufferPool()
+METRICS = Metrics()
+
+
+def _raw_stream(resp: requests.Response):
+    # http.client's readinto fills the given buffer directly, while urllib3's
+    # allocates a temporary bytes object per call. Only valid for identity bodies.
+    if resp.headers.get("Content-Encoding", "identity") == "identity":
+        return getattr(resp.raw, "_fp", None) or resp.raw
+    resp.raw.decode_content = True
+    return resp.raw
+
+
+def _body_length(resp: requests.Response) -> Optional[int]:
+    # Bytes the body must hold once decoded, None when the headers can't tell.
+    if resp.headers.get("Content-Encoding", "identity") != "identity":
+        return None
+    length = resp.headers.get("Content-Length")
+    return int(length) if length and length.isdigit() else None
+
 
-    logging.debug(f"[REPORT] Current speed : {Bytes / Time * NS / 1000 :.2f} KBytes/s")
-    # logging.debug(f"[REPORT] bytes_amt = {bytes_amt}, time_ns = {time_ns},
-    # Current speed : {bytes_amt / time_ns * NS / 1000} KBytes/s")
-    # Clear and reset the cursor.
-    LAST_REPORT_TIME = ct
-    Bytes = 0
-    Time = 0
+def _whole_body(range_value: str, length: Optional[str]) -> bool:
+    # A 200 to a range carries the whole file, only usable when the range starts at 0 and holds all of it.
+    low, high = rs.parse_range(range_value)
+    return low == 0 and length is not None and length.isdigit() and int(length) <= high + 1
 
 
-def clear_report():
-    global LAST_REPORT_TIME
-    LAST_REPORT_TIME = None
+def _status_code(status: int) -> int:
+    # Timeouts and throttling are worth retrying, the other client errors won't change.
+    return REJECTED if 400 <= status < 500 and status not in (408, 429) else 4
+
+
+def _host_health(code: int) -> Optional[bool]:
+    # What the breaker records, a refused range says nothing about the host.
+    return None if code == REJECTED else code == 0
+
+
+def _traced(trace: Optional[SliceTrace], phase: str, fn, *args):
+    if trace is None:
+        return fn(*args)
+    st = time.monotonic()
+    fn(*args)
+    trace.phase(phase, st)
+
+
+def _receive(
+        resp: requests.Response, buffer: bytearray, writer,
+        span: Span = None, metrics: Metrics = METRICS, limiter: TokenBucket = None,
+        chunk_size: int = CHUNK_SIZE, trace: SliceTrace = None
+):
+    view = memoryview(buffer)
+    stream = _raw_stream(resp)
+    # http.client's readinto doesn't check the body against its Content-Length, a closed connection reads as the end.
+    expected = _body_length(resp)
+    received = 0
+    filled = 0
+    first_byte = None
+    exhausted = False
+    while True:
+        # Received bytes land in the pooled buffer, which is only handed to the writer when full.
+        amt = min(chunk_size, len(view) - filled)
+        # A span may have been shortened by a thief, never read past its end.
+        if span and (amt := span.claim(amt)) == 0:
+            break
+        n = stream.readinto(view[filled:filled + amt])
+        if not n:
+            exhausted = True
+            break
+        if first_byte is None:
+            first_byte = time.monotonic()
+        filled += n
+        received += n
+        if span:
+            span.advance(n)
+
+        # Audit - bytes, no lock and no clock on this path.
+        metrics.add(n)
+        if limiter:
+            limiter.consume(n)
+
+        if filled == len(view):
+            _traced(trace, "write", writer.write, view)
+            filled = 0
+
+    if trace:
+        trace.body_received(first_byte)
+    if filled:
+        _traced(trace, "write", writer.write, view[:filled])
+    if exhausted and expected is not None and received < expected:
+        # Never committed, the slice is received again.
+        raise IncompleteBody(f"connection closed after {received} of {expected} bytes")
+    _traced(trace, "commit", writer.commit)
+
+    if exhausted:
+        # Reading from http.client directly, urllib3 has to be told the connection is reusable.
+        resp.raw.release_conn()
+    return first_byte
 
 
 def _download(
@@ -49,44 +132,80 @@ def _download(
         name: str,
         s: requests.Session,
         headers: dict = None,
-        data=None
+        data=None,
+        writer=None,
+        pool: BufferPool = None,
+        span: Span = None,
+        metrics: Metrics = None,
+        limiter: TokenBucket = None,
+        chunk_size: int = CHUNK_SIZE,
+        trace: SliceTrace = None
 ):
     # Timeout = UNIT bytes // 5 kbps * 1024 bytes + 1
+    pool = pool or POOL
+    metrics = metrics or METRICS
+    # Waiting for a free buffer is the backpressure of the memory budget.
+    buffer = pool.acquire()
+    writer = writer or FragmentWriter(name)
+    resp = None
+    code, ttfb = 0, None
+    sent = time.monotonic()
     try:
-        start_req = time.time_ns()
+        if span:
+            span.start()
+        if trace:
+            trace.request_sent()
         resp = s.get(url=url, headers=headers, data=data,
                      timeout=1229, verify=False, stream=True)
-
-        downloaded_bytes = 0
-        # Using an IO Buffer for speeding up caching.
-        with io.BytesIO() as buffer:
-            total_length = resp.headers.get('content-length')
-            if total_length is None:
-                buffer.write(resp.content)
+        if trace:
+            trace.headers_received()
+        if resp.status_code not in (200, 206):
+            # An error page must not end up as a fragment.
+            logging.info(f"Unexpected status {resp.status_code} when downloading file, url = {url}, name = {name}.")
+            code = _status_code(resp.status_code)
+        elif resp.status_code == 200 and headers and "Range" in headers and \
+                not _whole_body(headers["Range"], resp.headers.get("Content-Length")):
+            # The whole file can't be written where the range should be. The only slice of the file may take it.
+            if "If-Range" in headers:
+                # The validator didn't match.
+                logging.warning(f"Resource changed since {headers['If-Range']}, url = {url}, name = {name}.")
+                code = CHANGED
             else:
-                for chunk in resp.iter_content(CHUNK_SIZE):
-                    buffer.write(chunk)
-
-                    # Audit - bytes
-                    downloaded_bytes += len(chunk)
-                    current_time = time.time_ns()
-                    report(len(chunk), time.time_ns() - start_req)
-                    start_req = current_time
-
-            with open(name, "wb") as f:
-                f.write(buffer.getvalue())
+                logging.info(f"Range ignored by the server, url = {url}, name = {name}.")
+                code = 4
+        else:
+            first_byte = _receive(resp, buffer, writer, span, metrics, limiter, chunk_size, trace)
+            ttfb = first_byte - sent if first_byte else None
 
     except requests.exceptions.Timeout:
         logging.info(f"Timeout when downloading file, url = {url}, name = {name}.")
-        return 1
+        code = 1
+    except IncompleteBody as ib:
+        logging.info(f"Body cut short, {ib}, url = {url}, name = {name}.")
+        code = 4
     except IOError as ie:
         logging.info(f"IOError when saving buffered content, url = {url}, name = {name}.", exc_info=ie)
-        return 2
+        code = 2
     except Exception as be:
         logging.info(f"Unhandled exception occurred, exception = {be}, url = {url}, name = {name}.", exc_info=be)
-        return 3
-    else:
-        return 0
+        code = 3
+    finally:
+        writer.close()
+        pool.release(buffer)
+        if resp is not None and resp.raw.connection is not None:
+            # The body wasn't read to its end, the connection can't be reused.
+            resp.close()
+
+    metrics.finish(code, time.monotonic() - sent, ttfb)
+    return code
+
+
+class ResourceChanged(Exception):
+    pass
+
+
+class IncompleteBody(Exception):
+    pass
 
 
 def check_slices(slices):
@@ -117,35 +236,36 @@ def path_specify(path, name=None, suffix='failed'):
     return meta_info_name
 
 
-# Support for parts range guided download.
-# A range guided download needs to pass in the list of range.
-def download(
-        url: str, path=None, name=None,
-        headers=None, data=None, retry_timeout=3600,
-        dparts: Optional[DParts] = None, block_index: Optional[BlockInterpreter] = None
+def _prepare(
+        url: str, path, name, s: requests.Session,
+        dparts: Optional[DParts] = None, direct: bool = False, mirrors: Optional[List[str]] = None,
+        unit: int = UNIT
 ):
-    s = requests.session()
-    headers = headers or {}
-
     # SLICING loggingIC
     # DParts has been configured:
     # If DParts enabled, we enforce using the directory in which lays the .dparts file.
     if dparts:
-        slices = dparts.get_range_slices(url=url, session=s)
-        logging.info(
-            f"[Download] [DPART] Reading ranges form dparts, with length = {len(dparts)}, enabling direct slicing."
-        )
-        direct_slicing = True
-        content_length, _ = rs.make_head_request(url, s)
         path = dparts.parts_folder
+    cached = _cached_head(url, path)
+    head = cached or rs.make_head_request(url, s, validators=True)
+    check_slices(head)
+    content_length, range_types, validators = head
+    if dparts:
+        # Parts files are exchanged between machines, they must describe this very resource.
+        if dparts.etag and validators.get("ETag") and dparts.etag != validators["ETag"]:
+            raise ResourceChanged(f"The dparts were listed for ETag {dparts.etag}, {url} now has {validators['ETag']}.")
+        if dparts.content_length and dparts.content_length != content_length:
+            raise ResourceChanged(
+                f"The dparts were listed for {dparts.content_length} bytes, {url} now has {content_length}."
+            )
+        slices = dparts.get_range_slices(unit, url=url, session=s)
+        logging.info(f"[Download] [DPART] Reading ranges form dparts, with length = {len(dparts)}.")
     else:
         # With no DParts told.
         if SLICING:
-            slices = rs.get_range_slices(url, s)
+            slices = rs.get_range_slices(url, s, unit=unit, head=(content_length, range_types))
         else:
-            slices = rs.get_range_slices(url, s, not_slicing=True)
-        direct_slicing = False
-        content_length = slices[-1]
+            slices = rs.get_range_slices(url, s, not_slicing=True, unit=unit, head=(content_length, range_types))
     check_slices(slices)  #
 
     raw_name = name_handler(path=path, name=name, range_info=None, url=url, with_path=False)
@@ -154,100 +274,414 @@ def download(
         instant_save=True, url=url, path=path,
         name=None, headers=None, data=None,
         content_length=content_length,
-        dparts=True if dparts else False
+        dparts=True if dparts else False,
+        direct=direct,
+        mirrors=mirrors,
+        etag=validators.get("ETag"),
+        last_modified=validators.get("Last-Modified"),
+        accept_ranges=range_types,
+        unit=unit
     )
     # save_meta(
     #     url=url, path=path, name=None, headers=None,
     #     data=None, content_length=content_length,
     #     dparts=True if dparts else False
     # )
+    return slices, path, raw_name, content_length, validators, cached is not None, bool(range_types)
 
-    checklist = {}  # dict typed
-    # Fast Write Back FD
+
+def _cached_head(url: str, path):
+    # A resumed download reuses the HEAD result saved in its meta, as long as ranges were accepted
+    # and a validator If-Range can carry came with it: the first slice then tells whether the resource changed.
+    try:
+        meta = Meta.load(path if path and os.path.isdir(path) else ".")
+    except (FileNotFoundError, ValueError):
+        return None
+    validators = {k: v for k, v in (("ETag", meta.etag), ("Last-Modified", meta.last_modified)) if v}
+    if meta.url != url or not meta.content_length or not meta.accept_ranges or not if_range(validators):
+        return None
+    logging.info(f"[Download] [Resume] Reusing the HEAD result saved in meta, validators = {validators}.")
+    return meta.content_length, meta.accept_ranges, validators
+
+
+def _unchanged(url: str, s: requests.Session, content_length: int, validators: dict) -> bool:
+    # Nothing was received to tell whether the saved HEAD still holds, a new one does.
+    head = rs.make_head_request(url, s, validators=True)
+    if head is None:
+        logging.warning(f"[Download] [Resume] HEAD request to {url} failed, can't tell whether it changed.")
+        return True
+    length, _, current = head
+    if length != content_length or any(current.get(k) != v for k, v in validators.items()):
+        logging.warning(f"[Download] [Resume] {url} changed, Content-Length = {length}, validators = {current}, "
+                        f"saved {content_length}, {validators}.")
+        return False
+    return True
+
+
+def if_range(validators: dict) -> dict:
+    # If-Range only takes a strong ETag, or else the date.
+    etag = validators.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return {"If-Range": etag}
+    if validators.get("Last-Modified"):
+        return {"If-Range": validators["Last-Modified"]}
+    return {}
+
+
+def _open_checklist(path, raw_name):
+    # Fast Write Back journal, completed ranges are appended as fixed size records.
+    # The checklist is the journal's interval set of completed bytes.
     fn = path_specify(path, name=raw_name, suffix="ok")
-    if os.path.exists(fn):
-        with open(fn, "rb") as _f:
-            try:
-                checklist = pickle.load(_f)
-            except EOFError:
-                logging.warning("[Download] [FWB] Failed to load checklist file, the file might be edited.")
-    # Used to save simultaneously
-    checklist_fast_write_fp = open(fn, "wb")
-    pickle.dump(checklist, checklist_fast_write_fp)
-    retrylist = queue.SimpleQueue()
-
-    epoch = 1
-    # Download by slice
-    logging.debug(f"[Download] [Slices] slices[-2:] = {slices[-2:]}, block_= {block_index}, type={type(block_index)}")
-    for low, high in rs.iterate_over_slices(slices, direct=direct_slicing):
-        # block_index is the first failed item.
-        if block_index and epoch not in block_index:
-            logging.info(f"[Resumable] Jumping over block {epoch}/{len(slices) - 1}")
-            epoch += 1
-            continue
+    journal = Journal(fn)
+    checklist = journal.completed
+    if checklist:
+        logging.info(f"[Download] [FWB] {checklist.size} bytes in {len(checklist)} ranges loaded from {fn!r}.")
+    return checklist, journal
+
 
+def _check(journal: Journal, range_value: str):
+    journal.append(*rs.parse_range(range_value))
+
+
+def _slice_tasks(slices: SlicePlan, checklist: IntervalSet, block_index: Optional[BlockInterpreter] = None):
+    total = len(slices)
+    # Download by slice
+    logging.debug(f"[Download] [Slices] slices = {slices}, block_= {block_index}, type={type(block_index)}")
+    if block_index:
+        # Only the selected blocks are visited, however many slices there are.
+        logging.info(f"[Resumable] Downloading the blocks of {block_index} out of {total}.")
+        ranges = ((epoch, slices.slice_at(epoch)) for epoch in block_index.blocks(total))
+    else:
+        ranges = enumerate(slices, start=1)
+    for epoch, (low, high) in ranges:
         range_info = rs.gen_range_headers(low, high)
 
         # Fast-forward check
         # TODO Pre-check all fast-forwarded fragments.
-        if range_info["Range"] in checklist:
-            logging.info(f"[Download][{epoch}/{len(slices) - 1}] [Fast-forward] "
+        # Whichever slices completed it last time, a range whose bytes are all there is done.
+        if (low, high) in checklist:
+            logging.info(f"[Download][{epoch}/{total}] [Fast-forward] "
                          f"File of range {range_info['Range']} existed, continue.")
             continue
+        yield epoch, low, high, range_info
+
 
-        # Mix into headers
-        headers.update(range_info)
-        _name = name_handler(path=path, name=name, range_info=range_info, url=url)
-        logging.info(f"[Download][{epoch}/{len(slices) - 1}] "
-                     f"Starting with url = {url}, name = {_name},"
-                     f" overwrite = {os.path.exists(_name)}, headers = {headers}, "
-                     f"save to {raw_name}")
+def _open_output(
+        path, name, url: str, content_length: int, direct: bool = False, mmap: bool = False
+) -> Optional[DirectOutput]:
+    # Direct mode: slices are written at their offsets of the final file, no fragment and no concat.
+    if not (direct or mmap):
+        return None
+    target = name_handler(path=path, name=name, range_info=None, url=url)
+    # An empty file can't be mapped.
+    if mmap and content_length:
+        return MmapOutput(target, content_length)
+    return DirectOutput(target, content_length)
+
+
+def _slice_writer(output: Optional[DirectOutput], range_value: str, name: str, digests: Optional[BlockDigests] = None):
+    low, _ = rs.parse_range(range_value)
+    writer = FragmentWriter(name) if output is None else output.slice_writer(low)
+    # Bytes are hashed on their way to the disk, never read back for it.
+    return digests.writer(writer, low) if digests is not None else writer
+
+
+def _adaptive_regions(content_length: int, checklist: IntervalSet, dparts: Optional[DParts] = None):
+    # Like the fixed slices, the last range ends at content_length, one past the last byte.
+    if dparts:
+        todo = IntervalSet((_l, min(_h, content_length)) for _l, _h in dparts.intervals)
+    else:
+        todo = IntervalSet([(0, content_length)])
+    # Whatever the slice boundaries were last time, only the bytes not in the checklist are left.
+    return list(todo - checklist)
+
+
+def _start_metrics(raw_name, content_length: int, journal: Journal, textfile=None, port=None) -> Metrics:
+    remaining = content_length - journal.completed.size
+    return Metrics(job=raw_name, total_bytes=max(remaining, 0)).start(textfile=textfile, port=port)
+
+
+def _open_mirrors(
+        url: str, s: requests.Session, mirrors: Optional[List[str]], content_length: int, validators: dict,
+        ranged: bool = True
+) -> MirrorSet:
+    # Without Accept-Ranges, url answers every range with a 200 and its whole body, If-Range would tell nothing.
+    own = validators if ranged else {}
+    if not mirrors:
+        return MirrorSet([url], {url: own})
+    # url stays the reference, mirrors disagreeing with it are left out.
+    mirror_set = MirrorSet.probe(url, mirrors, content_length, validators, s)
+    for mirror in mirror_set.mirrors:
+        if mirror.url == url:
+            mirror.validators = own
+    return mirror_set
+
+
+def _save_digests(path, content_length: int, digests: BlockDigests, totally_failed: list):
+    digests.close()
+    if totally_failed or not digests.covers(content_length):
+        return
+    root = digests.root().hex()
+    Meta.update(path if path and os.path.isdir(path) else ".", merkle_root=root)
+    logging.info(f"[Download] [Digest] {len(digests.blocks)} blocks, Merkle root = {root}.")
+
+
+def _discard_progress(path, raw_name, journal: Journal, digests: BlockDigests):
+    # Fragments of the former version must never be mixed with the new one.
+    fragments = list(pathlib.Path(path or ".").glob(f"{glob.escape(raw_name)}@bytes=*"))
+    for fragment in fragments:
+        os.remove(fragment)
+    journal.completed.clear()
+    digests.blocks.clear()
+    # The next run sends a fresh HEAD.
+    Meta.update(path if path and os.path.isdir(path) else ".", etag=None, last_modified=None)
+    logging.warning(f"[Download] [Resume] Discarded {len(fragments)} fragments and the progress of {raw_name}.")
+
+
+def _save_failed(path, raw_name, totally_failed: list):
+    # Save the unsuccessful items into a pickle file.
+    meta_info_name = path_specify(path, name=raw_name)
+    with open(meta_info_name, "wb") as pf:
+        pickle.dump(totally_failed, pf)
+
+
+class Transfer:
+    """
+    One file being downloaded: its slices, progress journal, output, mirrors and retries.
+    download() runs a single transfer, downloader.batch interleaves the slices of many
+    over the same workers, buffer pool, per-host gate and metrics.
+
+    fetch() and fetch_span() run in the workers, done() is fed their results in the
+    consumer thread, close() waits for the pending retries and saves what failed.
+    """
+
+    def __init__(
+            self, url: str, path=None, name=None,
+            headers=None, data=None, retry_timeout=3600,
+            dparts: Optional[DParts] = None, workers: int = WORKERS, direct: bool = False, mmap: bool = False,
+            pool: BufferPool = None, breaker: CircuitBreaker = None, limiter: TokenBucket = None,
+            metrics: Metrics = None, metrics_file: Optional[str] = None, metrics_port: Optional[int] = None,
+            mirrors: Optional[List[str]] = None, unit: int = UNIT, chunk_size: int = CHUNK_SIZE,
+            tracer: Optional[Tracer] = None, retry: Optional[RetryScheduler] = None
+    ):
+        self.url = url
+        self.name = name
+        self.data = data
+        self.dparts = dparts
+        # HEAD requests go over the warm connection of the calling thread.
+        s = thread_session()
+        self.pool = pool or POOL
+        self.breaker = breaker or CircuitBreaker(workers)
+        self.limiter = limiter
+        self.unit = unit
+        self.chunk_size = chunk_size
+        self.tracer = tracer
+
+        self.slices, self.path, self.raw_name, self.content_length, self.validators, self.cached, ranged = \
+            _prepare(url, path, name, s, dparts, direct, mirrors, unit)
+        # A slice received on the condition of the validators proves they still hold.
+        self.validated = False
+        # Every range is made conditional by _guarded(), on the validators of the mirror it goes to.
+        self.headers = {**(headers or {})}
+        self.changed = False
+        self.checklist, self.journal = _open_checklist(self.path, self.raw_name)
+        self.digests = BlockDigests(digest_file(self.path))
+        self.output = _open_output(self.path, name, url, self.content_length, direct, mmap)
+        # A shared metrics instance is started and stopped by its owner.
+        self._own_metrics = metrics is None
+        if self._own_metrics:
+            self.metrics = _start_metrics(self.raw_name, self.content_length, self.journal, metrics_file, metrics_port)
+        else:
+            self.metrics = metrics
+        self.total = len(self.slices)
+        self.mirror_set = _open_mirrors(url, s, mirrors, self.content_length, self.validators, ranged)
+        # Failed slices are retried with backoff while the main stream goes on.
+        # A scheduler shared between transfers is joined by its owner.
+        self._own_retry = retry is None
+        if self._own_retry:
+            retry = RetryScheduler(workers=workers, retry_timeout=retry_timeout, fatal=(CHANGED, REJECTED))
+        self.retry = retry
+        self.slicer: Optional[AdaptiveSlicer] = None
+
+    def _guarded(self, name, s, headers, key=None, **kwargs):
+        # Main stream and retries share the mirror choice and the per-host gate.
+        trace = self.tracer.begin(headers["Range"], key, file=self.raw_name) if self.tracer else None
+        mirror = self.mirror_set.pick()
+        logging.debug(f"[Download] [Mirror] {headers['Range']} from {mirror.url}.")
+        # A changed resource answers with its whole new body.
+        headers = {**headers, **if_range(mirror.validators)}
+        self.breaker.acquire(mirror.host)
+        code = 3
+        st = time.monotonic()
+        try:
+            code = _download(mirror.url, name, s, headers, pool=self.pool, metrics=self.metrics,
+                             limiter=self.limiter, chunk_size=self.chunk_size, trace=trace, **kwargs)
+        finally:
+            if trace:
+                self.tracer.end(trace, code, url=mirror.url)
+            self.breaker.release(mirror.host, _host_health(code))
+            span = kwargs.get("span")
+            low, high = rs.parse_range(headers["Range"])
+            received = span.position - span.low if span else high - low + 1
+            self.mirror_set.done(mirror, code == 0, received, time.monotonic() - st)
+        if code == REJECTED and len(self.mirror_set) > 1:
+            # Another mirror may still serve what this one refuses.
+            code = 4
+        return code
+
+    def _retry(self, failed):
+        # The url of the item is the reference one, the retry goes to whichever mirror is picked.
+        _url, _name, _headers, _data = failed
+        if self.changed:
+            return CHANGED
+        code = self._guarded(_name, thread_session(), _headers, data=_data,
+                             writer=self._writer(_headers["Range"], _name))
+        if code == 0:
+            _check(self.journal, _headers["Range"])
+        return code
+
+    def _writer(self, range_value: str, name: str):
+        return _slice_writer(self.output, range_value, name, self.digests)
+
+    def tasks(self, block_index: Optional[BlockInterpreter] = None):
+        for task in _slice_tasks(self.slices, self.checklist, block_index):
+            if self.changed:
+                return
+            if self.tracer:
+                self.tracer.queue((id(self), task[0]))
+            yield task
+
+    def span_tasks(self):
+        self.slicer = AdaptiveSlicer(
+            _adaptive_regions(self.content_length, self.checklist, self.dparts), unit=self.unit
+        )
+        epoch = 1
+        # Pulled lazily by windowed_map, a new span is cut (or stolen) whenever a worker is free.
+        while not self.changed and (span := self.slicer.next()) is not None:
+            if self.tracer:
+                self.tracer.queue((id(self), epoch))
+            yield epoch, span
+            epoch += 1
+
+    def fetch(self, epoch, low, high, range_info):
+        # Mix into headers, every slice owns its copy since slices may run concurrently.
+        _headers = {**self.headers, **range_info}
+        _name = name_handler(path=self.path, name=self.name, range_info=range_info, url=self.url)
+        logging.info(f"[Download][{epoch}/{self.total}] "
+                     f"Starting with url = {self.url}, name = {_name},"
+                     f" overwrite = {os.path.exists(_name)}, headers = {_headers}, "
+                     f"save to {self.raw_name}")
         st = time.time()
-        code = _download(url, name=_name, s=s, headers=headers, data=data)
+        code = self._guarded(name=_name, s=thread_session(), headers=_headers, key=(id(self), epoch),
+                             data=self.data, writer=self._writer(range_info["Range"], _name))
         duration = time.time() - st
         logging.info(
-            f"[Download][{epoch}/{len(slices) - 1}] "
+            f"[Download][{epoch}/{self.total}] "
             f"Ended with code = {code}, used {duration} secs @ {(high - low) / 1024 / duration:.2f}KB/s."
         )
+        return code, _name, _headers
+
+    def fetch_span(self, epoch, span: Span):
+        planned = rs.gen_range_headers(span.low, span.high)
+        _name = name_handler(path=self.path, name=self.name, range_info=planned, url=self.url)
+        logging.info(f"[Download][{epoch}/*] "
+                     f"Starting with url = {self.url}, name = {_name}, range = {planned['Range']}, "
+                     f"save to {self.raw_name}")
+        st = time.time()
+        code = self._guarded(name=_name, s=thread_session(), headers={**self.headers, **planned},
+                             key=(id(self), epoch), data=self.data, writer=self._writer(planned["Range"], _name),
+                             span=span)
+        self.slicer.done(span, code == 0)
+        duration = time.time() - st
+
+        # The tail may have been stolen meanwhile, the fragment is named after what it really holds.
+        range_info = rs.gen_range_headers(span.low, span.high)
+        if range_info != planned:
+            _final_name = name_handler(path=self.path, name=self.name, range_info=range_info, url=self.url)
+            if self.output is None and os.path.exists(_name):
+                os.replace(_name, _final_name)
+            _name = _final_name
+        logging.info(
+            f"[Download][{epoch}/*] Ended with code = {code}, range = {range_info['Range']}, "
+            f"used {duration} secs @ {(span.position - span.low) / 1024 / duration:.2f}KB/s."
+        )
+        return code, _name, {**self.headers, **range_info}
 
+    def done(self, epoch, code, _name, _headers):
         # Successful queue
         if code == 0:
-            logging.debug(f"[DEBUG][{epoch}/{len(slices) - 1}] ** ** ** range_info = {range_info}")
-            checklist[range_info["Range"]] = name
-            pickle.dump(checklist, checklist_fast_write_fp)
+            logging.debug(f"[DEBUG][{epoch}/{self.total}] ** ** ** range_info = {_headers['Range']}")
+            _check(self.journal, _headers["Range"])
+            self.validated = True
+        elif code == CHANGED:
+            # Nothing more is scheduled, retrying would only fetch the new version again.
+            self.changed = True
+        elif code == REJECTED:
+            logging.warning(f"[Download][{epoch}/{self.total}] {_headers['Range']} refused by the server, given up.")
+            self.retry.give_up((self.url, _name, _headers, self.data), fn=self._retry)
         else:
-            retrylist.put((url, name, headers, data))
-
-        # Counter
-        epoch += 1
+            self.retry.submit((self.url, _name, _headers, self.data), fn=self._retry)
+
+    def close(self):
+        totally_failed = self.retry.wait(self._retry)
+        if self.cached and not (self.validated or self.changed):
+            # Complete from an earlier run on a cached HEAD, not a single request was sent.
+            self.changed = not _unchanged(self.url, thread_session(), self.content_length, self.validators)
+        if self._own_retry:
+            self.retry.join()
+
+        if self.output:
+            self.output.close()
+        if self.changed:
+            _discard_progress(self.path, self.raw_name, self.journal, self.digests)
+        self.journal.close()
+        if self._own_metrics:
+            self.metrics.stop()
+        _save_digests(self.path, self.content_length, self.digests, totally_failed)
+        _save_failed(self.path, self.raw_name, totally_failed)
+        if self.changed:
+            raise ResourceChanged(f"{self.url} changed while being downloaded, progress discarded, start again.")
+        return self.checklist, totally_failed
 
-    # Check for the retry list, and retry for those failed items.
-    retry_checkpoint = time.time()
-    while retrylist.empty() is False:
-        failed = retrylist.get(block=False)
 
-        # Timeout breakpoint
-        if time.time() - retry_checkpoint > retry_timeout:
-            break
-
-        # Retry
-        code = _download(*failed)
-        if code == 0:
-            checklist[failed[-2]["Range"]] = name
-        else:
-            retrylist.put(failed)
+# Support for parts range guided download.
+# A range guided download needs to pass in the list of range.
+# With workers > 1, up to `workers` slices are fetched at once, each worker on its own pooled connection.
+# With direct, slices are written into the preallocated final file instead of fragments, with mmap through a mapping.
+# With adaptive, slices are sized from the measured throughput and slow ranges get split between workers.
+# With mirrors, every slice goes to the url expected to serve it first, see MirrorSet.
+# With a limiter, all workers together stay under its bandwidth, which may be shared with other transfers.
+# With a tracer, the timeline of every slice attempt is recorded, see Tracer.
+def download(
+        url: str, path=None, name=None,
+        headers=None, data=None, retry_timeout=3600,
+        dparts: Optional[DParts] = None, block_index: Optional[BlockInterpreter] = None,
+        workers: int = WORKERS, direct: bool = False, memory_budget: int = MEMORY_BUDGET,
+        adaptive: bool = False, metrics_file: Optional[str] = None, metrics_port: Optional[int] = None,
+        mirrors: Optional[List[str]] = None, limiter: Optional[TokenBucket] = None, mmap: bool = False,
+        unit: int = UNIT, chunk_size: int = CHUNK_SIZE, tracer: Optional[Tracer] = None
+):
+    # Ranges are inclusive on both ends, a slice carries up to unit + 1 bytes.
+    pool = BufferPool(buffer_size=unit + 1, budget=memory_budget)
+    logging.debug(f"[Download] [BufferPool] {pool.capacity} buffers of {pool.buffer_size} bytes at most.")
+    transfer = Transfer(
+        url, path=path, name=name, headers=headers, data=data, retry_timeout=retry_timeout,
+        dparts=dparts, workers=workers, direct=direct, mmap=mmap, pool=pool, limiter=limiter,
+        metrics_file=metrics_file, metrics_port=metrics_port, mirrors=mirrors, unit=unit, chunk_size=chunk_size,
+        tracer=tracer
+    )
 
-    # Save the unsuccessful items into a pickle file.
-    totally_failed = []
-    while retrylist.empty() is False:
-        totally_failed.append(retrylist.get())
-
-    # if path and os.path.isdir(path):
-    #     meta_info_name = os.path.join(path, f"{_name}.failed")
-    # else:
-    #     meta_info_name = f"{_name}.failed"
-    meta_info_name = path_specify(path, name=raw_name)
-    with open(meta_info_name, "wb") as pf:
-        pickle.dump(totally_failed, pf)
+    if workers > 1:
+        logging.info(f"[Download] Running with {workers} workers.")
+    if len(transfer.mirror_set) > 1:
+        logging.info(f"[Download] Spreading slices over {len(transfer.mirror_set)} mirrors.")
+    if adaptive:
+        if block_index:
+            logging.warning("[Download] [Adaptive] Block index is ignored, slices are no longer fixed.")
+        tasks, fetch, window = transfer.span_tasks(), transfer.fetch_span, workers
+    else:
+        tasks, fetch, window = transfer.tasks(block_index), transfer.fetch, None
+    for task, result in windowed_map(fetch, tasks, workers, window):
+        transfer.done(task[0], *result)
 
-    return checklist, totally_failed
+    return transfer.close()
@@ -0,0 +1,87 @@
+import errno
+import logging
+import os
+import threading
+from typing import Optional
+
+from .static import COPY_CHUNK
+
+# A copy method failing with one of these can't copy between the given files.
+_UNSUPPORTED = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP}
+# Bytes asked of the kernel per call, it copies less when it likes.
+_KERNEL_CHUNK = 1 << 30
+
+
+class FileCopier:
+    """
+    Copies files into another one without their bytes entering userspace:
+    os.copy_file_range first, which shares the extents instead on filesystems
+    able to (btrfs, XFS with reflink, NFS 4.2 server-side copy), then os.sendfile,
+    and at last reads into a reused COPY_CHUNK buffer. A method the files don't
+    support is dropped for the copies that follow.
+
+    Safe to share between threads, every copy reads its source from where the
+    source fd is and writes at dst_offset, or where the destination fd is.
+    """
+
+    def __init__(self, chunk_size: int = COPY_CHUNK):
+        self.chunk_size = chunk_size
+        self.methods = []
+        if hasattr(os, "copy_file_range"):
+            self.methods.append(self._copy_file_range)
+        if hasattr(os, "sendfile"):
+            self.methods.append(self._sendfile)
+        self._local = threading.local()
+
+    @staticmethod
+    def _copy_file_range(src: int, dst: int, count: int, dst_offset: Optional[int]) -> int:
+        return os.copy_file_range(src, dst, min(count, _KERNEL_CHUNK), offset_dst=dst_offset)
+
+    @staticmethod
+    def _sendfile(src: int, dst: int, count: int, dst_offset: Optional[int]) -> int:
+        return os.sendfile(dst, src, None, min(count, _KERNEL_CHUNK))
+
+    def _buffered(self, src: int, dst: int, count: int, dst_offset: Optional[int]) -> int:
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None:
+            buffer = self._local.buffer = memoryview(bytearray(self.chunk_size))
+        size = min(count, self.chunk_size)
+        if hasattr(os, "readv"):
+            n = os.readv(src, [buffer[:size]])
+            view = buffer[:n]
+        else:
+            view = memoryview(os.read(src, size))
+            n = len(view)
+        while view:
+            written = os.write(dst, view) if dst_offset is None else os.pwrite(dst, view, dst_offset)
+            view = view[written:]
+            if dst_offset is not None:
+                dst_offset += written
+        return n
+
+    def copy(self, src: int, dst: int, count: int, dst_offset: Optional[int] = None) -> int:
+        """
+        :param src, dst: file descriptors.
+        :param count: bytes to copy, less are when the source ends before.
+        :param dst_offset: where to write in dst, its current position when None.
+        :return: the bytes copied.
+        """
+        copied = 0
+        # sendfile writes at the position of dst, which can't be told an offset.
+        methods = [m for m in self.methods if dst_offset is None or m != self._sendfile] + [self._buffered]
+        method = methods.pop(0)
+        while copied < count:
+            try:
+                n = method(src, dst, count - copied, None if dst_offset is None else dst_offset + copied)
+            except OSError as oe:
+                # Only a method which hasn't copied anything yet can give way to the next one.
+                if oe.errno not in _UNSUPPORTED or copied or method == self._buffered:
+                    raise
+                logging.debug(f"[FileCopy] {method.__name__} unavailable, {oe}.")
+                self.methods = [m for m in self.methods if m != method]
+                method = methods.pop(0)
+                continue
+            if n == 0:
+                break
+            copied += n
+        return copied
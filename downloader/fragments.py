@@ -0,0 +1,142 @@
+import logging
+import os
+import pathlib
+import struct
+import time
+from typing import List, NamedTuple, Tuple
+
+from .intervals import parse_interval
+from .static import DEFAULT_FRAGMENT_INDEX_FILE_NAME, DEFAULT_META_FILE_NAME, FRAGMENT_INDEX_RACY_SECS
+
+MAGIC = b"DFIX"
+VERSION = 1
+# Magic, version, mtime_ns of the folder and of the meta file, size of the meta file, names and fragments.
+HEADER = struct.Struct("<4sHqqqII")
+# One fragment: low, high, size and the index of its name before "@bytes=".
+RECORD = struct.Struct("<qqqI")
+NAME = struct.Struct("<H")
+
+
+class Fragment(NamedTuple):
+    # A str path, pathlib costs more than the rest of the scan together.
+    path: str
+    low: int
+    high: int
+    size: int
+
+    @property
+    def name(self) -> str:
+        return os.path.basename(self.path)
+
+
+def _key(folder: pathlib.Path) -> Tuple[int, int, int]:
+    # A fragment added, removed or renamed changes the folder, every download run rewrites the meta.
+    # Fragments rewritten in place change neither, but only a download rewrites them.
+    try:
+        meta = os.stat(folder / DEFAULT_META_FILE_NAME)
+        meta_mtime, meta_size = meta.st_mtime_ns, meta.st_size
+    except FileNotFoundError:
+        meta_mtime, meta_size = -1, -1
+    return os.stat(folder).st_mtime_ns, meta_mtime, meta_size
+
+
+def _scan(folder: pathlib.Path) -> List[Fragment]:
+    fragments = []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if "@bytes=" not in entry.name or not entry.is_file():
+                continue
+            try:
+                low, high = parse_interval(entry.name)
+            except ValueError:
+                logging.warning(f"[Fragments] Skipping {entry.name!r}, not a fragment name.")
+                continue
+            # DirEntry caches its stat, the name is parsed once.
+            fragments.append(Fragment._make((entry.path, low, high, entry.stat().st_size)))
+    return fragments
+
+
+def _load(fn: pathlib.Path, folder: pathlib.Path, key: Tuple[int, int, int]):
+    try:
+        with open(fn, "rb") as fp:
+            content = fp.read()
+        magic, version, *saved, names, count = HEADER.unpack_from(content)
+    except (FileNotFoundError, struct.error):
+        return None
+    if magic != MAGIC or version != VERSION or tuple(saved) != key:
+        return None
+
+    offset, bases = HEADER.size, []
+    try:
+        for _ in range(names):
+            size, = NAME.unpack_from(content, offset)
+            offset += NAME.size
+            bases.append(os.path.join(folder, content[offset:offset + size].decode() + "@bytes="))
+            offset += size
+        records = memoryview(content)[offset:offset + count * RECORD.size]
+        if len(records) != count * RECORD.size:
+            return None
+        make = Fragment._make
+        return [
+            make((f"{bases[base]}{low}-{high}", low, high, size))
+            for low, high, size, base in RECORD.iter_unpack(records)
+        ]
+    except (struct.error, IndexError, UnicodeDecodeError):
+        # Torn by a crash while being rewritten.
+        return None
+
+
+def _save(fn: pathlib.Path, key: Tuple[int, int, int], fragments: List[Fragment]):
+    bases, records = {}, bytearray()
+    for fragment in fragments:
+        base = bases.setdefault(fragment.name.rsplit("@bytes=", maxsplit=1)[0], len(bases))
+        records += RECORD.pack(fragment.low, fragment.high, fragment.size, base)
+    body = bytearray(HEADER.pack(MAGIC, VERSION, *key, len(bases), len(fragments)))
+    for base in bases:
+        encoded = base.encode()
+        body += NAME.pack(len(encoded)) + encoded
+    body += records
+    # Rewritten in place, creating or renaming a file would change the folder it's keyed by.
+    # The magic goes last, an index torn by a crash is never taken for a valid one.
+    with open(fn, "r+b") as fp:
+        fp.write(b"\0" * len(MAGIC) + body[len(MAGIC):])
+        fp.truncate()
+        fp.flush()
+        fp.seek(0)
+        fp.write(MAGIC)
+
+
+def scan_fragments(path, use_index: bool = True) -> List[Fragment]:
+    """
+    The fragments of a folder, sorted by their high end, sizes included.
+    One os.scandir pass parses the names and takes the sizes from the directory
+    entries. The result is kept in the folder's DEFAULT_FRAGMENT_INDEX_FILE_NAME,
+    reused as long as neither the folder nor its meta file changed.
+    """
+    folder = pathlib.Path(path)
+    fn = folder / DEFAULT_FRAGMENT_INDEX_FILE_NAME
+    if use_index and not fn.exists():
+        # Created before the folder is looked at, it won't change it afterwards.
+        fn.touch()
+    key = _key(folder)
+    if use_index:
+        fragments = _load(fn, folder, key)
+        if fragments is not None:
+            logging.info(f"[Fragments] {len(fragments)} fragments read from the index of {str(folder)!r}.")
+            return fragments
+
+    fragments = _scan(folder)
+    fragments.sort(key=lambda f: f.high)
+    # A folder changed within the resolution of its mtime may change again unnoticed, it's not indexed yet.
+    if use_index and time.time_ns() - max(key[:2]) > FRAGMENT_INDEX_RACY_SECS * 10 ** 9:
+        _save(fn, key, fragments)
+    logging.info(f"[Fragments] {len(fragments)} fragments scanned in {str(folder)!r}.")
+    return fragments
+
+
+def refresh_index(path, fragments: List[Fragment]):
+    # After writing a file of our own beside the fragments, which changed the folder but not them.
+    folder = pathlib.Path(path)
+    fn = folder / DEFAULT_FRAGMENT_INDEX_FILE_NAME
+    if fn.exists():
+        _save(fn, _key(folder), fragments)
@@ -0,0 +1,125 @@
+import bisect
+from typing import Iterable, Iterator, List, Tuple, Union
+
+
+def parse_interval(value: str) -> Tuple[int, int]:
+    # "bytes=low-high", "name@bytes=low-high" or "low-high" -> (low, high)
+    low, high = value.rsplit("=", maxsplit=1)[-1].split("-")
+    return int(low), int(high)
+
+
+class IntervalSet:
+    """
+    Set of integers kept as sorted, disjoint ranges. Ranges are given and returned
+    inclusive on both ends, like HTTP byte ranges, overlapping and adjacent ones merge.
+
+    Internally one flat list of half-open bounds [low0, end0, low1, end1, ...]: a
+    value lies in the set when an odd number of bounds are <= it. Lookups bisect the
+    list, O(log n). Updates replace a slice of it, so threads reading it meanwhile
+    see either the old or the new ranges, never a mix of both.
+    """
+
+    __slots__ = ("_bounds",)
+
+    def __init__(self, ranges: Iterable[Tuple[int, int]] = ()):
+        self._bounds: List[int] = []
+        for low, high in ranges:
+            self.add(low, high)
+
+    @classmethod
+    def parse(cls, values: Iterable[str]) -> "IntervalSet":
+        return cls(map(parse_interval, values))
+
+    def add(self, low: int, high: int):
+        if low > high:
+            return
+        b = self._bounds
+        # An odd index means the bound falls within (or touches) a range, which is extended.
+        i = bisect.bisect_left(b, low)
+        j = bisect.bisect_right(b, high + 1)
+        b[i:j] = ([] if i % 2 else [low]) + ([] if j % 2 else [high + 1])
+
+    def discard(self, low: int, high: int):
+        if low > high:
+            return
+        b = self._bounds
+        i = bisect.bisect_left(b, low)
+        j = bisect.bisect_right(b, high + 1)
+        # The ranges cut through are shortened, the ones within are dropped.
+        b[i:j] = ([low] if i % 2 else []) + ([high + 1] if j % 2 else [])
+
+    def update(self, ranges: Iterable[Tuple[int, int]]):
+        for low, high in ranges:
+            self.add(low, high)
+
+    def clear(self):
+        del self._bounds[:]
+
+    def covers(self, low: int, high: int) -> bool:
+        # Every value of [low, high] is in the set.
+        b = self._bounds
+        i = bisect.bisect_right(b, low)
+        return i % 2 == 1 and b[i] > high
+
+    def intersects(self, low: int, high: int) -> bool:
+        # Any value of [low, high] is in the set.
+        b = self._bounds
+        i = bisect.bisect_right(b, low)
+        return i % 2 == 1 or (i < len(b) and b[i] <= high)
+
+    def gaps(self, low: int, high: int) -> Iterator[Tuple[int, int]]:
+        # Ranges of [low, high] missing from the set, in order.
+        b = list(self._bounds)
+        i = bisect.bisect_right(b, low)
+        cursor = low
+        if i % 2:
+            cursor, i = b[i], i + 1
+        while cursor <= high:
+            if i >= len(b) or b[i] > high:
+                yield cursor, high
+                return
+            if b[i] > cursor:
+                yield cursor, b[i] - 1
+            cursor, i = b[i + 1], i + 2
+
+    def __contains__(self, item: Union[int, Tuple[int, int]]) -> bool:
+        if isinstance(item, tuple):
+            return self.covers(*item)
+        return bisect.bisect_right(self._bounds, item) % 2 == 1
+
+    def __iter__(self) -> Iterator[Tuple[int, int]]:
+        b = list(self._bounds)
+        for idx in range(0, len(b), 2):
+            yield b[idx], b[idx + 1] - 1
+
+    def __len__(self):
+        # Number of ranges, not of values.
+        return len(self._bounds) // 2
+
+    @property
+    def size(self) -> int:
+        b = list(self._bounds)
+        return sum(b[idx + 1] - b[idx] for idx in range(0, len(b), 2))
+
+    def copy(self) -> "IntervalSet":
+        other = IntervalSet()
+        other._bounds = list(self._bounds)
+        return other
+
+    def __or__(self, other: "IntervalSet") -> "IntervalSet":
+        result = self.copy()
+        result.update(other)
+        return result
+
+    def __sub__(self, other: "IntervalSet") -> "IntervalSet":
+        result = self.copy()
+        for low, high in other:
+            result.discard(low, high)
+        return result
+
+    def __eq__(self, other):
+        return isinstance(other, IntervalSet) and self._bounds == other._bounds
+
+    def __repr__(self):
+        ranges = ", ".join(f"{low}-{high}" for low, high in list(self)[:8])
+        return f"IntervalSet({ranges}{', ...' if len(self) > 8 else ''})"
@@ -0,0 +1,119 @@
+import io
+import logging
+import os
+import pickle
+import struct
+import threading
+import time
+from typing import Tuple
+
+from .intervals import IntervalSet, parse_interval
+from .static import JOURNAL_SYNC_RECORDS, JOURNAL_SYNC_SECS
+
+MAGIC = b"DJNL"
+VERSION = 1
+HEADER = struct.Struct("<4sH")
+# One completed range, low and high, both inclusive.
+RECORD = struct.Struct("<qq")
+
+
+class Journal:
+    """
+    Append-only progress journal of a download, one fixed-size record per
+    completed range. Records are fsync-ed in batches, every JOURNAL_SYNC_RECORDS
+    records or JOURNAL_SYNC_SECS seconds, whichever comes first. A torn record left
+    by a crash is simply dropped on load, compact() rewrites the merged ranges.
+
+    Files written by the former pickled checklist are read once and converted.
+    """
+
+    def __init__(self, fn: str, sync_records: int = JOURNAL_SYNC_RECORDS, sync_secs: float = JOURNAL_SYNC_SECS):
+        self.fn = fn
+        self._sync_records = sync_records
+        self._sync_secs = sync_secs
+        self._lock = threading.Lock()
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+        self.completed = IntervalSet()
+        records, clean = self._load()
+        # Rewrite whenever the file holds anything but whole records of disjoint ranges.
+        if not clean or records != len(self.completed):
+            self.compact()
+        self._fp = open(self.fn, "ab")
+
+    def _load(self) -> Tuple[int, bool]:
+        if not os.path.exists(self.fn):
+            return 0, False
+        with open(self.fn, "rb") as fp:
+            content = fp.read()
+
+        if content[:len(MAGIC)] != MAGIC:
+            return self._load_legacy(content), False
+        magic, version = HEADER.unpack_from(content)
+        if version != VERSION:
+            raise ValueError(f"Unsupported journal version {version} of file {self.fn!r}.")
+
+        body = memoryview(content)[HEADER.size:]
+        tail = len(body) % RECORD.size
+        if tail:
+            logging.warning(f"[Journal] Dropping a torn record of {tail} bytes from {self.fn!r}.")
+            body = body[:len(body) - tail]
+        # One linear scan over fixed size records.
+        self.completed.update(RECORD.iter_unpack(body))
+        return len(body) // RECORD.size, tail == 0
+
+    def _load_legacy(self, content: bytes) -> int:
+        # The pickled checklist was dumped again after each slice, the last dump is the most complete.
+        checklist = {}
+        with io.BytesIO(content) as fp:
+            while True:
+                try:
+                    checklist = pickle.load(fp)
+                except EOFError:
+                    break
+                except Exception:  # noqa
+                    logging.warning(f"[Journal] Legacy checklist {self.fn!r} is truncated, keeping what was read.")
+                    break
+        self.completed.update(parse_interval(k) for k in checklist)
+        logging.info(f"[Journal] Converted legacy checklist {self.fn!r} with {len(checklist)} ranges.")
+        return len(self.completed)
+
+    def __contains__(self, item: Tuple[int, int]):
+        return item in self.completed
+
+    def __len__(self):
+        return len(self.completed)
+
+    def append(self, low: int, high: int):
+        with self._lock:
+            self.completed.add(low, high)
+            self._fp.write(RECORD.pack(low, high))
+            self._unsynced += 1
+            if self._unsynced >= self._sync_records or time.monotonic() - self._last_sync >= self._sync_secs:
+                self._sync()
+
+    def _sync(self):
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def compact(self):
+        # Merged ranges, sorted, written aside then swapped in.
+        tmp = self.fn + ".tmp"
+        with open(tmp, "wb") as fp:
+            fp.write(HEADER.pack(MAGIC, VERSION))
+            for record in self.completed:
+                fp.write(RECORD.pack(*record))
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp, self.fn)
+        logging.debug(f"[Journal] Compacted {self.fn!r} to {len(self.completed)} records.")
+
+    def close(self, compact: bool = True):
+        with self._lock:
+            self._sync()
+            self._fp.close()
+            if compact:
+                self.compact()
@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import os
+import signal
+import threading
+import time
+from typing import Optional, Tuple
+
+from .static import LIMIT_GRANT, LIMIT_POLL_SECS
+
+_SUFFIXES = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+
+def parse_size(text: str) -> int:
+    # 512K, 10M, 1G or plain bytes.
+    text = text.strip().upper().rstrip("B")
+    if text and text[-1] in _SUFFIXES:
+        return int(float(text[:-1]) * _SUFFIXES[text[-1]])
+    return int(float(text))
+
+
+def parse_limit(text: str) -> Tuple[Optional[int], Optional[int]]:
+    # "<rate> [<burst>]", nothing, 0 or off for no limit.
+    fields = text.split()
+    if not fields or fields[0].lower() in ("0", "off", "none"):
+        return None, None
+    return parse_size(fields[0]), parse_size(fields[1]) if len(fields) > 1 else None
+
+
+class TokenBucket:
+    """
+    Bandwidth ceiling shared by every worker thread and coroutine, in bytes/s,
+    with bursts up to `burst` bytes (one second worth of rate by default).
+
+    Workers take tokens LIMIT_GRANT bytes at a time into a thread-local allowance
+    and spend it chunk by chunk, so the lock is taken once per grant, not per chunk.
+    A grant larger than the tokens left is still handed out, as a debt its taker
+    sleeps off outside the lock, so the rate holds however many workers there are.
+
+    The rate can be changed at any time with set_rate(), or by watch()-ing a
+    control file holding "<rate> [<burst>]", re-read when it changes or on SIGUSR1.
+    """
+
+    def __init__(self, rate: Optional[int] = None, burst: Optional[int] = None):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._rate: Optional[float] = None
+        self._burst = 0
+        self._grant = LIMIT_GRANT
+        self._tokens = 0.0
+        self._last = time.monotonic()
+        self._stop = threading.Event()
+        self._poke = threading.Event()
+        self._watcher: Optional[threading.Thread] = None
+        self.set_rate(rate, burst)
+
+    @property
+    def rate(self) -> Optional[float]:
+        return self._rate
+
+    def set_rate(self, rate: Optional[int], burst: Optional[int] = None):
+        with self._lock:
+            limited, self._rate = self._rate is not None, float(rate) if rate else None
+            if self._rate is None:
+                if limited:
+                    logging.info("[Limiter] Bandwidth limit lifted.")
+                return
+            self._burst = burst or max(int(self._rate), 1)
+            self._grant = max(1, min(LIMIT_GRANT, self._burst))
+            self._tokens = min(self._tokens, self._burst)
+            self._last = time.monotonic()
+        logging.info(f"[Limiter] Limited to {self._rate / 1024:.2f}KB/s, burst of {self._burst} bytes.")
+
+    def _take(self, amt: int) -> float:
+        # Seconds to wait before amt more bytes may go.
+        if self._rate is None:
+            return 0.0
+        allowance = getattr(self._local, "allowance", 0)
+        if allowance >= amt:
+            self._local.allowance = allowance - amt
+            return 0.0
+        grant = max(amt - allowance, self._grant)
+        with self._lock:
+            if self._rate is None:
+                return 0.0
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._last) * self._rate) - grant
+            self._last = now
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0.0
+        self._local.allowance = allowance + grant - amt
+        return wait
+
+    def consume(self, amt: int):
+        wait = self._take(amt)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def aconsume(self, amt: int):
+        wait = self._take(amt)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def reload(self, fn: str):
+        try:
+            with open(fn, "r") as fp:
+                rate, burst = parse_limit(fp.read())
+        except (OSError, ValueError) as e:
+            logging.warning(f"[Limiter] Can't read the limit from {fn!r}, keeping the current one. {e}")
+            return
+        self.set_rate(rate, burst)
+
+    def _watch(self, fn: str, mtime: Optional[int]):
+        while True:
+            self._poke.wait(LIMIT_POLL_SECS)
+            if self._stop.is_set():
+                return
+            poked = self._poke.is_set()
+            self._poke.clear()
+            try:
+                current = os.stat(fn).st_mtime_ns
+            except OSError:
+                continue
+            if poked or current != mtime:
+                mtime = current
+                self.reload(fn)
+
+    def watch(self, fn: str) -> "TokenBucket":
+        mtime = None
+        if os.path.exists(fn):
+            mtime = os.stat(fn).st_mtime_ns
+            self.reload(fn)
+        self._watcher = threading.Thread(target=self._watch, args=(fn, mtime), name="LimiterWatcher", daemon=True)
+        self._watcher.start()
+        if hasattr(signal, "SIGUSR1"):
+            try:
+                # The handler only wakes the watcher up, it may interrupt a thread holding the lock.
+                signal.signal(signal.SIGUSR1, lambda *_: self._poke.set())
+            except ValueError:
+                # Only the main thread may install signal handlers, polling is left.
+                pass
+        return self
+
+    def close(self):
+        self._stop.set()
+        self._poke.set()
+        if self._watcher:
+            self._watcher.join()
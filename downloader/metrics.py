@@ -0,0 +1,200 @@
+import bisect
+import logging
+import os
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, List, Optional
+
+from .static import NS, REPORT_FREQUENCY, EWMA_ALPHA, LATENCY_BUCKETS
+
+
+class _Counter:
+    __slots__ = ("bytes",)
+
+    def __init__(self):
+        self.bytes = 0
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        # Once per slice, far from the hot path, a lock is fine here.
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+
+    def lines(self, metric: str, labels: str) -> List[str]:
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f"{metric}_sum{{{labels}}} {total}")
+        lines.append(f"{metric}_count{{{labels}}} {cumulative}")
+        return lines
+
+
+class Metrics:
+    """
+    Throughput metrics of one transfer, shared by all its workers.
+
+    Every thread counts received bytes into its own counter, add() therefore takes
+    no lock and no clock reading, the counters are only summed by the reporter.
+    The reporter ticks every REPORT_FREQUENCY, keeping an EWMA of the throughput
+    from which the ETA is derived. Slice latencies go into histograms.
+
+    Exported in the Prometheus text format, to a file (atomically replaced at every
+    tick, for the node exporter's textfile collector) and/or over HTTP on localhost.
+    """
+
+    def __init__(self, job: str = "download", total_bytes: int = 0):
+        self.job = job
+        self.total_bytes = total_bytes
+        self._local = threading.local()
+        self._counters: List[_Counter] = []
+        self._register_lock = threading.Lock()
+
+        self.slice_seconds = Histogram()
+        self.ttfb_seconds = Histogram()
+        self.slices: Dict[int, int] = {}
+        self._slices_lock = threading.Lock()
+
+        self.rate: Optional[float] = None  # bytes/s, EWMA
+        self._last_bytes = 0
+        self._last_tick = time.monotonic()
+
+        self._textfile: Optional[str] = None
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._stop = threading.Event()
+        self._reporter: Optional[threading.Thread] = None
+
+    def _counter(self) -> _Counter:
+        try:
+            return self._local.counter
+        except AttributeError:
+            counter = self._local.counter = _Counter()
+            with self._register_lock:
+                self._counters.append(counter)
+            return counter
+
+    def add(self, amt: int):
+        self._counter().bytes += amt
+
+    def finish(self, code: int, seconds: float, ttfb: Optional[float] = None):
+        with self._slices_lock:
+            self.slices[code] = self.slices.get(code, 0) + 1
+        self.slice_seconds.observe(seconds)
+        if ttfb is not None:
+            self.ttfb_seconds.observe(ttfb)
+
+    @property
+    def downloaded(self) -> int:
+        return sum(c.bytes for c in self._counters)
+
+    @property
+    def eta(self) -> Optional[float]:
+        if not self.rate or not self.total_bytes:
+            return None
+        return max(self.total_bytes - self.downloaded, 0) / self.rate
+
+    def tick(self):
+        now = time.monotonic()
+        downloaded = self.downloaded
+        elapsed = now - self._last_tick
+        if elapsed <= 0:
+            return
+        rate = (downloaded - self._last_bytes) / elapsed
+        self.rate = rate if self.rate is None else EWMA_ALPHA * rate + (1 - EWMA_ALPHA) * self.rate
+        self._last_bytes, self._last_tick = downloaded, now
+
+    def to_prometheus(self) -> str:
+        labels = f'job="{self.job}"'
+        lines = [
+            "# HELP downloader_bytes_total Bytes received.",
+            "# TYPE downloader_bytes_total counter",
+            f"downloader_bytes_total{{{labels}}} {self.downloaded}",
+            "# HELP downloader_size_bytes Bytes expected in total.",
+            "# TYPE downloader_size_bytes gauge",
+            f"downloader_size_bytes{{{labels}}} {self.total_bytes}",
+            "# HELP downloader_throughput_bytes Throughput in bytes/s, EWMA.",
+            "# TYPE downloader_throughput_bytes gauge",
+            f"downloader_throughput_bytes{{{labels}}} {self.rate or 0}",
+            "# HELP downloader_eta_seconds Estimated time left.",
+            "# TYPE downloader_eta_seconds gauge",
+            f"downloader_eta_seconds{{{labels}}} {self.eta if self.eta is not None else 'NaN'}",
+            "# HELP downloader_slices_total Finished slices by return code.",
+            "# TYPE downloader_slices_total counter",
+        ]
+        with self._slices_lock:
+            slices = dict(self.slices)
+        lines.extend(f'downloader_slices_total{{{labels},code="{code}"}} {n}' for code, n in sorted(slices.items()))
+        lines.extend([
+            "# HELP downloader_slice_seconds Time to download a slice.",
+            "# TYPE downloader_slice_seconds histogram",
+            *self.slice_seconds.lines("downloader_slice_seconds", labels),
+            "# HELP downloader_ttfb_seconds Time to first byte of a slice.",
+            "# TYPE downloader_ttfb_seconds histogram",
+            *self.ttfb_seconds.lines("downloader_ttfb_seconds", labels),
+        ])
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path: str):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as fp:
+            fp.write(self.to_prometheus())
+        os.replace(tmp, path)
+
+    def serve(self, port: int, host: str = "127.0.0.1"):
+        metrics = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self):  # noqa
+                body = metrics.to_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):  # noqa
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        threading.Thread(target=self._server.serve_forever, name="MetricsServer", daemon=True).start()
+        logging.info(f"[Metrics] Serving on http://{host}:{self._server.server_port}/metrics.")
+
+    def _report(self):
+        while not self._stop.wait(REPORT_FREQUENCY / NS):
+            self.tick()
+            eta = self.eta
+            logging.debug(f"[REPORT] Current speed : {(self.rate or 0) / 1000:.2f} KBytes/s, "
+                          f"{self.downloaded}/{self.total_bytes} bytes, "
+                          f"ETA : {f'{eta:.0f}s' if eta is not None else 'unknown'}")
+            if self._textfile:
+                self.write_textfile(self._textfile)
+
+    def start(self, textfile: Optional[str] = None, port: Optional[int] = None) -> "Metrics":
+        self._textfile = textfile
+        if port is not None:
+            self.serve(port)
+        self._reporter = threading.Thread(target=self._report, name="MetricsReporter", daemon=True)
+        self._reporter.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._reporter:
+            self._reporter.join()
+        self.tick()
+        if self._textfile:
+            self.write_textfile(self._textfile)
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
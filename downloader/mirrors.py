@@ -0,0 +1,110 @@
+import logging
+import threading
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+import requests
+
+from .rangespec import RangeSlicer
+from .static import EWMA_ALPHA, MIRROR_MAX_ERRORS, MIRROR_MIN_SAMPLES, MIRROR_SLOW_RATIO
+
+
+class Mirror:
+    def __init__(self, url: str, validators: Optional[dict] = None):
+        self.url = url
+        self.host = urlparse(url).netloc
+        # Its own ETag and Last-Modified, which its If-Range has to carry.
+        self.validators = validators or {}
+        self.rate: Optional[float] = None  # bytes/s per slice, EWMA
+        self.samples = 0
+        self.errors = 0  # consecutive
+        self.inflight = 0
+
+    def __repr__(self):
+        return f"<Mirror {self.url!r} rate={self.rate} inflight={self.inflight} errors={self.errors}>"
+
+
+class MirrorSet:
+    """
+    Several URLs serving the same file. Every slice goes to the mirror with the
+    lowest (inflight + 1) / throughput, so ranges are spread in proportion to the
+    observed speed of each mirror; mirrors without measurement yet count as the
+    fastest one, so they are tried early.
+
+    A mirror failing MIRROR_MAX_ERRORS times in a row, or running below
+    MIRROR_SLOW_RATIO of the fastest one, is dropped. The last mirror is never dropped.
+    """
+
+    def __init__(self, urls: List[str], validators: Optional[Dict[str, dict]] = None):
+        validators = validators or {}
+        self.mirrors = [Mirror(url, validators.get(url)) for url in dict.fromkeys(urls)]
+        self.dropped: List[Mirror] = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.mirrors)
+
+    @classmethod
+    def probe(cls, url: str, mirrors: List[str], content_length: int, validators: dict,
+              s: requests.Session = None) -> "MirrorSet":
+        """
+        :param url: the reference, always kept, with the length and validators it was prepared with.
+        :param mirrors: other urls, kept when they agree on the length and on the validators they share.
+        """
+        agreeing = {url: validators}
+        for mirror in mirrors:
+            head = RangeSlicer.make_head_request(mirror, s, validators=True)
+            if head is None:
+                logging.warning(f"[Mirror] HEAD request to {mirror} failed, mirror ignored.")
+                continue
+            length, range_types, own = head
+            if length != content_length or any(validators[k] != v for k, v in own.items() if k in validators):
+                logging.warning(f"[Mirror] {mirror} disagrees with {url}: Content-Length = {length}, "
+                                f"validators = {own}, expected {content_length}, {validators}. Mirror ignored.")
+                continue
+            elif not range_types:
+                logging.warning(f"[Mirror] {mirror} doesn't accept ranges, mirror ignored.")
+                continue
+            if not own:
+                logging.warning(f"[Mirror] {mirror} has no validator, a change on it can't be told.")
+            # A validator the reference has and the mirror hasn't can't be sent to it, If-Range uses its own.
+            agreeing.setdefault(mirror, own)
+        logging.info(f"[Mirror] Using {len(agreeing)}/{len(mirrors) + 1} mirrors: {list(agreeing)}.")
+        return cls(list(agreeing), agreeing)
+
+    def pick(self) -> Mirror:
+        with self._lock:
+            known = [m.rate for m in self.mirrors if m.rate]
+            best = max(known) if known else 1.0
+            mirror = min(self.mirrors, key=lambda m: (m.inflight + 1) / (m.rate or best))
+            mirror.inflight += 1
+            return mirror
+
+    def done(self, mirror: Mirror, ok: bool, amt: int = 0, seconds: float = 0.0):
+        with self._lock:
+            mirror.inflight -= 1
+            if not ok:
+                mirror.errors += 1
+                if mirror.errors >= MIRROR_MAX_ERRORS:
+                    self._drop(mirror, f"{mirror.errors} errors in a row")
+                return
+
+            mirror.errors = 0
+            if seconds > 0:
+                rate = amt / seconds
+                mirror.rate = rate if mirror.rate is None else EWMA_ALPHA * rate + (1 - EWMA_ALPHA) * mirror.rate
+                mirror.samples += 1
+
+            measured = [m for m in self.mirrors if m.samples >= MIRROR_MIN_SAMPLES]
+            if len(measured) > 1:
+                fastest = max(m.rate for m in measured)
+                for m in measured:
+                    if m.rate < fastest * MIRROR_SLOW_RATIO:
+                        self._drop(m, f"{m.rate / 1024:.2f}KB/s against {fastest / 1024:.2f}KB/s")
+
+    def _drop(self, mirror: Mirror, reason: str):
+        if mirror not in self.mirrors or len(self.mirrors) <= 1:
+            return
+        self.mirrors.remove(mirror)
+        self.dropped.append(mirror)
+        logging.warning(f"[Mirror] Dropping {mirror.url}, {reason}.")
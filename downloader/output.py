@@ -0,0 +1,128 @@
+import logging
+import mmap
+import os
+
+
+class FragmentWriter:
+    """
+    Default output of a slice, saved as its own <name>@bytes=<low>-<high> fragment,
+    waiting to be joined by concat(). The caller hands over filled buffers, a slice
+    fitting in one buffer is therefore written once, after it was fully received.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._fp = None
+
+    def write(self, chunk):
+        if self._fp is None:
+            self._fp = open(self.name, "wb")
+        self._fp.write(chunk)
+
+    def commit(self):
+        if self._fp is None:
+            # Empty slice, still leave a fragment behind.
+            self._fp = open(self.name, "wb")
+        self.close()
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+
+class DirectWriter:
+    """Positioned writes of a slice straight into the final file, starting at its byte offset."""
+
+    def __init__(self, fd: int, offset: int):
+        self._fd = fd
+        self._offset = offset
+
+    def write(self, chunk):
+        view = memoryview(chunk)
+        while view:
+            written = os.pwrite(self._fd, view, self._offset)
+            self._offset += written
+            view = view[written:]
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class DirectOutput:
+    """
+    The final file preallocated to content_length, shared by every slice.
+    Existing content is kept, so a resumed download only fills what is missing,
+    but a longer file is truncated to content_length.
+    """
+
+    def __init__(self, target: str, content_length: int):
+        self.target = target
+        self.content_length = content_length
+        self._fd = os.open(target, os.O_RDWR | os.O_CREAT, 0o644)
+        self._preallocate()
+
+    def _preallocate(self):
+        size = os.fstat(self._fd).st_size
+        if size == self.content_length:
+            return
+        if size > self.content_length:
+            # Trailing bytes of a longer file, or of the former version of a shrunk resource.
+            os.ftruncate(self._fd, self.content_length)
+            logging.info(f"[Output] [Direct] Truncated {self.target!r} from {size} to {self.content_length} bytes.")
+            return
+        try:
+            os.posix_fallocate(self._fd, 0, self.content_length)
+        except (AttributeError, OSError):
+            # Not every platform and filesystem supports fallocate, a sparse file will do.
+            os.ftruncate(self._fd, self.content_length)
+        logging.info(f"[Output] [Direct] Preallocated {self.target!r} to {self.content_length} bytes.")
+
+    def slice_writer(self, low: int) -> DirectWriter:
+        return DirectWriter(self._fd, low)
+
+    def close(self):
+        os.fsync(self._fd)
+        os.close(self._fd)
+
+
+class MmapWriter:
+    """Copies a slice into its window of the mapped final file, no system call per buffer."""
+
+    def __init__(self, mm: mmap.mmap, offset: int):
+        self._mm = mm
+        self._offset = offset
+
+    def write(self, chunk):
+        n = len(chunk)
+        self._mm[self._offset:self._offset + n] = chunk
+        self._offset += n
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class MmapOutput(DirectOutput):
+    """
+    The preallocated final file, mapped once and shared by every slice. Workers
+    copy their buffers straight into the page cache, the kernel writes the pages
+    back, flushed when the output is closed.
+    """
+
+    def __init__(self, target: str, content_length: int):
+        super().__init__(target, content_length)
+        self._mm = mmap.mmap(self._fd, content_length, access=mmap.ACCESS_WRITE)
+
+    def slice_writer(self, low: int) -> MmapWriter:
+        return MmapWriter(self._mm, low)
+
+    def close(self):
+        self._mm.flush()
+        self._mm.close()
+        super().close()
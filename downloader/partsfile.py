@@ -0,0 +1,163 @@
+import bisect
+import io
+import logging
+import mmap
+import os
+import pickle
+import struct
+import sys
+from array import array
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from .intervals import IntervalSet, parse_interval
+
+MAGIC = b"DPRT"
+VERSION = 1
+# Magic, version, ETag length, content length, unit and number of ranges.
+HEADER = struct.Struct("<4sHHqqq")
+# One range, low and high, both inclusive.
+RECORD = struct.Struct("<qq")
+
+
+class DamagedPartsFile(ValueError):
+    # Empty or cut short, neither a parts file nor a legacy list to convert.
+    pass
+
+
+class UnsupportedPartsFile(ValueError):
+    # A parts file of another version, written by another release, never a legacy list.
+    pass
+
+
+def _padded(n: int) -> int:
+    # Records start 8-byte aligned.
+    return -(-n // 8) * 8
+
+
+class _NoGlobalsUnpickler(pickle.Unpickler):
+    # A parts list is plain strings in a list, anything referring to a global is refused.
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(f"Refusing {module}.{name} in a parts list.")
+
+
+def load_legacy(content: bytes) -> List[Tuple[int, int]]:
+    # Pickled list of "low-high" strings, as written before the binary format.
+    parts = _NoGlobalsUnpickler(io.BytesIO(content)).load()
+    if not isinstance(parts, (list, set, tuple)) or not all(isinstance(p, str) for p in parts):
+        raise ValueError("A legacy parts list holds nothing but \"low-high\" strings.")
+    return [parse_interval(p) for p in parts]
+
+
+def save_parts(fn, ranges: Iterable[Tuple[int, int]], content_length: int = 0,
+               etag: Optional[str] = None, unit: int = 0):
+    """
+    Write ranges as a parts file, merged and sorted, written aside then swapped in.
+    :param content_length, etag: of the resource the ranges belong to, 0 and None when unknown.
+    :param unit: slice size the fragments were downloaded with, 0 when unknown.
+    """
+    merged = IntervalSet(ranges)
+    tag = (etag or "").encode()
+    tmp = f"{fn}.tmp"
+    with open(tmp, "wb") as fp:
+        fp.write(HEADER.pack(MAGIC, VERSION, len(tag), content_length or 0, unit or 0, len(merged)))
+        fp.write(tag.ljust(_padded(len(tag)), b"\0"))
+        for record in merged:
+            fp.write(RECORD.pack(*record))
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp, fn)
+
+
+class PartsFile:
+    """
+    Ranges left to download, as exchanged between machines to repair a download.
+    A header tells the content length, ETag and unit of the resource, then come
+    sorted, disjoint int64 (low, high) pairs.
+
+    The file is memory-mapped and the ranges are read in place, loading costs the
+    same whatever the number of ranges, lookups bisect the lows, O(log n).
+    """
+
+    def __init__(self, fn):
+        self.fn = str(fn)
+        with open(self.fn, "rb") as fp:
+            if os.fstat(fp.fileno()).st_size == 0:
+                # An empty file can't be mapped, it holds no parts either.
+                raise DamagedPartsFile(f"{self.fn!r} is empty, it lists no parts.")
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, tag_size, self.content_length, self.unit, count = HEADER.unpack_from(self._mmap)
+        except struct.error:
+            magic = version = None
+            if bytes(self._mmap[:len(MAGIC)]) == MAGIC:
+                self._mmap.close()
+                raise DamagedPartsFile(f"{self.fn!r} is cut short within its header, it lists no parts.")
+        if magic != MAGIC:
+            self._mmap.close()
+            raise ValueError(f"{self.fn!r} is not a parts file.")
+        if version != VERSION:
+            self._mmap.close()
+            raise UnsupportedPartsFile(f"Unsupported parts file version {version} of file {self.fn!r}, "
+                                       f"{VERSION} expected.")
+
+        start = HEADER.size + _padded(tag_size)
+        found = max(len(self._mmap) - start, 0) // RECORD.size
+        if found < count:
+            self._mmap.close()
+            raise DamagedPartsFile(f"{self.fn!r} is cut short, {count} ranges announced, {found} found.")
+        self.etag = bytes(self._mmap[HEADER.size:HEADER.size + tag_size]).decode() or None
+        records = memoryview(self._mmap)[start:start + count * RECORD.size]
+        if sys.byteorder == "little":
+            self._view = records.cast("q")
+        else:
+            # Records are little-endian wherever they were written, they're swapped into memory on this host.
+            swapped = array("q")
+            swapped.frombytes(records)
+            records.release()
+            swapped.byteswap()
+            self._view = memoryview(swapped)
+        self._lows = self._view[0::2]
+        self._highs = self._view[1::2]
+
+    @classmethod
+    def convert(cls, fn, content_length: int = 0, etag: Optional[str] = None, unit: int = 0) -> "PartsFile":
+        # Legacy pickled parts list rewritten in place, without ever running a pickled global.
+        with open(fn, "rb") as fp:
+            try:
+                ranges = load_legacy(fp.read())
+            except (pickle.UnpicklingError, EOFError) as e:
+                raise DamagedPartsFile(f"{str(fn)!r} is neither a parts file nor a legacy parts list.") from e
+        save_parts(fn, ranges, content_length, etag, unit)
+        logging.info(f"[PartsFile] Converted legacy parts list {str(fn)!r} with {len(ranges)} ranges.")
+        return cls(fn)
+
+    def __len__(self):
+        return len(self._lows)
+
+    def __getitem__(self, idx: int) -> Tuple[int, int]:
+        return self._lows[idx], self._highs[idx]
+
+    def __iter__(self) -> Iterator[Tuple[int, int]]:
+        for idx in range(len(self)):
+            yield self._lows[idx], self._highs[idx]
+
+    def find(self, offset: int) -> Optional[Tuple[int, int]]:
+        # The range holding offset, if any.
+        idx = bisect.bisect_right(self._lows, offset) - 1
+        if idx >= 0 and self._highs[idx] >= offset:
+            return self[idx]
+        return None
+
+    def __contains__(self, item: Tuple[int, int]) -> bool:
+        # The whole of [low, high] lies within one range, the ranges never touch.
+        found = self.find(item[0])
+        return found is not None and found[1] >= item[1]
+
+    def close(self):
+        for view in (self._lows, self._highs, self._view):
+            view.release()
+        self._mmap.close()
+
+    def __repr__(self):
+        return f"PartsFile({self.fn!r}, {len(self)} ranges, content_length={self.content_length}, etag={self.etag})"
+
@@ -1,11 +1,17 @@
+import array
+import bisect
+import heapq
+import itertools
 import os.path
 import pathlib
-import pickle
 import reprlib
-from typing import List, Optional
+from typing import Iterable, Iterator, List, Optional, Tuple
 import requests
 import logging
 
+from .intervals import IntervalSet, parse_interval
+from .partsfile import DamagedPartsFile, PartsFile, UnsupportedPartsFile
+
 
 KB = 1 << 10
 HALF_MB = 1 << 19
@@ -19,7 +25,10 @@ class RangeSlicer:
         self.UNIT = unit
 
     @classmethod
-    def make_head_request(cls, url: str, s: requests.Session = None):
+    def make_head_request(cls, url: str, s: requests.Session = None, validators: bool = False):
+        """
+        :param validators: bool, also return the ETag and Last-Modified of the resource, as a dict.
+        """
         s = s or requests.Session()
         try:
             resp = s.head(url, verify=False)
@@ -36,6 +45,10 @@ class RangeSlicer:
 
         logging.info(resp.headers)
         logging.info(f"[RangeSpec] [HeadSniffing] Content-Length = {content_length}, Accept-Ranges = {range_types}.")
+        if validators:
+            return content_length, range_types, {
+                k: resp.headers[k] for k in ("ETag", "Last-Modified") if k in resp.headers
+            }
         return content_length, range_types
 
     @classmethod
@@ -44,8 +57,10 @@ class RangeSlicer:
             url: str,
             s: requests.Session = None,
             not_slicing: bool = False,
-            specified_low: int = 0
-    ) -> Optional[List[int]]:
+            specified_low: int = 0,
+            unit: int = UNIT,
+            head: Optional[Tuple[int, Optional[str]]] = None
+    ) -> Optional["SlicePlan"]:
         """
         Decide the file slices by knowing whether the server support file range spec,
         and then calculating the optimal slicing result by given unit.
@@ -53,22 +68,19 @@ class RangeSlicer:
         :param not_slicing: If the switch is on, the whole range of that file will be returned.
         :param url: str, url you want to download from.
         :param s: requests.Session, a session object from which the HEAD pre-query request is to be sent.
-        :return:
+        :param unit: int, size of a slice in bytes.
+        :param head: (content_length, range_types) of a previous HEAD request still valid, no request is sent.
+        :return: the plan, its last slice ends at content_length.
         """
-        content_length, range_types = cls.make_head_request(url, s)
+        content_length, range_types = head or cls.make_head_request(url, s)
 
         if specified_low and specified_low < content_length:
-            return [specified_low, content_length]
+            return SlicePlan([(specified_low, content_length)], content_length)
 
         if range_types and not_slicing is False:
-            slices = [b for b in range(0, content_length, UNIT)]
-
-            # The built-in range will stop while not reach the last number.
-            # Such circumstances can be told from comparing the last element with the content-length.
-            if slices[-1] < content_length:
-                slices.append(content_length)
+            slices = SlicePlan([(0, content_length)] if content_length else [], unit)
         else:
-            slices = (0, content_length)
+            slices = SlicePlan([(0, content_length)], max(content_length, 1))
         logging.info(slices)
 
         return slices
@@ -78,39 +90,83 @@ class RangeSlicer:
         return {"Range": f"{range_type}={low}-{high}"}
 
     @classmethod
-    def iterate_over_slices(
-            cls,
-            slices: List[int],
-            direct=False
-    ):
-    # ) -> Generator[None, int, int]:  # noqa
-        if not direct:
-            if slices[0] != -1:
-                slices[0] = -1
-            for idx in range(0, len(slices) - 1):
-                yield slices[idx] + 1, slices[idx + 1]
-        else:
-            # In direct mode, only two neighbored element can be treated as a valid range.
-            for idx in range(0, len(slices) - 1, 2):
-                yield slices[idx], slices[idx + 1]
+    def parse_range(cls, range_value: str) -> Tuple[int, int]:
+        # "bytes=low-high" or "low-high" -> (low, high)
+        return parse_interval(range_value)
+
+
+class SlicePlan:
+    """
+    Slices of a download, planned as segments: every segment [low, high] is cut
+    every `unit` bytes, into (low, low + unit), (low + unit + 1, low + 2 * unit),
+    ... up to high, ranges being inclusive on both ends.
+
+    Only the bounds of the segments are stored, in int64 arrays with the number
+    of slices before each segment, so the plan of a multi-terabyte file takes as
+    much memory as the plan of a small one. Slices are computed when iterated or
+    looked up by their 1-based epoch, in O(log segments). Nothing is mutated.
+    """
+
+    def __init__(self, segments: Iterable[Tuple[int, int]], unit: int = UNIT):
+        self.unit = unit
+        self._lows = array.array("q")
+        self._highs = array.array("q")
+        # Slices before each segment, then the total.
+        self._offsets = array.array("q", [0])
+        for low, high in segments:
+            self._lows.append(low)
+            self._highs.append(high)
+            self._offsets.append(self._offsets[-1] + max(1, -(-(high - low) // unit)))
+
+    def __len__(self):
+        return self._offsets[-1]
+
+    def _slice(self, segment: int, k: int) -> Tuple[int, int]:
+        low = self._lows[segment]
+        return (low if k == 0 else low + k * self.unit + 1), min(low + (k + 1) * self.unit, self._highs[segment])
+
+    def slice_at(self, epoch: int) -> Tuple[int, int]:
+        if not 1 <= epoch <= len(self):
+            raise IndexError(f"Slice {epoch} out of 1-{len(self)}.")
+        segment = bisect.bisect_right(self._offsets, epoch - 1) - 1
+        return self._slice(segment, epoch - 1 - self._offsets[segment])
+
+    def __iter__(self) -> Iterator[Tuple[int, int]]:
+        for segment in range(len(self._lows)):
+            for k in range(self._offsets[segment + 1] - self._offsets[segment]):
+                yield self._slice(segment, k)
+
+    def __repr__(self):
+        segments = ", ".join(f"{low}-{high}" for low, high in zip(self._lows[:4], self._highs[:4]))
+        more = ", ..." if len(self._lows) > 4 else ""
+        return f"SlicePlan({len(self)} slices of {self.unit} bytes over {segments}{more})"
+
+
+def _folder_meta(folder):
+    from .static import Meta
+    try:
+        return Meta.load(folder)
+    except (FileNotFoundError, ValueError):
+        return None
 
 
 class DParts:
     """
     A DParts represent a target block tasks hierarchy,
-    the class need a picked file path as its all parameter,
-    from which it will try to read the content, and then
-    convert into a set for speeding up comparing.
+    the class need a parts file path (or its folder) as its all
+    parameter, which is memory-mapped, see partsfile.PartsFile.
+    Pickled parts lists of former versions are converted on load.
 
     A recommended usage is still downloading with the original
     slices order, and check every range info using "in" operator,
-    if the object return True, then you should continue.
+    if the object return True, then you should continue. Lookups
+    bisect the ranges of the file, in O(log n).
 
-    Every bytes-range is represented as <low-high>, the result of
-    stripping "@bytes=" from the original name.
+    Every bytes-range is (low, high), or <low-high> as a string,
+    the result of stripping "@bytes=" from the original name.
 
-    Internally, get_slice method can change the formate from string
-    liked <low-high> to slices like [low1, high1, low2, high2].
+    get_range_slices() plans the slices of the listed ranges,
+    cut into pieces of at most unit bytes.
 
     A DPart file is generated when concatenating fragments.
     """
@@ -135,150 +191,165 @@ class DParts:
         else:
             self.parts_folder = fpath.parent.absolute()
 
-        with open(fpath, 'rb') as tasks:
-            self._dparts = set(pickle.load(tasks))
-
-        self._dparts = list(self._dparts)
-        self._dparts.sort(key=lambda x: int(x.split('-')[0]))
-        # Lazyload
-        self._slices = None
+        try:
+            self.parts = PartsFile(fpath)
+        except (DamagedPartsFile, UnsupportedPartsFile):
+            raise
+        except ValueError:
+            # Written before the binary format, converted once with what the meta tells.
+            meta = _folder_meta(self.parts_folder)
+            self.parts = PartsFile.convert(
+                fpath, meta.content_length or 0, meta.etag, meta.unit or 0
+            ) if meta else PartsFile.convert(fpath)
+        self.content_length = self.parts.content_length
+        self.etag = self.parts.etag
+        self._intervals: Optional[IntervalSet] = None
+
+    @property
+    def intervals(self) -> IntervalSet:
+        if self._intervals is None:
+            self._intervals = IntervalSet(self.parts)
+        return self._intervals
 
     def __contains__(self, item):
+        # "low-high" or (low, high), True when the whole range is listed.
         if isinstance(item, str):
-            return item in self._dparts
-        return False
+            item = parse_interval(item)
+        return isinstance(item, tuple) and item in self.parts
 
     def __len__(self):
-        return self._dparts.__len__()  if self._slices is None else self._slices.__len__() // 2
+        return self.parts.__len__()
 
     def as_list(self) -> List[str]:
-        return list(self._dparts)
+        return [f"{low}-{high}" for low, high in self.parts]
 
-    @classmethod
-    def range_slices_narrow_down(cls, _l, _h) -> List[int]:
-        r = [_ for _ in range(_l, _h, UNIT)]
-        if _h not in r:
-            r.append(_h)
-        return r
-
-    def get_range_slices(self, **kwargs):
-        # Lazyload
-        if not self._slices:
-            cache = set()
-            slices = []
-            for s in self._dparts:
-                l, h = s.split("-")
-                l, h = int(l), int(h)
-                if h - l > UNIT:
-                    cache.add(l)
-                    cache.add(h)
-                    slices.extend(_t := self.range_slices_narrow_down(l, h))
-                    logging.info(f"[RangeSpec] Range {l}-{h} from "
-                                 f"dparts larger than UNIT:{UNIT}, "
-                                 f"cutting down to pieces: {reprlib.repr(_t)}.")
-                if l not in cache:
-                    slices.append(l)
-                    cache.add(l)
-                if h not in cache:
-                    slices.append(h)
-                    cache.add(h)
-            del cache
-            slices.sort(key=lambda x: int(x))
-            self._slices = slices
-        return self._slices
+    def close(self):
+        # The mapping of the parts file, the planned slices and the intervals built already are kept.
+        self.parts.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def get_range_slices(self, unit: int = UNIT, **kwargs) -> SlicePlan:
+        # Ranges of a parts file are sorted and disjoint already.
+        plan = SlicePlan(self.parts, unit)
+        logging.info(f"[RangeSpec] {len(self.parts)} ranges from dparts planned as {plan}.")
+        return plan
 
 
 class BlockInterpreter:
+    """
+    Blocks (1-based slice indexes) selected by a statement of ':'-separated tokens:
+        n       the block n
+        a-b     blocks a to b, both included
+        a-      blocks from a on, as >a
+        -b      blocks up to b, as <b
+        a-b/s   every s-th block from a to b, b may be left open
+        <n, >n  blocks up to n, from n on, both included
+
+    Nothing is expanded: ranges are kept in an IntervalSet and stepped ranges as
+    (start, stop, step), so `1-50000000` costs as much as `1`. Lookups bisect,
+    blocks() yields the selected blocks in order, lazily.
+    """
+
+    def _fail(self, token: str, reason: str):
+        logging.error(f"[RangeSpec] [Block] Cannot parse {token!r} of {self._raw!r}, {reason}.")
+        exit(-1)
+
+    def _int(self, token: str, value: str) -> int:
+        try:
+            return int(value)
+        except ValueError:
+            self._fail(token, f"{value!r} isn't an integer")
+
+    def _open_upper(self, low: int):
+        self._upper_bound = low if self._upper_bound is None else min(self._upper_bound, low)
+
+    def _open_lower(self, high: int):
+        self._lower_bound = high if self._lower_bound is None else max(self._lower_bound, high)
 
     def _parse(self):
-        # 首先检查是否有column
-        if ":" in self._raw:
-            tokens = self._raw.split(":")
-        else:
-            tokens = [self._raw]
-
-        # 对于每个range item进行处理
-        # 首先要循环找出大于或小于的范围匹配参数，以供精确值的修复使用
-        for token in tokens:
-            if "<" in token:
-                try:
-                    self._lower_bound = int(token.replace("<", ""))
-                except Exception:  # noqa  如果int转换失败，对这个token报错
-                    logging.exception(
-                        f"[RangeSpec] [Block] Cannot convert the specified identifier {token!r} into range spec."
-                    )
-                    exit(-1)
-            elif ">" in token:
-                try:
-                    self._upper_bound = int(token.replace(">", ""))
-                except Exception:  # noqa
-                    logging.exception(
-                        f"[RangeSpec] [Block] Cannot convert the specified identifier {token!r} into range spec."
-                    )
-                    exit(-1)
-
-        for token in tokens:
-            if "<" in token or ">" in token:
+        for token in self._raw.split(":"):
+            token = token.strip()
+            if not token:
+                continue
+            if token.startswith("<"):
+                self._open_lower(self._int(token, token[1:]))
+                continue
+            if token.startswith(">"):
+                self._open_upper(self._int(token, token[1:]))
                 continue
 
-            if "-" in token:
-                try:
-                    _l, _h = token.split('-')
-                except Exception:  # noqa
-                    logging.exception(
-                        f"[RangeSpec] [Block] Cannot parse range {token!r} into exactly two bounds."
-                    )
-                    exit(-1)
-
-                try:
-                    _l, _h = int(_l), int(_h)  # noqa
-                except Exception:  # noqa
-                    logging.exception(
-                        f"[[RangeSpec] [Block]] Cannot parse range {token!r} into integers."
-                    )
-                    exit(-1)
+            token_range, _, token_step = token.partition("/")
+            step = self._int(token, token_step) if token_step else 1
+            if step <= 0:
+                self._fail(token, "the step must be positive")
+            if "-" in token_range:
+                _l, _, _h = token_range.partition("-")
+                low = self._int(token, _l) if _l else None
+                high = self._int(token, _h) if _h else None
+            else:
+                low = high = self._int(token, token_range)
+            if low is not None and high is not None and low > high:
+                self._fail(token, "the range is reversed")
+
+            if step > 1:
+                self._steps.append((1 if low is None else low, high, step))
+            elif low is None and high is None:
+                self._fail(token, "both bounds are missing")
+            elif low is None:
+                self._open_lower(high)
+            elif high is None:
+                self._open_upper(low)
             else:
-                try:
-                    _l, _h = int(token), int(token)
-                except Exception:  # noqa
-                    logging.exception(
-                        f"[RangeSpec] [Block] Cannot parse range {token!r} into integer."
-                    )
-                    exit(-1)
-
-            assert isinstance(_l, int) and isinstance(_h, int)
-
-            # 扩展此部分range
-            for _i in range(_l, _h + 1):
-                if self._lower_bound and _i <= self._lower_bound:
-                    continue
-                if self._upper_bound and _i >= self._upper_bound:
-                    continue
-                self._ranges.add(_i)
+                self._ranges.add(low, high)
 
     def __init__(self, block_stmt: str):
         self._raw: str = block_stmt
 
-        self._upper_bound: Optional[int] = None  # 包含自己
-        self._lower_bound: Optional[int] = None  # 包含自己
-        self._ranges = set()  # 精确命中
+        self._upper_bound: Optional[int] = None  # Included
+        self._lower_bound: Optional[int] = None  # Included
+        self._ranges = IntervalSet()
+        self._steps: List[Tuple[int, Optional[int], int]] = []
 
         self._parse()
 
     def __contains__(self, item):
         if not isinstance(item, int):
             return False
-
-        # 精确搜索
-        if item in self._ranges:
+        if (self._upper_bound is not None and item >= self._upper_bound) or \
+                (self._lower_bound is not None and item <= self._lower_bound):
             return True
-
-        # 范围搜索
-        if (self._upper_bound and item >= self._upper_bound) or (self._lower_bound and item <= self._lower_bound):
+        if item in self._ranges:
             return True
-        return False
+        return any(
+            start <= item and (stop is None or item <= stop) and (item - start) % step == 0
+            for start, stop, step in self._steps
+        )
+
+    def blocks(self, total: int) -> Iterator[int]:
+        # Selected blocks of 1..total, ascending, each once.
+        ranges = self._ranges.copy()
+        if self._lower_bound is not None:
+            ranges.add(1, self._lower_bound)
+        if self._upper_bound is not None:
+            ranges.add(self._upper_bound, total)
+        sequences = [itertools.chain.from_iterable(
+            range(max(low, 1), min(high, total) + 1) for low, high in ranges
+        )]
+        sequences.extend(
+            range(start, min(total if stop is None else stop, total) + 1, step) for start, stop, step in self._steps
+        )
+        last = None
+        for block in heapq.merge(*sequences):
+            if block != last and block >= 1:
+                yield block
+            last = block
 
     def __repr__(self):
         return super(BlockInterpreter, self).__repr__().rsplit(">", maxsplit=1)[0] + \
-               f" == Lower: {self._lower_bound}, Upper: {self._upper_bound}, Ranges: {reprlib.repr(self._ranges)}>"
-
+               f" == Lower: {self._lower_bound}, Upper: {self._upper_bound}, " \
+               f"Ranges: {self._ranges!r}, Steps: {reprlib.repr(self._steps)}>"
@@ -0,0 +1,219 @@
+import collections
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .static import (
+    RETRY_BASE_DELAY, RETRY_MAX_DELAY, BREAKER_WINDOW, BREAKER_THRESHOLD, BREAKER_COOLDOWN
+)
+
+
+def backoff_delay(attempt: int, base: float = RETRY_BASE_DELAY, cap: float = RETRY_MAX_DELAY) -> float:
+    # Exponential backoff with full jitter, retries of a flaky mirror don't arrive in waves.
+    return random.uniform(0, min(cap, base * (1 << attempt)))
+
+
+class _HostState:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self.outcomes = collections.deque(maxlen=BREAKER_WINDOW)
+        self.open_until = 0.0
+
+
+class CircuitBreaker:
+    """
+    Per-host concurrency gate. Every failure seen while the error rate of the last
+    BREAKER_WINDOW requests is above BREAKER_THRESHOLD halves the allowed concurrency,
+    and every success gives one connection back. When a single connection still
+    fails, the circuit opens and nothing is sent to that host for BREAKER_COOLDOWN.
+
+    Threads acquire() it, coroutines aacquire() it, both engines may share one.
+    """
+
+    def __init__(self, concurrency: int):
+        self._concurrency = max(1, concurrency)
+        self._hosts: Dict[str, _HostState] = {}
+        self._cond = threading.Condition()
+        # (loop, future) of the coroutines waiting for a release, woken in their own loop.
+        self._waiters: List[tuple] = []
+
+    def _state(self, host: str) -> _HostState:
+        if host not in self._hosts:
+            self._hosts[host] = _HostState(self._concurrency)
+        return self._hosts[host]
+
+    @staticmethod
+    def _admit(st: _HostState) -> Tuple[bool, Optional[float]]:
+        # Admitted, or else how long to wait at most before asking again, None meaning until a release.
+        wait_for = st.open_until - time.monotonic()
+        if wait_for > 0:
+            return False, wait_for
+        if st.active < st.limit:
+            st.active += 1
+            return True, None
+        return False, None
+
+    def acquire(self, host: str):
+        with self._cond:
+            st = self._state(host)
+            while True:
+                admitted, wait_for = self._admit(st)
+                if admitted:
+                    return
+                self._cond.wait(wait_for)
+
+    async def aacquire(self, host: str):
+        # Only the asyncio engine waits here, the threaded one doesn't import asyncio.
+        import asyncio
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._cond:
+                admitted, wait_for = self._admit(self._state(host))
+                if admitted:
+                    return
+                woken = loop.create_future()
+                self._waiters.append((loop, woken))
+            await asyncio.wait([woken], timeout=wait_for)
+
+    @staticmethod
+    def _wake(woken):
+        if not woken.done():
+            woken.set_result(None)
+
+    def release(self, host: str, ok: Optional[bool]):
+        # ok is None when the answer tells nothing of the host's health, it isn't recorded.
+        with self._cond:
+            st = self._state(host)
+            st.active -= 1
+            if ok:
+                st.outcomes.append(ok)
+                st.limit = min(st.limit + 1, self._concurrency)
+            elif ok is not None:
+                st.outcomes.append(ok)
+                error_rate = st.outcomes.count(False) / len(st.outcomes)
+                if len(st.outcomes) >= BREAKER_WINDOW // 2 and error_rate > BREAKER_THRESHOLD:
+                    if st.limit > 1:
+                        st.limit //= 2
+                        logging.warning(f"[Breaker] Error rate of {host} at {error_rate:.0%}, "
+                                        f"throttled to {st.limit} connections.")
+                    else:
+                        st.open_until = time.monotonic() + BREAKER_COOLDOWN
+                        st.outcomes.clear()
+                        logging.warning(f"[Breaker] {host} keeps failing, pausing it for {BREAKER_COOLDOWN}s.")
+            self._cond.notify_all()
+            waiters, self._waiters = self._waiters, []
+        for loop, woken in waiters:
+            # A waiter may have timed out and its loop ended meanwhile.
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(self._wake, woken)
+
+
+class RetryScheduler:
+    """
+    Retries failed items in the background while the main stream goes on.
+    Items wait in a delay heap, ordered by the time their backoff ends, and a
+    dispatcher thread hands the ready ones to a small pool. An item failing past
+    retry_timeout seconds after its first failure is given up and kept as failed.
+
+    fn(item) is the retry itself and returns 0 on success, items failing with a
+    code in `fatal` are given up at once. Items may bring their own fn, so that
+    several transfers share one scheduler and its `workers` threads, each of them
+    waiting for its own items with wait(fn).
+    """
+
+    def __init__(self, fn: Optional[Callable] = None, workers: int = 1, retry_timeout: float = 3600,
+                 fatal: Tuple[int, ...] = ()):
+        self._fn = fn
+        self._retry_timeout = retry_timeout
+        self._fatal = fatal
+        self._tp = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="retry")
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._pending = 0
+        # Pending and failed items of every fn.
+        self._owners = collections.Counter()
+        self._failed: Dict[Callable, list] = collections.defaultdict(list)
+        self._closed = False
+        self._dispatcher = threading.Thread(target=self._dispatch, name="RetryDispatcher", daemon=True)
+        self._dispatcher.start()
+
+    def submit(self, item, attempt: int = 0, deadline: float = None, fn: Optional[Callable] = None):
+        deadline = deadline or time.monotonic() + self._retry_timeout
+        fn = fn or self._fn
+        with self._cond:
+            self._push(fn, item, attempt, deadline)
+            self._pending += 1
+            self._owners[fn] += 1
+
+    def _push(self, fn: Callable, item, attempt: int, deadline: float):
+        ready_at = time.monotonic() + backoff_delay(attempt)
+        heapq.heappush(self._heap, (ready_at, next(self._seq), attempt, deadline, fn, item))
+        self._cond.notify_all()
+
+    def _dispatch(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed and self._pending == 0:
+                        return
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    wait_for = self._heap[0][0] - time.monotonic()
+                    if wait_for > 0:
+                        self._cond.wait(wait_for)
+                        continue
+                    _, _, attempt, deadline, fn, item = heapq.heappop(self._heap)
+                    break
+            self._tp.submit(self._run, fn, item, attempt, deadline)
+
+    def give_up(self, item, fn: Optional[Callable] = None):
+        # Failed for good at its first attempt, never retried.
+        with self._cond:
+            self._failed[fn or self._fn].append(item)
+
+    def _run(self, fn: Callable, item, attempt: int, deadline: float):
+        try:
+            code = fn(item)
+        except Exception as be:  # noqa
+            logging.exception(f"[Retry] Unhandled exception while retrying {item!r}.", exc_info=be)
+            code = 3
+        with self._cond:
+            if code == 0:
+                logging.info(f"[Retry] Succeeded after {attempt + 1} retries.")
+            elif code in self._fatal or time.monotonic() >= deadline:
+                logging.warning(f"[Retry] Giving up after {attempt + 1} retries, code = {code}.")
+                self._failed[fn].append(item)
+            else:
+                self._push(fn, item, attempt + 1, deadline)
+                return
+            self._pending -= 1
+            self._owners[fn] -= 1
+            self._cond.notify_all()
+
+    def wait(self, fn: Optional[Callable] = None) -> list:
+        # Wait for the pending retries of fn only, the items of fn given up are returned.
+        fn = fn or self._fn
+        with self._cond:
+            while self._owners[fn]:
+                self._cond.wait()
+            del self._owners[fn]
+            return self._failed.pop(fn, [])
+
+    def join(self) -> list:
+        # No more submissions, wait for every pending retry to succeed or time out.
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            while self._pending:
+                self._cond.wait()
+        self._dispatcher.join()
+        self._tp.shutdown()
+        return [item for failed in self._failed.values() for item in failed]
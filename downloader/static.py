@@ -5,12 +5,71 @@ import pathlib
 import time
 
 DEFAULT_DISTRIBUTED_DOWNLOADED_TARFILE = ".dparts.tgz"
+DEFAULT_DISTRIBUTED_DOWNLOADED_ZSTFILE = ".dparts.tar.zst"
 DEFAULT_PARTS_LIST_FILE_NAME = ".dparts"
 DEFAULT_META_FILE_NAME = ".dmeta"
+DEFAULT_DIGEST_FILE_NAME = ".ddigest"
+DEFAULT_FRAGMENT_INDEX_FILE_NAME = ".dindex"
 NS = 1000000000  # S
 REPORT_FREQUENCY = int(0.5 * NS)  # 0.5S
 SLICING = True
 THREADED = True
+WORKERS = 1
+# Bounded in-flight window = WORKERS * IN_FLIGHT_FACTOR
+IN_FLIGHT_FACTOR = 2
+# Upper bound of the memory held by in-flight slice buffers
+MEMORY_BUDGET = 1 << 28  # 256MB
+# Adaptive slicing, a slice should last ADAPTIVE_SLICE_SECS and at least ADAPTIVE_RTT_FACTOR round trips
+ADAPTIVE_MIN_UNIT = 1 << 19  # 512KB
+ADAPTIVE_MAX_UNIT = 1 << 26  # 64MB
+ADAPTIVE_SLICE_SECS = 2
+ADAPTIVE_RTT_FACTOR = 20
+EWMA_ALPHA = 0.3
+# Progress journal, fsync-ed every JOURNAL_SYNC_RECORDS records or JOURNAL_SYNC_SECS
+JOURNAL_SYNC_RECORDS = 256
+JOURNAL_SYNC_SECS = 1  # S
+# Retries, exponential backoff capped at RETRY_MAX_DELAY, with full jitter
+RETRY_BASE_DELAY = 1  # S
+RETRY_MAX_DELAY = 60  # S
+# Per-host circuit breaker, over the last BREAKER_WINDOW requests
+BREAKER_WINDOW = 20
+BREAKER_THRESHOLD = 0.5
+BREAKER_COOLDOWN = 30  # S
+# Slice latency histogram buckets, seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# Asyncio engine connection pool
+AIO_CONNECTIONS = 256
+AIO_CONNECTIONS_PER_HOST = 16
+AIO_KEEPALIVE = 30  # S
+# Mirrors, dropped after MIRROR_MAX_ERRORS failures in a row,
+# or when slower than MIRROR_SLOW_RATIO of the fastest one over MIRROR_MIN_SAMPLES slices
+MIRROR_MAX_ERRORS = 3
+MIRROR_SLOW_RATIO = 0.1
+MIRROR_MIN_SAMPLES = 3
+# Batch download, files fetched side by side and concurrent connections per host
+BATCH_OPEN_FILES = 32
+BATCH_PER_HOST = 4
+BATCH_OPENERS = 4
+# Hosts whose keep-alive connection a worker session keeps
+SESSION_HOSTS = 16
+# Bandwidth limiter, tokens taken LIMIT_GRANT bytes at a time, control file polled every LIMIT_POLL_SECS
+LIMIT_GRANT = 1 << 16  # 64KB
+LIMIT_POLL_SECS = 1  # S
+# Concat, buffer of the copies done in userspace when the kernel can't copy between the files
+COPY_CHUNK = 1 << 20  # 1MB
+# Concat, fragments copied at once, and when the output is fsync-ed
+CONCAT_JOBS = 1
+FSYNC_NONE = "none"
+FSYNC_END = "end"
+FSYNC_FRAGMENT = "fragment"
+# Fragment index of a folder, not saved while the folder changed less than FRAGMENT_INDEX_RACY_SECS ago
+FRAGMENT_INDEX_RACY_SECS = 2  # S
+# Bundles of missing parts, compressed BUNDLE_BLOCK bytes of tar at a time, blocks in parallel
+BUNDLE_GZIP = "gzip"
+BUNDLE_ZSTD = "zstd"
+BUNDLE_BLOCK = 1 << 22  # 4MB
+BUNDLE_GZIP_LEVEL = 6
+BUNDLE_ZSTD_LEVEL = 3
 # CHUNK_SIZE = 1 << 16
 CHUNK_SIZE = 1 << 10
 
@@ -48,12 +107,31 @@ class Meta:
         self.data = kwargs.get("data")
         self.dparts = kwargs.get("dparts")
         self.content_length = kwargs.get("content_length")
+        self.direct = kwargs.get("direct")
+        self.mirrors = kwargs.get("mirrors")
+        self.merkle_root = kwargs.get("merkle_root")
+        # Validators and range support from the HEAD request, reused when resuming.
+        self.etag = kwargs.get("etag")
+        self.last_modified = kwargs.get("last_modified")
+        self.accept_ranges = kwargs.get("accept_ranges")
+        # Slice size the download was planned with.
+        self.unit = kwargs.get("unit")
         # Save & load
         self.start_time = time.time() if instant_save else kwargs.get("start_time")
         if instant_save:
             kwargs['start_time'] = self.start_time
             self._instant_save(**kwargs)
 
+    @classmethod
+    def update(cls, path, **kwargs) -> "Meta":
+        # Add to the saved meta, keeping its start time.
+        d = vars(cls.load(path))
+        d.update(kwargs)
+        o = cls.__new__(cls)
+        o.__init__(**d)
+        o._instant_save(**d)
+        return o
+
     @classmethod
     def load(cls, path) -> "Meta":
         path = pathlib.Path(path)
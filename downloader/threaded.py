@@ -1,5 +1,60 @@
 import threading
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Callable, Iterable, Iterator, Tuple
 
+import requests
 
-tp = ThreadPoolExecutor(max_workers=2)
+from .static import IN_FLIGHT_FACTOR, SESSION_HOSTS
+from .trace import TracedAdapter
+
+_LOCAL = threading.local()
+
+
+def thread_session() -> requests.Session:
+    # Every worker thread owns one session with a single pooled connection per host,
+    # so concurrent slices never queue up behind each other on the same socket.
+    # New connections report their connect time to the traced slice, if any.
+    s = getattr(_LOCAL, "session", None)
+    if s is None:
+        s = requests.Session()
+        adapter = TracedAdapter(pool_connections=SESSION_HOSTS, pool_maxsize=1)
+        s.mount("http://", adapter)
+        s.mount("https://", adapter)
+        _LOCAL.session = s
+    return s
+
+
+def windowed_map(
+        fn: Callable,
+        tasks: Iterable[Tuple],
+        workers: int = 1,
+        window: int = None
+) -> Iterator[Tuple[Tuple, Any]]:
+    """
+    Run fn(*task) for every task, yielding (task, result) pairs in completion order.
+    At most `window` tasks are submitted at any time, so a huge slice list never
+    turns into a huge list of pending futures.
+    :param fn: callable executed by the workers.
+    :param tasks: iterable of argument tuples, consumed lazily.
+    :param workers: number of worker threads, 1 means running inline in the caller's thread.
+    :param window: bounded in-flight window, defaults to workers * IN_FLIGHT_FACTOR.
+    """
+    if workers <= 1:
+        for task in tasks:
+            yield task, fn(*task)
+        return
+
+    window = max(window or workers * IN_FLIGHT_FACTOR, workers)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="slice") as tp:
+        pending = {}
+        for task in tasks:
+            if len(pending) >= window:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+            pending[tp.submit(fn, *task)] = task
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
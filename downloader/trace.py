@@ -0,0 +1,160 @@
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, Hashable, List, Optional
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# The attempt whose request is being sent by the current thread, for the connection hook.
+_LOCAL = threading.local()
+
+
+class SliceTrace:
+    """
+    Timeline of one attempt at a slice, time.monotonic() seconds. The attempt
+    starts when a worker takes the slice, phases nest within [start, end].
+    """
+    __slots__ = ("name", "args", "thread", "queued", "start", "end", "phases", "_sent", "_headers")
+
+    def __init__(self, name: str, queued: Optional[float] = None, **args):
+        self.name = name
+        self.args = args
+        self.thread = threading.current_thread().name
+        self.queued = queued
+        self.start = time.monotonic()
+        self.end: Optional[float] = None
+        self.phases = []
+        self._sent: Optional[float] = None
+        self._headers: Optional[float] = None
+
+    def phase(self, name: str, st: float, end: Optional[float] = None):
+        self.phases.append((name, st, end or time.monotonic()))
+
+    def request_sent(self):
+        # Up to here the worker waited for a buffer and a connection slot of the host.
+        self._sent = time.monotonic()
+        self.phase("acquire", self.start, self._sent)
+        _LOCAL.trace = self
+
+    def headers_received(self):
+        # Connecting, TLS included, then the server's time to answer.
+        _LOCAL.trace = None
+        self._headers = time.monotonic()
+        self.phase("request", self._sent, self._headers)
+
+    def body_received(self, first_byte: Optional[float]):
+        if first_byte is None:
+            return
+        self.phase("first byte", self._headers, first_byte)
+        self.phase("transfer", first_byte)
+
+
+class _TracedConnection:
+    def connect(self):
+        trace: Optional[SliceTrace] = getattr(_LOCAL, "trace", None)
+        st = time.monotonic()
+        super().connect()  # noqa
+        if trace:
+            trace.phase("connect", st)
+            trace.args["new_connection"] = True
+
+
+class _HTTPConnection(_TracedConnection, HTTPConnection):
+    pass
+
+
+class _HTTPSConnection(_TracedConnection, HTTPSConnection):
+    pass
+
+
+class _HTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _HTTPConnection
+
+
+class _HTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _HTTPSConnection
+
+
+class TracedAdapter(HTTPAdapter):
+    """HTTPAdapter whose connections report the time they take to connect to the traced attempt."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": _HTTPConnectionPool, "https": _HTTPSConnectionPool}
+
+
+class Tracer:
+    """
+    Collects the timeline of every slice attempt of a download: queueing, waiting
+    for a buffer and a connection slot, connecting, the request until the headers,
+    the first byte, the transfer, writes and the final commit to disk.
+
+    Saved in the Chrome trace event format, to be opened in chrome://tracing or
+    https://ui.perfetto.dev, a track per worker thread. Queueing overlaps between
+    slices, it's shown as async events of its own.
+    """
+
+    def __init__(self):
+        self._origin = time.monotonic()
+        self._queued: Dict[Hashable, float] = {}
+        self._traces: List[SliceTrace] = []
+        self._lock = threading.Lock()
+
+    def queue(self, key: Hashable):
+        self._queued[key] = time.monotonic()
+
+    def begin(self, name: str, key: Optional[Hashable] = None, **args) -> SliceTrace:
+        # Retries have no key, the backoff before them isn't queueing.
+        return SliceTrace(name, self._queued.pop(key, None), **args)
+
+    def end(self, trace: SliceTrace, code: int, **args):
+        trace.end = time.monotonic()
+        trace.args.update(args, code=code)
+        if getattr(_LOCAL, "trace", None) is trace:
+            # The request failed before its headers came.
+            _LOCAL.trace = None
+        with self._lock:
+            self._traces.append(trace)
+
+    def _us(self, ts: float) -> float:
+        return round((ts - self._origin) * 1e6, 1)
+
+    @staticmethod
+    def _dur(st: float, end: float) -> float:
+        return round((end - st) * 1e6, 1)
+
+    def events(self) -> List[dict]:
+        pid = os.getpid()
+        with self._lock:
+            traces = sorted(self._traces, key=lambda t: t.start)
+        tids: Dict[str, int] = {}
+        events = []
+        for n, trace in enumerate(traces):
+            tid = tids.setdefault(trace.thread, len(tids) + 1)
+            if trace.queued is not None:
+                common = {"name": "queued", "cat": "queue", "id": n, "pid": pid, "tid": tid}
+                events.append({**common, "ph": "b", "ts": self._us(trace.queued), "args": {"slice": trace.name}})
+                events.append({**common, "ph": "e", "ts": self._us(trace.start)})
+            events.append({
+                "name": trace.name, "cat": "slice", "ph": "X", "pid": pid, "tid": tid,
+                "ts": self._us(trace.start), "dur": self._dur(trace.start, trace.end), "args": trace.args
+            })
+            for name, st, end in trace.phases:
+                events.append({
+                    "name": name, "cat": "phase", "ph": "X", "pid": pid, "tid": tid,
+                    "ts": self._us(st), "dur": self._dur(st, end)
+                })
+        for thread, tid in tids.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": thread}})
+        return events
+
+    def save(self, fn: str):
+        tmp = fn + ".tmp"
+        with open(tmp, "w") as fp:
+            json.dump({"traceEvents": self.events(), "displayTimeUnit": "ms"}, fp)
+        os.replace(tmp, fn)
+        logging.info(f"[Trace] {len(self._traces)} slice attempts saved to {fn}.")
@@ -2,13 +2,13 @@ import os
 import pathlib
 import sys
 
-import urllib3
 import logging
 import argparse
 
-from downloader import download, concat
-from downloader.rangespec import DParts, BlockInterpreter
-from utils.migrate import WebServerMigrator
+# Only what every subcommand needs is imported here, the engines and their dependencies
+# (requests, urllib3, lxml, tqdm) are imported by the subcommand running them.
+from downloader.static import WORKERS, BATCH_PER_HOST, CONCAT_JOBS, FSYNC_NONE, FSYNC_END, FSYNC_FRAGMENT, \
+    BUNDLE_GZIP, BUNDLE_ZSTD
 from statics import LOGGING_FORMAT
 
 logging.getLogger("requests").setLevel(logging.ERROR)
@@ -17,15 +17,52 @@ logging.getLogger("urllib").setLevel(logging.ERROR)
 logging.root.setLevel(logging.DEBUG)
 
 
+def disable_warnings():
+    import urllib3
+    urllib3.disable_warnings()
+
+
+def parse_size(text: str) -> int:
+    from downloader.limiter import parse_size as _parse_size
+    return _parse_size(text)
+
+
+def make_limiter(**kwargs):
+    # One bucket for the whole process, every worker draws from it.
+    if not (kwargs.get("limit") or kwargs.get("limit_file")):
+        return None
+    from downloader.limiter import TokenBucket
+    limiter = TokenBucket(kwargs.get("limit"), kwargs.get("burst"))
+    if kwargs.get("limit_file"):
+        limiter.watch(kwargs["limit_file"])
+    return limiter
+
+
 def download_wrapper(**kwargs):
     logging.basicConfig(
         filename="tests.log",
         level=logging.DEBUG,
         format=LOGGING_FORMAT
     )
+    from downloader.downloader import download, ResourceChanged
+    from downloader.rangespec import DParts, BlockInterpreter, MB
+    from downloader.trace import Tracer
+    disable_warnings()
+
+    tracer = Tracer() if kwargs.get("trace") else None
     # Mixin
     keywords = {'path': None, 'name': None, 'headers': None,
-                'data': None, 'retry_timeout': 3600, 'dparts': None, 'block_index': None}
+                'data': None, 'retry_timeout': 3600, 'dparts': None, 'block_index': None,
+                'workers': kwargs.get('workers') or WORKERS, 'direct': kwargs.get('direct', False),
+                'mmap': kwargs.get('mmap', False),
+                'adaptive': kwargs.get('adaptive', False),
+                'metrics_file': kwargs.get('metrics_file'), 'metrics_port': kwargs.get('metrics_port'),
+                'mirrors': kwargs.get('mirror'), 'limiter': make_limiter(**kwargs), 'tracer': tracer}
+    if kwargs.get('memory_budget'):
+        keywords['memory_budget'] = kwargs['memory_budget'] * MB
+
+    if kwargs.get("manifest"):
+        return manifest_wrapper(keywords, **kwargs)
 
     # Arguments check
     url = kwargs.get('url')
@@ -47,8 +84,13 @@ def download_wrapper(**kwargs):
 
     # DParts
     dparts = kwargs.get("dparts")
+    dp = None
     if dparts:
-        dp = DParts(dparts)
+        try:
+            dp = DParts(dparts)
+        except ValueError as ve:
+            logging.error(f"[ENV] Can't read the parts list, {ve}")
+            exit(-1)
         keywords["dparts"] = dp  # NOQA
 
     # block_index
@@ -61,10 +103,54 @@ def download_wrapper(**kwargs):
         keywords["block_index"] = BlockInterpreter(block_index)
         logging.info(keywords["block_index"])
 
-    cl, tf = download(url, **keywords)
+    try:
+        if kwargs.get("asyncio"):
+            # aiohttp is only required by the asyncio engine.
+            from downloader.aio import download_async
+            workers = keywords.pop("workers")
+            if keywords.pop("adaptive"):
+                logging.warning("[ENV] Adaptive slicing is only available with the threaded engine, ignored.")
+            if keywords.pop("tracer"):
+                logging.warning("[ENV] Tracing is only available with the threaded engine, ignored.")
+                tracer = None
+            if workers > 1:
+                keywords["connections_per_host"] = workers
+            cl, tf = download_async(url, **keywords)
+        else:
+            cl, tf = download(url, **keywords)
+    except ResourceChanged as rc:
+        logging.error(f"[ENV] {rc}")
+        exit(-1)
+    finally:
+        if tracer:
+            tracer.save(kwargs["trace"])
+        if dp:
+            dp.close()
     logging.info(tf)
 
 
+def manifest_wrapper(keywords: dict, **kwargs):
+    from downloader.batch import download_manifest
+    for option in ("url", "dparts", "block_index", "asyncio", "adaptive", "mirror"):
+        if kwargs.get(option):
+            logging.warning(f"[ENV] --{option} is not available with --manifest, ignored.")
+
+    # Every file gets a folder of its own under the path.
+    path = kwargs.get("path") or str(pathlib.Path(__file__).absolute().parent)
+    os.makedirs(path, exist_ok=True)
+    failed = download_manifest(
+        kwargs["manifest"], path=path, retry_timeout=keywords["retry_timeout"],
+        workers=keywords["workers"], per_host=kwargs.get("per_host") or BATCH_PER_HOST,
+        direct=keywords["direct"], mmap=keywords["mmap"],
+        metrics_file=keywords["metrics_file"], metrics_port=keywords["metrics_port"],
+        limiter=keywords["limiter"], tracer=keywords["tracer"],
+        **({"memory_budget": keywords["memory_budget"]} if "memory_budget" in keywords else {})
+    )
+    if keywords["tracer"]:
+        keywords["tracer"].save(kwargs["trace"])
+    logging.info(failed)
+
+
 def concat_wrapper(**kwargs):
     logging.basicConfig(
         stream=sys.stdout,
@@ -75,6 +161,7 @@ def concat_wrapper(**kwargs):
     path = kwargs.get('path')
     if not os.path.exists(path):
         raise FileNotFoundError(f"Path {path} not found.")
+    from downloader.concat import concat
     concat(**kwargs)
 
 
@@ -84,10 +171,21 @@ def migrate_wrapper(**kwargs):
         level=logging.DEBUG,
         format=LOGGING_FORMAT
     )
-    wm = WebServerMigrator(kwargs.get("url"))
+    from utils.migrate import WebServerMigrator
+    disable_warnings()
+    wm = WebServerMigrator(kwargs.get("url"), limiter=make_limiter(**kwargs))
     wm.migrate(**kwargs)
 
 
+def add_limit_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("-l", "--limit", type=parse_size, help="Bandwidth ceiling per second, e.g. 512K or 10M.")
+    parser.add_argument("--burst", type=parse_size, help="Bytes allowed in a burst, one second of --limit by default.")
+    parser.add_argument(
+        "--limit_file",
+        help="Control file holding '<limit> [<burst>]' or 'off', re-read when changed or on SIGUSR1."
+    )
+
+
 def get_argparser():
     _base = argparse.ArgumentParser()
     _base.set_defaults(func=lambda **kwargs: print(_base.format_help()))
@@ -95,19 +193,93 @@ def get_argparser():
     # Download subcommand
     subparser = _base.add_subparsers()
     download_parser = subparser.add_parser("download")
-    download_parser.add_argument("url")
+    download_parser.add_argument("url", nargs="?")
+    download_parser.add_argument(
+        "-L", "--manifest",
+        help="File listing one url per line, optionally followed by a name. All are downloaded in this process."
+    )
+    download_parser.add_argument(
+        "-P", "--per_host", type=int, default=BATCH_PER_HOST,
+        help="With --manifest, connections per host at most, --workers being the global limit."
+    )
     download_parser.add_argument("-c", "--dparts", help="Folder or specific parts list file path.")
     download_parser.add_argument("-p", "--path", help="Folder to store the file.")
     download_parser.add_argument("-n", "--name", help="Name of the file.")
-    download_parser.add_argument("-I", "--block_index", help="Integers of fragment index.")
+    download_parser.add_argument(
+        "-I", "--block_index",
+        help="Blocks (1-based slice indexes) to download, ':'-separated: n, a-b, a-, -b, a-b/step, <n or >n."
+    )
+    download_parser.add_argument(
+        "-w", "--workers", type=int, default=WORKERS,
+        help="Number of slices downloaded concurrently, each over its own connection. "
+             "With --asyncio, the per-host connection limit."
+    )
+    download_parser.add_argument(
+        "-A", "--asyncio", action="store_true",
+        help="Schedule slices as coroutines over a shared keep-alive pool, requires aiohttp."
+    )
+    download_parser.add_argument(
+        "-D", "--direct", action="store_true",
+        help="Write slices at their offsets of a preallocated file, no fragments and no concat."
+    )
+    download_parser.add_argument(
+        "--mmap", action="store_true",
+        help="Like --direct, slices are copied into a memory map of the file instead of written."
+    )
+    download_parser.add_argument(
+        "-a", "--adaptive", action="store_true",
+        help="Size slices from the measured throughput and RTT, idle workers split the slowest range."
+    )
+    download_parser.add_argument(
+        "-M", "--memory_budget", type=int,
+        help="Megabytes of slice buffers held at once, new slices wait when it's used up."
+    )
+    download_parser.add_argument(
+        "-m", "--mirror", action="append",
+        help="Another url of the same file, repeatable. Slices are spread over the agreeing mirrors by throughput."
+    )
+    add_limit_arguments(download_parser)
+    download_parser.add_argument("--metrics_file", help="Prometheus text file, rewritten at every report.")
+    download_parser.add_argument("--metrics_port", type=int, help="Serve Prometheus metrics on localhost:port.")
+    download_parser.add_argument(
+        "-T", "--trace", help="Save the timeline of every slice to this file, Chrome trace format (Perfetto)."
+    )
     download_parser.set_defaults(func=download_wrapper)
 
     # Concat subcommand
     concat_parser = subparser.add_parser("concat")
     concat_parser.add_argument("path")
     concat_parser.add_argument("-f", "--without_meta", action="store_true", help="Continue without meta file.")
-    concat_parser.add_argument("-F", "--force", action="store_true", help="Don't check mission, just concat.")
+    concat_parser.add_argument(
+        "-F", "--force", action="store_true", help="Don't check missing blocks nor digests, just concat."
+    )
     concat_parser.add_argument("-E", "--export", action="store_true", help="Export digest only.")
+    concat_parser.add_argument(
+        "-j", "--jobs", type=int, default=CONCAT_JOBS,
+        help="Fragments copied at once, each at its offset of the preallocated file, e.g. 8 on NVMe."
+    )
+    concat_parser.add_argument(
+        "--fsync", choices=(FSYNC_NONE, FSYNC_END, FSYNC_FRAGMENT), default=FSYNC_NONE,
+        help="Sync the file to disk once complete (end) or after every fragment (fragment)."
+    )
+    concat_parser.add_argument(
+        "-B", "--bundle", choices=(BUNDLE_GZIP, BUNDLE_ZSTD), default=BUNDLE_GZIP,
+        help="Compression of the bundle of healthy fragments made when some are missing, zstd requires zstandard."
+    )
+    concat_parser.add_argument(
+        "-U", "--unbundle", help="Extract this bundle of fragments into path, then exit."
+    )
+    concat_parser.add_argument(
+        "-V", "--verify", action="store_true",
+        help="Hash every fragment against its digest and check the Merkle root, instead of checking sizes only."
+    )
+    concat_parser.add_argument(
+        "--no_index", action="store_true", help="Scan the fragments again instead of reusing the folder's index."
+    )
+    concat_parser.add_argument(
+        "-C", "--convert", action="store_true",
+        help="Convert the pickled .dparts files under path to the binary format."
+    )
     concat_parser.set_defaults(func=concat_wrapper)
 
     # Migrate subcommand
@@ -120,6 +292,9 @@ def get_argparser():
         action="store_true",
         help="Make another directory based on to, or current working directory."
     )
+    add_limit_arguments(migrate_parser)
+    migrate_parser.add_argument("--metrics_file", help="Prometheus text file, rewritten at every report.")
+    migrate_parser.add_argument("--metrics_port", type=int, help="Serve Prometheus metrics on localhost:port.")
     migrate_parser.set_defaults(func=migrate_wrapper)
 
     return _base
@@ -128,9 +303,6 @@ def get_argparser():
 if __name__ == '__main__':
     base = get_argparser()
 
-    # Disable warnings
-    urllib3.disable_warnings()
-
     # Parse args & execute
     args = base.parse_args()
     args.func(**args.__dict__)
@@ -1,19 +1,49 @@
+import io
+import mmap
+import os
 from io import BufferedReader, BufferedWriter
 
 from downloader.rangespec import UNIT
 
 
+def _iterate_by_read(fp: BufferedReader, amt: int, chunk_size=UNIT):
+    read = 0
+    while read < amt:
+        chunk = fp.read(min(chunk_size, amt - read))
+        if not chunk:
+            break
+        read += len(chunk)
+        yield chunk
+
+
 def iterate_over_size(fp: BufferedReader, amt: int, chunk_size=UNIT):
+    """
+    Yield up to amt bytes from the current position of fp, chunk_size at a time.
+    Chunks are memoryviews of a read-only mapping of the file, nothing is copied
+    into Python objects. Streams which can't be mapped are read as usual.
+    """
     if not fp or not fp.readable():
         raise ValueError("File pointer not valid.")
 
-    read = 0
-    nbrk = True
-    while nbrk:
-        _read_size = chunk_size if read + chunk_size < amt else amt - read
-        nbrk = False if read + chunk_size > amt else True
-        yield fp.read(_read_size)
-        read += _read_size
+    try:
+        fileno = fp.fileno()
+    except (io.UnsupportedOperation, AttributeError):
+        yield from _iterate_by_read(fp, amt, chunk_size)
+        return
+
+    start = fp.tell()
+    amt = max(min(amt, os.fstat(fileno).st_size - start), 0)
+    if amt == 0:
+        return
+    # A mapping starts at a multiple of the allocation granularity.
+    skip = start % mmap.ALLOCATIONGRANULARITY
+    mm = mmap.mmap(fileno, skip + amt, access=mmap.ACCESS_READ, offset=start - skip)
+    view = memoryview(mm)[skip:]
+    # The mapping is released once the last chunk handed out is.
+    del mm
+    for offset in range(0, amt, chunk_size):
+        yield view[offset:offset + chunk_size]
+    fp.seek(start + amt)
 
 
 # 1853196977-2018370263-MISSING
@@ -15,6 +15,9 @@ from urllib.parse import urljoin, unquote
 from lxml import etree
 from lxml.etree import _Element  # noqa
 
+from downloader.limiter import TokenBucket
+from downloader.metrics import Metrics
+
 
 def seconds_friendly(secs):
     if secs == math.nan:
@@ -46,33 +49,30 @@ def seconds_friendly(secs):
 
 
 class WebServerMigrator:
-    def __init__(self, url: str):
+    def __init__(self, url: str, limiter: Optional[TokenBucket] = None):
         self._tp = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="migrator")
         self._url = url
         if not self._url.endswith('/'):
             self._url += '/'
 
-        # Bytes audit
-        self._tp_lock = threading.Lock()
-        self._current_amt = 0
+        # Bytes & task audit
+        self._metrics = Metrics(job="migrate")
+        self._limiter = limiter
         self._total_amt = 0
-
-        # Task audit
-        self._finished_length_lock = threading.Lock()
         self.__targets_length = 0
-        self._finished_length = 0
 
         self.__single_thread: Optional[threading.Thread] = None
 
     def _download(self, url, name, path: pathlib.Path):
+        st = time.monotonic()
         with open(path / name, "wb") as buffer:
             resp = requests.get(url, stream=True)
             for chunk in resp.iter_content(chunk_size=2048):
                 buffer.write(chunk)
-                with self._tp_lock:
-                    self._current_amt += 2048
-        with self._finished_length_lock:
-            self._finished_length += 1
+                self._metrics.add(len(chunk))
+                if self._limiter:
+                    self._limiter.consume(len(chunk))
+        self._metrics.finish(0, time.monotonic() - st)
         logging.info(f"[_download] Finish task, url = {url}.")
 
     def gen_tasks(self, targets):
@@ -104,6 +104,7 @@ class WebServerMigrator:
                 current += 1
 
         self._total_amt = size
+        self._metrics.total_bytes = size
         return size
 
     def _single_threaded(self, targets, path):
@@ -115,20 +116,17 @@ class WebServerMigrator:
         return threading.Thread(target=self._single_threaded, args=(targets, path), name="Worker")
 
     def main_receiver(self):
-        downloaded = 0
         while self.__single_thread and self.__single_thread.is_alive():
             time.sleep(1)
-            with self._tp_lock:
-                speed = self._current_amt
-                self._current_amt = 0
-            downloaded += speed
-            speed_kilo = speed / 1000
-            eta = (self._total_amt - downloaded) // speed if speed != 0 else math.nan  # seconds
-            logging.info(f"[Migrator] [{self._finished_length}/{self.__targets_length}] "
-                         f"Downloaded {downloaded}/{self._total_amt} bytes @ {speed_kilo:.2f} kbps, "
+            self._metrics.tick()
+            speed_kilo = (self._metrics.rate or 0) / 1000
+            eta = self._metrics.eta
+            eta = int(eta) if eta is not None else math.nan  # seconds
+            logging.info(f"[Migrator] [{sum(self._metrics.slices.values())}/{self.__targets_length}] "
+                         f"Downloaded {self._metrics.downloaded}/{self._total_amt} bytes @ {speed_kilo:.2f} kbps, "
                          f"ETA : {seconds_friendly(eta)}.")
 
-    def migrate(self, to=None, mkdir=True, **kwargs):  # noqa
+    def migrate(self, to=None, mkdir=True, metrics_file=None, metrics_port=None, **kwargs):  # noqa
         if not (to and os.path.exists(to)):
             to = pathlib.Path(os.getcwd())
         else:
@@ -157,4 +155,7 @@ class WebServerMigrator:
         # Calling
         self.__single_thread = self.single_threaded_download(targets, path=destiny)
         self.__single_thread.start()
+        if metrics_file or metrics_port is not None:
+            self._metrics.start(textfile=metrics_file, port=metrics_port)
         self.main_receiver()
+        self._metrics.stop()